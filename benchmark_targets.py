@@ -0,0 +1,115 @@
+import argparse
+import time
+
+import torch
+
+from utils.utils import bbox_iou, bbox_wh_iou, build_targets, build_targets_layers
+
+# Anchors of config/yolov3.cfg, in pixels, for the 13, 26 and 52 grids of a 416 image
+YOLOV3_ANCHORS = [
+    [(116, 90), (156, 198), (373, 326)],
+    [(30, 61), (62, 45), (59, 119)],
+    [(10, 13), (16, 30), (33, 23)],
+]
+
+
+def reference_build_targets(pred_boxes, pred_cls, target, anchors, ignore_thres):
+    """ build_targets before vectorization: nine new dense tensors and a loop over the targets """
+    nB, nA, nG, nC = pred_boxes.size(0), pred_boxes.size(1), pred_boxes.size(2), pred_cls.size(-1)
+    obj_mask = torch.zeros(nB, nA, nG, nG, dtype=torch.bool, device=pred_boxes.device)
+    noobj_mask = torch.ones(nB, nA, nG, nG, dtype=torch.bool, device=pred_boxes.device)
+    class_mask, iou_scores, tx, ty, tw, th = torch.zeros(6, nB, nA, nG, nG, device=pred_boxes.device)
+    tcls = torch.zeros(nB, nA, nG, nG, nC, device=pred_boxes.device)
+
+    target_boxes = target[:, 2:6] * nG
+    gxy = target_boxes[:, :2]
+    gwh = target_boxes[:, 2:]
+    ious = torch.stack([bbox_wh_iou(anchor, gwh) for anchor in anchors])
+    best_ious, best_n = ious.max(0)
+    b, target_labels = target[:, :2].long().t()
+    gx, gy = gxy.t()
+    gw, gh = gwh.t()
+    gi, gj = gxy.long().t()
+    obj_mask[b, best_n, gj, gi] = 1
+    noobj_mask[b, best_n, gj, gi] = 0
+    for i, anchor_ious in enumerate(ious.t()):
+        noobj_mask[b[i], anchor_ious > ignore_thres, gj[i], gi[i]] = 0
+    tx[b, best_n, gj, gi] = gx - gx.floor()
+    ty[b, best_n, gj, gi] = gy - gy.floor()
+    tw[b, best_n, gj, gi] = torch.log(gw / anchors[best_n][:, 0] + 1e-16)
+    th[b, best_n, gj, gi] = torch.log(gh / anchors[best_n][:, 1] + 1e-16)
+    tcls[b, best_n, gj, gi, target_labels] = 1
+    class_mask[b, best_n, gj, gi] = (pred_cls[b, best_n, gj, gi].argmax(-1) == target_labels).float()
+    iou_scores[b, best_n, gj, gi] = bbox_iou(pred_boxes[b, best_n, gj, gi], target_boxes, x1y1x2y2=False)
+    tconf = obj_mask.float()
+    return iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf
+
+
+def random_batch(batch_size, max_objects, num_classes, img_size, device):
+    """ Predictions of the three YOLO layers and 'max_objects' targets per image """
+    pred_boxes, pred_cls, anchors = [], [], []
+    for layer_anchors, stride in zip(YOLOV3_ANCHORS, (32, 16, 8)):
+        nG = img_size // stride
+        pred_boxes.append(torch.rand(batch_size, 3, nG, nG, 4, device=device) * nG)
+        pred_cls.append(torch.rand(batch_size, 3, nG, nG, num_classes, device=device))
+        anchors.append(torch.tensor(layer_anchors, dtype=torch.float32, device=device) / stride)
+
+    target = torch.zeros(batch_size * max_objects, 6, device=device)
+    target[:, 0] = torch.arange(batch_size, device=device).repeat_interleave(max_objects)
+    target[:, 1] = torch.randint(0, num_classes, (len(target),), device=device)
+    target[:, 2:4] = torch.rand(len(target), 2, device=device) * 0.98 + 0.01
+    target[:, 4:6] = torch.rand(len(target), 2, device=device) * 0.5 + 0.01
+    return pred_boxes, pred_cls, target, anchors
+
+
+def timed(function, iterations, device):
+    function()  # Warm up, also fills the buffer pool
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=8, help="size of each image batch")
+    parser.add_argument("--max_objects", type=int, default=100, help="targets per image (ListDataset.max_objects)")
+    parser.add_argument("--num_classes", type=int, default=80, help="number of classes")
+    parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--iterations", type=int, default=20, help="timed calls of each builder")
+    opt = parser.parse_args()
+    print(opt)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    pred_boxes, pred_cls, target, anchors = random_batch(
+        opt.batch_size, opt.max_objects, opt.num_classes, opt.img_size, device
+    )
+    layers = list(zip(pred_boxes, pred_cls, anchors))
+
+    # The builders must agree before their times are compared
+    for (layer_boxes, layer_cls, layer_anchors), layer_targets in zip(
+        layers, build_targets_layers(pred_boxes, pred_cls, target, anchors, 0.5)
+    ):
+        expected = reference_build_targets(layer_boxes, layer_cls, target, layer_anchors, 0.5)
+        assert all(torch.equal(a.float(), b.float()) for a, b in zip(layer_targets, expected))
+
+    results = {
+        "reference loop, per layer": timed(
+            lambda: [reference_build_targets(b, c, target, a, 0.5) for b, c, a in layers], opt.iterations, device
+        ),
+        "build_targets, per layer": timed(
+            lambda: [build_targets(b, c, target, a, 0.5) for b, c, a in layers], opt.iterations, device
+        ),
+        "build_targets_layers": timed(
+            lambda: build_targets_layers(pred_boxes, pred_cls, target, anchors, 0.5), opt.iterations, device
+        ),
+    }
+    print(f"{len(target)} targets on {device}, three YOLO layers")
+    for name, milliseconds in results.items():
+        speedup = results["reference loop, per layer"] / milliseconds
+        print(f"{name:28s} {milliseconds:8.2f} ms  {speedup:5.1f}x")
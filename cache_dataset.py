@@ -0,0 +1,21 @@
+import os
+import argparse
+
+from utils.datasets import build_dataset_cache
+from utils.parse_config import parse_data_config
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_config", type=str, default="config/custom.data", help="path to data config file")
+    parser.add_argument("--cache_dir", type=str, default="data/cache", help="directory where the cache is written")
+    parser.add_argument("--img_size", type=int, default=512, help="size of the cached images, at least the largest training size")
+    parser.add_argument("--shard_size", type=int, default=1024, help="number of images per memory-mapped shard")
+    opt = parser.parse_args()
+    print(opt)
+
+    data_config = parse_data_config(opt.data_config)
+    for split in ["train", "valid"]:
+        print(f"Caching {data_config[split]}...")
+        build_dataset_cache(
+            data_config[split], os.path.join(opt.cache_dir, split), img_size=opt.img_size, shard_size=opt.shard_size
+        )
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+
+METODOS = ('caja', 'pixelado', 'relleno', 'gaussiano')
+
+
+def sigma_equivalente(lado):
+    """
+    Sigma del desenfoque gaussiano que se aplicaba a una región de este lado: núcleo de dos
+    tercios del lado, mínimo 31, con el sigma que OpenCV deduce del tamaño del núcleo
+
+    Args:
+        lado (int): Ancho o alto de la región en píxeles
+
+    Returns:
+        float: Sigma en píxeles
+    """
+    ksize = max(31, lado // 3 * 2 | 1)
+    return 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+
+
+class Anonimizador:
+    def __init__(self, metodo='caja', fuerza=1.0, color=(0, 0, 0)):
+        """
+        Oculta las matrículas de un frame con un coste por píxel que no depende del tamaño de la caja
+
+        Args:
+            metodo (str): 'caja' aplica tres pasadas de desenfoque de caja, que equivalen a un
+                gaussiano; 'pixelado' reduce la región y la vuelve a ampliar por bloques; 'relleno'
+                la pinta de un color sólido; 'gaussiano' es el desenfoque gaussiano original
+            fuerza (float): Multiplicador de la intensidad. Con 1.0 el desenfoque de caja tiene la
+                misma sigma que el gaussiano original y los bloques del pixelado miden tres sigmas;
+                valores mayores ocultan más
+            color (tuple): Color BGR del relleno
+        """
+        if metodo not in METODOS:
+            raise ValueError(f"Método de anonimizado desconocido: {metodo}. Opciones: {', '.join(METODOS)}")
+        if fuerza < 1.0:
+            raise ValueError(f"fuerza debe ser al menos 1.0 para no ocultar menos que el desenfoque original: {fuerza}")
+
+        self.metodo = metodo
+        self.fuerza = fuerza
+        self.color = color
+
+    def __call__(self, imagen, cajas):
+        """
+        Anonimiza todas las cajas de una imagen en una sola llamada
+
+        Args:
+            imagen (np.ndarray): Imagen BGR que se modifica en el sitio
+            cajas (np.ndarray): Cajas (N, 4) en formato x1, y1, x2, y2
+
+        Returns:
+            np.ndarray: La misma imagen
+        """
+        alto, ancho = imagen.shape[:2]
+        cajas = np.asarray(cajas).reshape(-1, 4).astype(int)
+        cajas[:, [0, 2]] = cajas[:, [0, 2]].clip(0, ancho)
+        cajas[:, [1, 3]] = cajas[:, [1, 3]].clip(0, alto)
+
+        for x1, y1, x2, y2 in cajas:
+            region = imagen[y1:y2, x1:x2]
+            if region.size == 0:
+                continue
+            h, w = region.shape[:2]
+
+            if self.metodo == 'relleno':
+                region[:] = self.color
+            elif self.metodo == 'gaussiano':
+                ksize = (int(max(31, w // 3 * 2 | 1) * self.fuerza) | 1,
+                         int(max(31, h // 3 * 2 | 1) * self.fuerza) | 1)  # siempre impar
+                region[:] = cv2.GaussianBlur(region, ksize, 0)
+            elif self.metodo == 'pixelado':
+                bloque_x = 3 * self.fuerza * sigma_equivalente(w)
+                bloque_y = 3 * self.fuerza * sigma_equivalente(h)
+                pequena = cv2.resize(region, (max(1, int(w / bloque_x)), max(1, int(h / bloque_y))),
+                                     interpolation=cv2.INTER_AREA)
+                region[:] = cv2.resize(pequena, (w, h), interpolation=cv2.INTER_NEAREST)
+            else:
+                # Tres pasadas de caja de lado 2 * sigma dan una sigma igual a la del gaussiano
+                lado_x = int(2 * self.fuerza * sigma_equivalente(w)) | 1
+                lado_y = int(2 * self.fuerza * sigma_equivalente(h)) | 1
+                borrosa = region
+                for _ in range(3):
+                    borrosa = cv2.blur(borrosa, (lado_x, lado_y))
+                region[:] = borrosa
+        return imagen
@@ -1,13 +1,29 @@
-from flask import Flask, request, render_template, url_for, send_from_directory, jsonify
+from flask import Flask, request, render_template, url_for, send_from_directory, send_file, jsonify, redirect
 import os
+import io
 import uuid
 import json
-from flask_socketio import SocketIO, emit
-from detector import difuminar_matricula
-from detector_yolo import difuminar_matricula_yolo
-from detector_video_yolo import DetectorVideoYOLO
+import mimetypes
+import threading
+import time
+import zipfile
+import cv2
+import numpy as np
+from flask_socketio import SocketIO, emit, join_room
+from detector import difuminar_imagen
+from detector_yolo import difuminar_imagen_yolo, modelo_path
+from cascada import CompuertaCascada, difuminar_imagen_cascada
+from anonimizador import Anonimizador
+from servicio_inferencia import ServicioInferencia, ServicioSaturado
+from cola_trabajos import ColaTrabajos
+from detecciones import EscritorDetecciones, LectorDetecciones
+from cache_resultados import CacheLRU, CacheContenido, PeticionConHash, clave_contenido, huella_archivo
+from procesamiento_lote import procesar_lote, entradas_zip, escritor_zip, EXTENSIONES_IMAGEN
+from video_paralelo import procesar_video_paralelo
 
 app = Flask(__name__)
+# Las subidas calculan su SHA-256 mientras llegan: la clave de la caché no necesita releer el archivo
+app.request_class = PeticionConHash
 app.config['SECRET_KEY'] = 'secret!'
 app.config['SERVER_NAME'] = 'localhost:5000'  # Asegúrate de que coincida con tu configuración
 app.config['APPLICATION_ROOT'] = '/'
@@ -18,10 +34,50 @@ OUTPUT_FOLDER = 'procesadas'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# Las imágenes se procesan en memoria y se sirven desde una caché LRU; guardarlas en disco es opcional
+PERSISTIR_IMAGENES = os.environ.get('PERSISTIR_IMAGENES', '0') == '1'
+imagenes = CacheLRU(max_bytes=int(os.environ.get('CACHE_IMAGENES_MB', 256)) * 1024 * 1024)
+
+# Resultados direccionados por contenido: una subida repetida con los mismos parámetros no se vuelve
+# a procesar. Se expulsan por LRU cuando superan el presupuesto de disco
+CACHE_FOLDER = os.path.join('static', 'procesadas', 'cache')
+cache = CacheContenido(CACHE_FOLDER, max_bytes=int(os.environ.get('CACHE_DISCO_MB', 10240)) * 1024 * 1024)
+# Un modelo nuevo invalida los resultados de la caché
+VERSION_MODELO = huella_archivo(modelo_path) if os.path.exists(modelo_path) else 'sin_modelo'
+# Confianza con la que se procesan los videos; forma parte de la clave de la caché
+CONFIANZA_VIDEO = float(os.environ.get('CONFIANZA_VIDEO', 0.5))
+
+LOTE_FOLDER = os.path.join(OUTPUT_FOLDER, 'lotes')
+os.makedirs(LOTE_FOLDER, exist_ok=True)
+# Horas que se conserva el zip de un lote para descargarlo
+LOTE_HORAS = float(os.environ.get('LOTE_HORAS', 24))
+
 VIDEO_UPLOAD_FOLDER = 'static/uploads/videos'
-VIDEO_OUTPUT_FOLDER = 'static/procesadas/videos'
 os.makedirs(VIDEO_UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(VIDEO_OUTPUT_FOLDER, exist_ok=True)
+
+# Servicio de inferencia compartido por las imágenes y los videos: los modelos se cargan una sola vez,
+# en iniciar_servicios(). Las imágenes y los lotes van por su carril prioritario y los videos en curso
+# los atienden entre sus lotes, así que no esperan a que termine un video largo
+NUM_WORKERS = int(os.environ.get('NUM_WORKERS', 1))
+MAX_TRABAJOS = int(os.environ.get('MAX_TRABAJOS', 8))
+servicio = None
+# Segundos que una petición espera a su imagen o a su lote antes de responder 503
+TIMEOUT_IMAGEN = float(os.environ.get('TIMEOUT_IMAGEN', 30))
+TIMEOUT_LOTE = float(os.environ.get('TIMEOUT_LOTE', 300))
+# Frames entre detecciones en los videos; en los intermedios las matrículas se siguen con flujo óptico
+DETECTAR_CADA = int(os.environ.get('DETECTAR_CADA', 1))
+# Diferencia máxima de gris entre miniaturas bajo la cual un frame reutiliza las detecciones del anterior (0 desactiva)
+UMBRAL_ESTATICO = float(os.environ.get('UMBRAL_ESTATICO', 0))
+# Con más de un proceso, los videos se dividen en trozos que procesa un pool de procesos, cada uno con
+# su propio modelo. Así no se guardan sus detecciones: cambiar después solo el anonimizado vuelve a detectar
+PROCESOS_VIDEO = int(os.environ.get('PROCESOS_VIDEO', 1))
+# Primera etapa del método cascada para imágenes: el clasificador Haar decide si se llama a YOLO.
+# Una sola compuerta para todas las peticiones acumula cuántas imágenes se saltaron YOLO
+CASCADA_ESCALA = float(os.environ.get('CASCADA_ESCALA', 0.5))
+CASCADA_MIN_VECINOS = int(os.environ.get('CASCADA_MIN_VECINOS', 2))
+compuerta = CompuertaCascada(escala=CASCADA_ESCALA, min_vecinos=CASCADA_MIN_VECINOS)
+# Cómo se ocultan las matrículas: caja, pixelado, relleno o gaussiano
+anonimizador = Anonimizador(os.environ.get('ANONIMIZADO', 'caja'), fuerza=float(os.environ.get('FUERZA_ANONIMIZADO', 1.0)))
 
 @app.route('/')
 def index():
@@ -38,27 +94,165 @@ def procesar():
 
     file = request.files['imagen']
     metodo = request.form.get("metodo", "haar")
-    input_path = os.path.join(UPLOAD_FOLDER, file.filename)
-    output_path = os.path.join(OUTPUT_FOLDER, file.filename)
-    file.save(input_path)
 
-    if metodo == "yolo":
-        hay_placa = difuminar_matricula_yolo(input_path, output_path)
-    else:
-        hay_placa = difuminar_matricula(input_path, output_path)
+    # Codificar el resultado con el formato de la subida si es uno conocido
+    extension = os.path.splitext(file.filename)[1].lower()
+    if extension not in EXTENSIONES_IMAGEN:
+        extension = '.jpg'
+    # La configuración de la compuerta cambia qué imágenes llegan a YOLO con el método cascada
+    parametros_cascada = {'escala': CASCADA_ESCALA, 'min_vecinos': CASCADA_MIN_VECINOS} if metodo == 'cascada' else {}
+    nombre_cache = clave_contenido(file.stream.hexdigest(), tipo='imagen', metodo=metodo, modelo=VERSION_MODELO,
+                                   anonimizado=anonimizador.metodo, fuerza=anonimizador.fuerza,
+                                   **parametros_cascada) + extension
 
-    if hay_placa:
-        return render_template('resultado.html', imagen_original=file.filename, imagen_procesada=file.filename)
+    original = file.read()
+    path_cache = cache.obtener(nombre_cache)
+    if path_cache is not None:
+        with open(path_cache, 'rb') as f:
+            procesada = f.read()
     else:
+        try:
+            procesada = procesar_imagen_subida(original, metodo, extension)
+        except ServicioSaturado:
+            return 'El servidor está ocupado, inténtalo de nuevo en unos momentos', 503
+        if procesada is None:
+            return 'El archivo no es una imagen válida', 400
+        cache.guardar(nombre_cache, procesada)
+
+    # Un resultado vacío en la caché significa que la imagen no tiene matrículas
+    if not procesada:
         return render_template('no_matricula.html')
 
+    nombre = f"{uuid.uuid4().hex}{extension}"
+    imagenes.guardar(('original', nombre), original)
+    imagenes.guardar(('procesada', nombre), procesada)
+
+    if PERSISTIR_IMAGENES:
+        with open(os.path.join(UPLOAD_FOLDER, nombre), 'wb') as f:
+            f.write(original)
+        with open(os.path.join(OUTPUT_FOLDER, nombre), 'wb') as f:
+            f.write(procesada)
+
+    return render_template('resultado.html', imagen_original=nombre, imagen_procesada=nombre)
+
+def procesar_imagen_subida(original, metodo, extension):
+    """
+    Decodifica una imagen subida, oculta sus matrículas y la vuelve a codificar
+
+    Args:
+        original (bytes): Imagen subida
+        metodo (str): Detector a usar: haar, yolo o cascada
+        extension (str): Formato de la imagen procesada
+
+    Returns:
+        bytes: Imagen procesada; vacía si no tiene matrículas, o None si no es una imagen válida
+
+    Raises:
+        ServicioSaturado: Si el carril prioritario del servicio está lleno o la imagen no se procesa
+            en TIMEOUT_IMAGEN segundos
+    """
+    # Decodificar la subida una sola vez; el mismo array pasa por el detector y se difumina
+    imagen = cv2.imdecode(np.frombuffer(original, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if imagen is None:
+        return None
+
+    if metodo == "yolo":
+        hay_placa = servicio.ejecutar(
+            lambda detector: difuminar_imagen_yolo(imagen, modelo=detector.modelo, anonimizador=anonimizador),
+            timeout=TIMEOUT_IMAGEN
+        )
+    elif metodo == "cascada":
+        hay_placa = servicio.ejecutar(
+            lambda detector: difuminar_imagen_cascada(imagen, modelo=detector.modelo, compuerta=compuerta,
+                                                      anonimizador=anonimizador),
+            timeout=TIMEOUT_IMAGEN
+        )
+    else:
+        hay_placa = difuminar_imagen(imagen, anonimizador=anonimizador)
+
+    return cv2.imencode(extension, imagen)[1].tobytes() if hay_placa else b''
+
+def servir_imagen(tipo, carpeta, nombre):
+    # Primero la caché en memoria; en disco solo están las persistidas o las expulsadas de la caché
+    datos = imagenes.obtener((tipo, nombre))
+    if datos is None:
+        return send_from_directory(carpeta, nombre)
+    return send_file(io.BytesIO(datos), mimetype=mimetypes.guess_type(nombre)[0], download_name=nombre)
+
 @app.route('/procesadas/<nombre>')
 def mostrar_imagen(nombre):
-    return send_from_directory(OUTPUT_FOLDER, nombre)
+    return servir_imagen('procesada', OUTPUT_FOLDER, nombre)
 
 @app.route('/static/uploads/<nombre>')
 def imagen_original(nombre):
-    return send_from_directory(UPLOAD_FOLDER, nombre)
+    return servir_imagen('original', UPLOAD_FOLDER, nombre)
+
+@app.route('/cascada/estadisticas')
+def estadisticas_cascada():
+    # Imágenes del método cascada que pasaron a YOLO frente a las que se lo saltaron
+    return jsonify({**compuerta.estadisticas(), 'escala': CASCADA_ESCALA, 'min_vecinos': CASCADA_MIN_VECINOS})
+
+@app.route('/procesar_lote', methods=['POST'])
+def procesar_lote_post():
+    # Acepta varias imágenes y/o archivos .zip con imágenes en el campo 'imagenes'
+    archivos = request.files.getlist('imagenes')
+    if not archivos:
+        return jsonify({'error': 'No se subió ninguna imagen'}), 400
+
+    entradas = []
+    for archivo in archivos:
+        datos = archivo.read()
+        if archivo.filename.lower().endswith('.zip'):
+            try:
+                entradas.extend(entradas_zip(zipfile.ZipFile(io.BytesIO(datos))))
+            except zipfile.BadZipFile:
+                return jsonify({'error': f'{archivo.filename} no es un archivo zip válido'}), 400
+        elif os.path.splitext(archivo.filename)[1].lower() in EXTENSIONES_IMAGEN:
+            entradas.append((os.path.basename(archivo.filename), lambda datos=datos: datos))
+    if not entradas:
+        return jsonify({'error': 'No se encontró ninguna imagen'}), 400
+
+    purgar_lotes()
+    # El resultado es un zip con las imágenes anonimizadas
+    nombre_lote = f"{uuid.uuid4().hex}.zip"
+    path_lote = os.path.join(LOTE_FOLDER, nombre_lote)
+    # Un lote que ya empezó no se interrumpe al vencer el timeout: se detiene antes de su siguiente lote de imágenes
+    cancelar = threading.Event()
+    def procesar(detector):
+        try:
+            with zipfile.ZipFile(path_lote, 'w') as zip_salida:
+                informe = procesar_lote(entradas, detector.modelo, escritor_zip(zip_salida), anonimizador,
+                                        cancelar=cancelar)
+        except Exception:
+            os.remove(path_lote)
+            raise
+        # Nadie va a descargar el zip de un lote cancelado
+        if cancelar.is_set():
+            os.remove(path_lote)
+        return informe
+
+    try:
+        informe = servicio.ejecutar(procesar, timeout=TIMEOUT_LOTE)
+    except ServicioSaturado:
+        cancelar.set()
+        return jsonify({'error': 'El servidor está ocupado, inténtalo de nuevo en unos momentos'}), 503
+
+    return jsonify({**informe, 'descarga': url_for('descargar_lote', nombre=nombre_lote)})
+
+def purgar_lotes():
+    # Los zips de los lotes se borran pasadas LOTE_HORAS, se hayan descargado o no
+    limite = time.time() - LOTE_HORAS * 3600
+    for nombre in os.listdir(LOTE_FOLDER):
+        path = os.path.join(LOTE_FOLDER, nombre)
+        try:
+            if os.path.getmtime(path) < limite:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+@app.route('/lotes/<nombre>')
+def descargar_lote(nombre):
+    return send_from_directory(LOTE_FOLDER, nombre, as_attachment=True)
 
 @app.route('/video', methods=['GET'])
 def procesar_video():
@@ -76,6 +270,120 @@ def mostrar_video_resultado():
                          video_url=video_url, 
                          nombre_archivo=nombre_archivo)
 
+def procesar_trabajo_video(detector, trabajo, cancelar):
+    """
+    Procesa un trabajo de video de la cola y notifica su progreso solo a la sala del trabajo
+    
+    Args:
+        detector (DetectorVideoYOLO): Detector del worker que ejecuta el trabajo
+        trabajo (dict): Trabajo registrado en la cola
+        cancelar (threading.Event): Evento que se activa al cancelar el trabajo
+    """
+    trabajo_id = trabajo['id']
+    nombre_salida = os.path.basename(trabajo['path_salida'])
+    # El video se escribe con otro nombre y solo entra en la caché cuando está completo
+    path_parcial = os.path.splitext(trabajo['path_salida'])[0] + '.parcial.mp4'
+    
+    # Si ya están las detecciones del mismo video con la misma configuración de detección (por
+    # ejemplo, se cambió solo el anonimizado), se renderiza sin llamar al modelo
+    detecciones = None
+    escritor_detecciones = None
+    nombre_detecciones = trabajo['parametros'].get('detecciones')
+    if nombre_detecciones:
+        path_detecciones = cache.obtener(nombre_detecciones)
+        if path_detecciones is not None:
+            try:
+                detecciones = LectorDetecciones(path_detecciones)
+            except ValueError as e:
+                # Detecciones de otra versión o incompletas: se vuelven a detectar y se reemplazan
+                print(f"Detecciones descartadas: {e}")
+        if detecciones is None and PROCESOS_VIDEO <= 1:
+            cap = cv2.VideoCapture(trabajo['path_entrada'])
+            escritor_detecciones = EscritorDetecciones(
+                os.path.splitext(cache.ruta(nombre_detecciones))[0] + '.parcial.npz',
+                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            cap.release()
+    
+    # Función de callback para el progreso
+    def progress_callback(progress_data):
+        trabajos.actualizar_progreso(trabajo_id, progress_data.get('progress', 0.0), progress_data.get('message'))
+        socketio.emit('progress_update', progress_data, room=trabajo_id)
+        # Entre lotes de frames, las imágenes en espera se procesan con el mismo detector
+        servicio.atender_prioritarios(detector)
+    
+    opciones = {
+        'difuminar': trabajo['parametros']['difuminar'],
+        'confianza': trabajo['parametros'].get('confianza', 0.5),
+        'anonimizador': anonimizador,
+        'detectar_cada': trabajo['parametros'].get('detectar_cada', 1),
+        'umbral_estatico': trabajo['parametros'].get('umbral_estatico', 0.0)
+    }
+    
+    # Procesar el video; si falla, la cola marca el trabajo como error y no se registra nada en la caché
+    try:
+        if PROCESOS_VIDEO > 1 and detecciones is None:
+            # Este worker espera a los procesos y sigue atendiendo las imágenes en el progress_callback
+            procesar_video_paralelo(
+                trabajo['path_entrada'],
+                path_parcial,
+                procesos=PROCESOS_VIDEO,
+                progress_callback=progress_callback,
+                cancelar=cancelar,
+                **opciones
+            )
+        else:
+            # Con las detecciones ya guardadas solo se renderiza, no compensa repartirlo en procesos
+            detector.detectar_matriculas_video(
+                trabajo['path_entrada'], 
+                salida_path=path_parcial, 
+                mostrar_video=False,
+                progress_callback=progress_callback,
+                cancelar=cancelar,
+                escritor_detecciones=escritor_detecciones,
+                detecciones=detecciones,
+                **opciones
+            )
+    except Exception as e:
+        socketio.emit('error', {'message': f'Error al procesar el video: {e}'}, room=trabajo_id)
+        raise
+    
+    if cancelar.is_set():
+        socketio.emit('trabajo_cancelado', {'trabajo_id': trabajo_id}, room=trabajo_id)
+        return
+    
+    os.replace(path_parcial, trabajo['path_salida'])
+    # Los trabajos anteriores a la caché escriben fuera de su directorio
+    if os.path.dirname(trabajo['path_salida']) == CACHE_FOLDER:
+        cache.registrar(nombre_salida)
+    if escritor_detecciones is not None:
+        os.replace(escritor_detecciones.path, cache.ruta(nombre_detecciones))
+        cache.registrar(nombre_detecciones)
+    
+    # Notificar que el video está listo
+    # Usar with app.app_context() para generar la URL correctamente
+    with app.app_context():
+        # Usamos una ruta relativa directa en lugar de url_for para evitar problemas de contexto
+        video_url = os.path.relpath(trabajo['path_salida'], 'static')
+        socketio.emit('video_ready', {
+            'video_url': video_url,
+            'nombre_archivo': nombre_salida
+        }, room=trabajo_id)
+
+# Cola persistente de trabajos de video: sobrevive a los reinicios del servidor
+TRABAJOS_DB = os.environ.get('TRABAJOS_DB', 'trabajos.db')
+trabajos = None
+
+def iniciar_servicios():
+    """
+    Carga los modelos de los servicios de inferencia y reanuda los trabajos que quedaron activos.
+    Importar el módulo no carga nada: se llama una sola vez en el proceso que sirve las peticiones,
+    para que dos procesos no reanuden los mismos trabajos
+    """
+    global servicio, trabajos
+    servicio = ServicioInferencia(num_workers=NUM_WORKERS, max_trabajos=MAX_TRABAJOS)
+    trabajos = ColaTrabajos(servicio, procesar_trabajo_video, db_path=TRABAJOS_DB, max_trabajos=MAX_TRABAJOS)
+    trabajos.reanudar()
+
 @app.route('/procesar_video', methods=['POST'])
 def procesar_video_post():
     video = request.files['video']
@@ -84,49 +392,71 @@ def procesar_video_post():
     if not video:
         return "No se subió ningún video", 400
 
+    # El video procesado se nombra por el contenido subido y los parámetros que cambian el resultado
+    parametros = {'difuminar': difuminar, 'confianza': CONFIANZA_VIDEO, 'detectar_cada': DETECTAR_CADA,
+                  'umbral_estatico': UMBRAL_ESTATICO}
+    nombre_salida = clave_contenido(video.stream.hexdigest(), tipo='video', modelo=VERSION_MODELO,
+                                    anonimizado=anonimizador.metodo, fuerza=anonimizador.fuerza, **parametros) + '.mp4'
+    path_salida = cache.ruta(nombre_salida)
+    # Las detecciones solo dependen de los parámetros de detección, no de cómo se ocultan las matrículas
+    parametros['detecciones'] = clave_contenido(video.stream.hexdigest(), tipo='detecciones', modelo=VERSION_MODELO,
+                                                confianza=CONFIANZA_VIDEO, detectar_cada=DETECTAR_CADA,
+                                                umbral_estatico=UMBRAL_ESTATICO) + '.npz'
+
+    # Mismo video ya procesado: se devuelve sin volver a inferirlo
+    if cache.obtener(nombre_salida) is not None:
+        return redirect(url_for('mostrar_video_resultado', video_url=os.path.relpath(path_salida, 'static'),
+                                nombre_archivo=nombre_salida))
+    # Mismo video en proceso: se sigue el trabajo que ya existe
+    trabajo_id = trabajos.buscar_activo(path_salida)
+    if trabajo_id is not None:
+        return render_template("video_procesando.html", trabajo_id=trabajo_id)
+
     # Guardar video subido
-    nombre_video = f"{uuid.uuid4()}.mp4"
-    path_entrada = os.path.join(VIDEO_UPLOAD_FOLDER, nombre_video)
+    path_entrada = os.path.join(VIDEO_UPLOAD_FOLDER, f"{uuid.uuid4()}.mp4")
     video.save(path_entrada)
 
-    # Iniciar procesamiento en segundo plano
-    from threading import Thread
-    
-    def process_video():
-        # Crear el nombre del archivo de salida antes de entrar al contexto de la aplicación
-        nombre_salida = f"procesado_{nombre_video}"
-        path_salida = os.path.join(VIDEO_OUTPUT_FOLDER, nombre_salida)
-        
-        # Función de callback para el progreso
-        def progress_callback(progress_data):
-            socketio.emit('progress_update', progress_data)
-        
-        # Procesar el video
-        detector = DetectorVideoYOLO()
-        detector.detectar_matriculas_video(
-            path_entrada, 
-            salida_path=path_salida, 
-            difuminar=difuminar, 
-            mostrar_video=False,
-            progress_callback=progress_callback
-        )
-        
-        # Notificar que el video está listo
-        # Usar with app.app_context() para generar la URL correctamente
-        with app.app_context():
-            # Usamos una ruta relativa directa en lugar de url_for para evitar problemas de contexto
-            video_url = f"procesadas/videos/{nombre_salida}"
-            socketio.emit('video_ready', {
-                'video_url': video_url,
-                'nombre_archivo': nombre_salida
-            })
-    
-    # Iniciar el procesamiento en un hilo separado
-    thread = Thread(target=process_video)
-    thread.start()
+    # Registrar el trabajo en la cola; se procesa en segundo plano con el detector de un worker
+    try:
+        trabajo_id = trabajos.crear(path_entrada, path_salida, **parametros)
+    except ServicioSaturado:
+        os.remove(path_entrada)
+        return "El servidor está ocupado, inténtalo de nuevo en unos momentos", 503
     
-    # Devolver la plantilla con el ID de sesión
-    return render_template("video_procesando.html")
+    # Devolver la plantilla con el ID del trabajo para seguir su progreso
+    return render_template("video_procesando.html", trabajo_id=trabajo_id)
+
+@app.route('/jobs/<trabajo_id>', methods=['GET'])
+def estado_trabajo(trabajo_id):
+    trabajo = trabajos.obtener(trabajo_id)
+    if trabajo is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(trabajo)
+
+@app.route('/jobs/<trabajo_id>/cancelar', methods=['POST'])
+def cancelar_trabajo(trabajo_id):
+    if trabajos.obtener(trabajo_id) is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    if not trabajos.cancelar(trabajo_id):
+        return jsonify({'error': 'El trabajo ya terminó'}), 409
+    trabajo = trabajos.obtener(trabajo_id)
+    # Un trabajo en espera se cancela al momento; uno en curso avisa cuando se detiene
+    if trabajo['estado'] == 'cancelado':
+        socketio.emit('trabajo_cancelado', {'trabajo_id': trabajo_id}, room=trabajo_id)
+    return jsonify(trabajo)
+
+@socketio.on('unirse_trabajo')
+def unirse_trabajo(data):
+    # Cada cliente solo recibe los eventos del trabajo que envió
+    trabajo_id = data.get('trabajo_id')
+    trabajo = trabajos.obtener(trabajo_id)
+    if trabajo is None:
+        emit('error', {'message': 'Trabajo no encontrado'})
+        return
+    join_room(trabajo_id)
+    emit('progress_update', {'progress': trabajo['progreso'], 'status': trabajo['estado'], 'message': trabajo['mensaje']})
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
\ No newline at end of file
+    iniciar_servicios()
+    # Sin el recargador: su proceso hijo volvería a cargar los modelos y a reanudar los mismos trabajos
+    socketio.run(app, debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,54 @@
+import argparse
+import time
+
+import numpy as np
+
+from anonimizador import Anonimizador, METODOS
+
+
+def medir(anonimizador, frame, caja, repeticiones):
+    """
+    Returns:
+        tuple: Milisegundos por llamada y desviación típica de la caja anonimizada; cuanto menor,
+            menos detalle queda de la matrícula
+    """
+    tiempos = []
+    for _ in range(repeticiones):
+        copia = frame.copy()
+        inicio = time.perf_counter()
+        anonimizador(copia, caja)
+        tiempos.append(time.perf_counter() - inicio)
+    x1, y1, x2, y2 = caja[0]
+    return np.median(tiempos) * 1000, copia[y1:y2, x1:x2].astype(np.float32).std()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mide el coste de cada método de anonimizado con una caja en un frame')
+    parser.add_argument('--ancho', type=int, default=1920, help='Ancho del frame (default: 1920)')
+    parser.add_argument('--alto', type=int, default=1080, help='Alto del frame (default: 1080)')
+    parser.add_argument('--cajas', type=str, nargs='+', default=['120x40', '600x200', '1500x500'],
+                        help='Tamaños de caja a medir, ANCHOxALTO (default: 120x40 600x200 1500x500)')
+    parser.add_argument('--metodos', type=str, nargs='+', default=list(METODOS), choices=METODOS,
+                        help='Métodos a medir (default: todos)')
+    parser.add_argument('--fuerza', type=float, default=1.0, help='Intensidad del anonimizado (default: 1.0)')
+    parser.add_argument('--repeticiones', type=int, default=5,
+                        help='Llamadas por método y caja; se informa la mediana (default: 5)')
+
+    args = parser.parse_args()
+
+    # Ruido aleatorio: el peor caso para ocultar detalle y el mismo frame para todos los métodos
+    frame = np.random.default_rng(0).integers(0, 256, (args.alto, args.ancho, 3), dtype=np.uint8)
+    print(f"Frame de {args.ancho}x{args.alto}, fuerza {args.fuerza}, mediana de {args.repeticiones} llamadas")
+    print(f"{'caja':>10s} {'método':>10s} {'ms':>10s} {'std':>7s}")
+    for tamano in args.cajas:
+        w, h = (int(v) for v in tamano.split('x'))
+        if w + 10 > args.ancho or h + 10 > args.alto:
+            parser.error(f"La caja {tamano} no cabe en el frame")
+        caja = np.array([[10, 10, 10 + w, 10 + h]])
+        for metodo in args.metodos:
+            milisegundos, desviacion = medir(Anonimizador(metodo, fuerza=args.fuerza), frame, caja, args.repeticiones)
+            print(f"{tamano:>10s} {metodo:>10s} {milisegundos:10.2f} {desviacion:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from detector_video_yolo import DetectorVideoYOLO
+
+
+class ResultadoSimulado:
+    def __init__(self, cajas):
+        # Misma interfaz que un resultado de ultralytics: boxes.xyxy, boxes.conf y len(boxes)
+        self.boxes = self
+        self.xyxy = torch.tensor(cajas, dtype=torch.float32).reshape(-1, 4)
+        self.conf = torch.full((len(cajas),), 0.9)
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class ModeloSimulado:
+    def __init__(self, coste_ms):
+        """
+        Sustituto del modelo YOLO con un coste fijo por frame: el benchmark mide cuántas llamadas
+        al modelo se ahorran, no la velocidad de un modelo concreto
+
+        Args:
+            coste_ms (float): Milisegundos de cálculo por frame
+        """
+        self.coste = coste_ms / 1000
+        self.frames = 0
+
+    def __call__(self, frames, **kwargs):
+        resultados = []
+        for frame in frames:
+            inicio = time.perf_counter()
+            while time.perf_counter() - inicio < self.coste:
+                pass
+            # La "matrícula" es el rectángulo blanco del clip sintético
+            ys, xs = np.where(frame[:, :, 0] > 200)
+            cajas = [[xs.min(), ys.min(), xs.max(), ys.max()]] if len(xs) else []
+            resultados.append(ResultadoSimulado(cajas))
+            self.frames += 1
+        return resultados
+
+
+def generar_clip(path, num_frames, width, height, mover_cada, ruido):
+    """
+    Escribe un clip casi estático: un fondo fijo con ruido de sensor y una matrícula que solo se
+    desplaza cada mover_cada frames, como una cámara fija con poco tráfico
+
+    Args:
+        path (str): Ruta del video .avi
+        num_frames (int): Frames del clip
+        width (int): Ancho de los frames
+        height (int): Alto de los frames
+        mover_cada (int): Frames entre dos desplazamientos de la matrícula
+        ruido (float): Desviación típica del ruido de cada frame, en niveles de gris
+    """
+    rng = np.random.default_rng(0)
+    fondo = rng.integers(40, 160, (height, width, 3), dtype=np.uint8)
+    escritor = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (width, height))
+    for i in range(num_frames):
+        frame = np.clip(fondo + rng.normal(0, ruido, fondo.shape), 0, 255).astype(np.uint8)
+        x = (20 + (i // mover_cada) * 8) % (width - 120)
+        cv2.rectangle(frame, (x, height // 2), (x + 100, height // 2 + 25), (255, 255, 255), -1)
+        escritor.write(frame)
+    escritor.release()
+
+
+def medir(video_path, coste_ms, batch_size, umbral_estatico):
+    """
+    Returns:
+        tuple: Frames por segundo, frames que pasaron por el modelo y frames omitidos por estáticos
+    """
+    # Sin archivo de modelo: el detector recibe directamente el modelo simulado
+    detector = DetectorVideoYOLO.__new__(DetectorVideoYOLO)
+    detector.modelo = ModeloSimulado(coste_ms)
+    resumen = {}
+    inicio = time.perf_counter()
+    detector.detectar_matriculas_video(video_path, mostrar_video=False, batch_size=batch_size,
+                                       umbral_estatico=umbral_estatico, progress_callback=resumen.update)
+    segundos = time.perf_counter() - inicio
+    return resumen['current_frame'] / segundos, detector.modelo.frames, resumen['frames_omitidos']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mide el filtro de frames estáticos en un clip sintético casi estático')
+    parser.add_argument('--frames', type=int, default=300, help='Frames del clip (default: 300)')
+    parser.add_argument('--ancho', type=int, default=640, help='Ancho del clip (default: 640)')
+    parser.add_argument('--alto', type=int, default=360, help='Alto del clip (default: 360)')
+    parser.add_argument('--mover-cada', type=int, default=25,
+                        help='Frames entre dos desplazamientos de la matrícula (default: 25)')
+    parser.add_argument('--ruido', type=float, default=1.0, help='Ruido de sensor en niveles de gris (default: 1.0)')
+    parser.add_argument('--coste-ms', type=float, default=20.0,
+                        help='Milisegundos por frame del modelo simulado (default: 20)')
+    parser.add_argument('--batch', type=int, default=8, help='Frames por llamada al modelo (default: 8)')
+    parser.add_argument('--umbral-estatico', type=float, default=3.0,
+                        help='Umbral del filtro de frames estáticos a comparar con 0 (default: 3.0)')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        video_path = os.path.join(carpeta, 'estatico.avi')
+        generar_clip(video_path, args.frames, args.ancho, args.alto, args.mover_cada, args.ruido)
+
+        resultados = {umbral: medir(video_path, args.coste_ms, args.batch, umbral)
+                      for umbral in (0.0, args.umbral_estatico)}
+
+    print(f"Clip de {args.frames} frames {args.ancho}x{args.alto}, matrícula movida cada {args.mover_cada} frames, "
+          f"modelo simulado de {args.coste_ms:.0f} ms/frame")
+    base = resultados[0.0][0]
+    for umbral, (fps, llamadas, omitidos) in resultados.items():
+        print(f"umbral_estatico={umbral:<4} {fps:7.1f} frames/s  {llamadas:4d} frames al modelo  "
+              f"{omitidos:4d} omitidos  {fps / base:4.1f}x")
+
+
+if __name__ == "__main__":
+    main()
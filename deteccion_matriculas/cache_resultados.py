@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Request
+
+
+class CacheLRU:
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """
+        Caché en memoria de resultados codificados con expulsión LRU y un tope de tamaño total
+
+        Args:
+            max_bytes (int): Tamaño máximo de la suma de los valores guardados
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entradas = OrderedDict()
+        # Las peticiones de Flask y los workers comparten la caché
+        self.lock = threading.Lock()
+
+    def obtener(self, clave):
+        """
+        Args:
+            clave: Clave del resultado
+
+        Returns:
+            bytes: El resultado, o None si no está o ya se expulsó
+        """
+        with self.lock:
+            datos = self.entradas.get(clave)
+            if datos is not None:
+                self.entradas.move_to_end(clave)
+            return datos
+
+    def guardar(self, clave, datos):
+        """
+        Guarda un resultado y expulsa los menos usados recientemente hasta volver al tope.
+        El último resultado guardado se conserva aunque supere el tope por sí solo
+
+        Args:
+            clave: Clave del resultado
+            datos (bytes): Resultado codificado
+        """
+        with self.lock:
+            if clave in self.entradas:
+                self.bytes -= len(self.entradas.pop(clave))
+            self.entradas[clave] = datos
+            self.bytes += len(datos)
+            while self.bytes > self.max_bytes and len(self.entradas) > 1:
+                _, expulsado = self.entradas.popitem(last=False)
+                self.bytes -= len(expulsado)
+
+
+def huella_archivo(ruta, bloque=1024 * 1024):
+    """
+    Args:
+        ruta (str): Ruta del archivo
+        bloque (int): Tamaño de los bloques leídos
+
+    Returns:
+        str: SHA-256 del contenido del archivo en hexadecimal
+    """
+    huella = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for datos in iter(lambda: f.read(bloque), b''):
+            huella.update(datos)
+    return huella.hexdigest()
+
+
+def clave_contenido(huella, **parametros):
+    """
+    Clave de caché de un resultado: el contenido subido más los parámetros que cambian el resultado
+
+    Args:
+        huella (str): SHA-256 del archivo subido
+        **parametros: Parámetros del procesamiento, serializables a JSON
+
+    Returns:
+        str: SHA-256 en hexadecimal
+    """
+    return hashlib.sha256((huella + json.dumps(parametros, sort_keys=True)).encode()).hexdigest()
+
+
+def es_parcial(nombre):
+    # Resultados a medio escribir: nunca se sirven desde la caché
+    return nombre.endswith('.tmp') or '.parcial' in nombre
+
+
+class ArchivoConHash:
+    def __init__(self, archivo):
+        """
+        Envuelve el archivo en el que Werkzeug escribe una subida y calcula su SHA-256 a
+        medida que llegan los datos, sin una segunda lectura
+
+        Args:
+            archivo: Archivo temporal de Werkzeug
+        """
+        self.archivo = archivo
+        self.huella = hashlib.sha256()
+
+    def write(self, datos):
+        self.huella.update(datos)
+        return self.archivo.write(datos)
+
+    def hexdigest(self):
+        return self.huella.hexdigest()
+
+    def __getattr__(self, nombre):
+        return getattr(self.archivo, nombre)
+
+    def __iter__(self):
+        return iter(self.archivo)
+
+
+class PeticionConHash(Request):
+    # Cada archivo subido expone su hash en request.files[...].stream.hexdigest()
+    def _get_file_stream(self, *args, **kwargs):
+        return ArchivoConHash(super()._get_file_stream(*args, **kwargs))
+
+
+class CacheContenido:
+    def __init__(self, directorio, max_bytes=10 * 1024 * 1024 * 1024):
+        """
+        Caché en disco de resultados direccionados por contenido, con expulsión LRU bajo un
+        presupuesto de disco. Sobrevive a los reinicios: al arrancar registra los archivos que
+        ya hay en el directorio por orden de último uso
+
+        Args:
+            directorio (str): Directorio donde viven los resultados
+            max_bytes (int): Presupuesto de disco de la caché
+        """
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+
+        # Solo se pueden expulsar los resultados registrados, nunca uno que se está escribiendo
+        self.entradas = OrderedDict()
+        self.bytes = 0
+        existentes = [entrada for entrada in os.scandir(directorio)
+                      if entrada.is_file() and not es_parcial(entrada.name)]
+        for entrada in sorted(existentes, key=lambda entrada: entrada.stat().st_mtime):
+            self.entradas[entrada.name] = entrada.stat().st_size
+            self.bytes += entrada.stat().st_size
+
+    def ruta(self, nombre):
+        return os.path.join(self.directorio, nombre)
+
+    def obtener(self, nombre):
+        """
+        Args:
+            nombre (str): Clave del resultado seguida de su extensión
+
+        Returns:
+            str: Ruta del resultado, o None si no está en la caché
+        """
+        with self.lock:
+            if nombre not in self.entradas:
+                return None
+            self.entradas.move_to_end(nombre)
+            # La fecha de modificación guarda el orden LRU entre reinicios
+            os.utime(self.ruta(nombre))
+            return self.ruta(nombre)
+
+    def registrar(self, nombre):
+        """
+        Añade a la caché un resultado ya escrito en ruta(nombre) y expulsa los menos usados
+        recientemente hasta volver al presupuesto
+
+        Args:
+            nombre (str): Clave del resultado seguida de su extensión
+        """
+        with self.lock:
+            if nombre in self.entradas:
+                self.bytes -= self.entradas.pop(nombre)
+            self.entradas[nombre] = os.path.getsize(self.ruta(nombre))
+            self.bytes += self.entradas[nombre]
+            while self.bytes > self.max_bytes and len(self.entradas) > 1:
+                expulsado, tamano = self.entradas.popitem(last=False)
+                self.bytes -= tamano
+                try:
+                    os.remove(self.ruta(expulsado))
+                except FileNotFoundError:
+                    pass
+
+    def guardar(self, nombre, datos):
+        """
+        Escribe y registra un resultado. Un resultado vacío también se guarda: indica que el
+        procesamiento no encontró nada que ocultar
+
+        Args:
+            nombre (str): Clave del resultado seguida de su extensión
+            datos (bytes): Resultado codificado
+        """
+        temporal = self.ruta(nombre) + '.tmp'
+        with open(temporal, 'wb') as f:
+            f.write(datos)
+        os.replace(temporal, self.ruta(nombre))
+        self.registrar(nombre)
@@ -0,0 +1,153 @@
+import threading
+
+import cv2
+import numpy as np
+
+from detector import detector_placas
+from detector_yolo import difuminar_imagen_yolo
+from seguimiento import miniatura
+
+
+class CompuertaCascada:
+    def __init__(self, escala=0.5, min_vecinos=2, periodo_maximo=30, umbral_movimiento=12.0):
+        """
+        Primera etapa barata de la cascada: decide si un frame necesita el modelo YOLO. YOLO corre
+        cuando el clasificador Haar ve una posible matrícula en el frame reducido, cuando hay
+        movimiento desde la última llamada a YOLO o cuando pasan periodo_maximo frames sin llamarlo
+
+        Args:
+            escala (float): Factor de reducción del frame antes de pasar el clasificador Haar
+            min_vecinos (int): minNeighbors del clasificador Haar. Valores bajos hacen que dispare más
+                y priorizan no perder matrículas frente a saltar YOLO
+            periodo_maximo (int): Máximo de frames seguidos sin YOLO; es el límite de seguridad para
+                las matrículas que la primera etapa no vea. 1 ejecuta YOLO en todos los frames
+            umbral_movimiento (float): Diferencia máxima de gris entre miniaturas con el último frame
+                que pasó por YOLO a partir de la cual se considera que hubo movimiento
+        """
+        if periodo_maximo < 1:
+            raise ValueError(f"periodo_maximo debe ser al menos 1: {periodo_maximo}")
+
+        self.escala = escala
+        self.min_vecinos = min_vecinos
+        self.periodo_maximo = periodo_maximo
+        self.umbral_movimiento = umbral_movimiento
+        self.miniatura_yolo = None
+        self.desde_yolo = 0
+        self.disparos = {'haar': 0, 'movimiento': 0, 'periodo': 0}
+        self.frames_saltados = 0
+        # Motivo por el que el último frame que pasó por decidir fue a YOLO, o None si se saltó
+        self.ultimo_motivo = None
+        # Los contadores se comparten entre los workers cuando la compuerta filtra imágenes sueltas
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # El lock no se puede serializar: el procesamiento en paralelo envía la compuerta a cada proceso
+        estado = self.__dict__.copy()
+        del estado['lock']
+        return estado
+
+    def __setstate__(self, estado):
+        self.__dict__.update(estado)
+        self.lock = threading.Lock()
+
+    def haar_dispara(self, frame):
+        """
+        Args:
+            frame (np.ndarray): Frame BGR
+
+        Returns:
+            bool: Si el clasificador Haar encuentra alguna posible matrícula en el frame reducido
+        """
+        gris = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.escala != 1:
+            gris = cv2.resize(gris, None, fx=self.escala, fy=self.escala, interpolation=cv2.INTER_AREA)
+        placas = detector_placas.detectMultiScale(gris, scaleFactor=1.1, minNeighbors=self.min_vecinos)
+        return len(placas) > 0
+
+    def decidir(self, frame):
+        """
+        Decide si un frame de video pasa a YOLO. Las comprobaciones van de la más barata a la más cara
+
+        Args:
+            frame (np.ndarray): Frame BGR
+
+        Returns:
+            bool: True si hay que ejecutar YOLO; si es False, siguen valiendo las detecciones de la
+                última llamada a YOLO
+        """
+        actual = miniatura(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+        if self.miniatura_yolo is None or self.desde_yolo + 1 >= self.periodo_maximo:
+            motivo = 'periodo'
+        elif np.abs(actual - self.miniatura_yolo).max() > self.umbral_movimiento:
+            motivo = 'movimiento'
+        elif self.haar_dispara(frame):
+            motivo = 'haar'
+        else:
+            self.desde_yolo += 1
+            self.frames_saltados += 1
+            self.ultimo_motivo = None
+            return False
+
+        self.disparos[motivo] += 1
+        self.ultimo_motivo = motivo
+        self.miniatura_yolo = actual
+        self.desde_yolo = 0
+        return True
+
+    def estadisticas(self):
+        """
+        Returns:
+            dict: Frames que pasaron por YOLO según el motivo y frames en los que se saltó
+        """
+        return {
+            'frames_yolo_haar': self.disparos['haar'],
+            'frames_yolo_movimiento': self.disparos['movimiento'],
+            'frames_yolo_periodo': self.disparos['periodo'],
+            'frames_sin_yolo': self.frames_saltados
+        }
+
+
+def difuminar_imagen_cascada(imagen, modelo=None, compuerta=None, anonimizador=None):
+    """
+    Difumina las matrículas de una imagen llamando a YOLO solo si el clasificador Haar ve alguna
+    posible matrícula. Todas las regiones difuminadas las confirma YOLO
+
+    Args:
+        imagen (np.ndarray): Imagen BGR que se modifica en el sitio
+        modelo: Modelo YOLO a usar; si es None, el modelo por defecto
+        compuerta (CompuertaCascada): Primera etapa; si es None, una con los valores por defecto.
+            Se puede compartir entre hilos para acumular sus estadísticas
+        anonimizador (Anonimizador): Cómo ocultar las matrículas; si es None, el de por defecto
+
+    Returns:
+        bool: Si se encontró alguna matrícula
+    """
+    if compuerta is None:
+        compuerta = CompuertaCascada()
+    dispara = compuerta.haar_dispara(imagen)
+    with compuerta.lock:
+        if dispara:
+            compuerta.disparos['haar'] += 1
+        else:
+            compuerta.frames_saltados += 1
+    if not dispara:
+        return False
+    return difuminar_imagen_yolo(imagen, modelo=modelo, anonimizador=anonimizador)
+
+
+def difuminar_matricula_cascada(imagen_path, salida_path, modelo=None, compuerta=None, anonimizador=None):
+    """
+    Versión de difuminar_imagen_cascada que lee y escribe la imagen en disco
+
+    Args:
+        imagen_path (str): Ruta de la imagen de entrada
+        salida_path (str): Ruta de la imagen procesada
+
+    Returns:
+        bool: Si se encontró alguna matrícula
+    """
+    imagen = cv2.imread(imagen_path)
+    hay_placa = difuminar_imagen_cascada(imagen, modelo=modelo, compuerta=compuerta, anonimizador=anonimizador)
+    cv2.imwrite(salida_path, imagen)
+    return hay_placa
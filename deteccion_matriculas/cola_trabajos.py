@@ -0,0 +1,220 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from servicio_inferencia import ServicioSaturado
+
+# Estados de un trabajo; los activos ocupan un hueco de la cola hasta que terminan
+EN_COLA = 'en_cola'
+PROCESANDO = 'procesando'
+COMPLETADO = 'completado'
+CANCELADO = 'cancelado'
+ERROR = 'error'
+ESTADOS_ACTIVOS = (EN_COLA, PROCESANDO)
+
+
+class ColaTrabajos:
+    def __init__(self, servicio, ejecutar, db_path='trabajos.db', max_trabajos=8):
+        """
+        Cola persistente de trabajos de video respaldada por SQLite. Cada trabajo tiene un ID,
+        un estado consultable y se puede cancelar mientras espera o mientras se procesa
+
+        Args:
+            servicio (ServicioInferencia): Servicio cuyos workers ejecutan los trabajos
+            ejecutar (callable): Función ejecutar(detector, trabajo, cancelar) que procesa un
+                trabajo; recibe el detector del worker, el trabajo como diccionario y un
+                threading.Event que se activa al cancelarlo
+            db_path (str): Ruta de la base de datos SQLite con el estado de los trabajos
+            max_trabajos (int): Máximo de trabajos activos antes de rechazar los nuevos
+        """
+        self.servicio = servicio
+        self.ejecutar = ejecutar
+        self.db_path = db_path
+        self.max_trabajos = max_trabajos
+        self.lock = threading.Lock()
+        # Eventos de cancelación de los trabajos activos en este proceso
+        self.cancelaciones = {}
+
+        with self._conectar() as conexion:
+            conexion.execute("""
+                CREATE TABLE IF NOT EXISTS trabajos (
+                    id TEXT PRIMARY KEY,
+                    estado TEXT NOT NULL,
+                    progreso REAL NOT NULL DEFAULT 0,
+                    mensaje TEXT,
+                    path_entrada TEXT NOT NULL,
+                    path_salida TEXT NOT NULL,
+                    parametros TEXT NOT NULL,
+                    creado REAL NOT NULL,
+                    actualizado REAL NOT NULL
+                )
+            """)
+
+    def _conectar(self):
+        # Una conexión por operación: los workers y las peticiones HTTP corren en hilos distintos
+        conexion = sqlite3.connect(self.db_path, timeout=30)
+        conexion.row_factory = sqlite3.Row
+        return closing(conexion)
+
+    def _actualizar(self, trabajo_id, **campos):
+        campos['actualizado'] = time.time()
+        asignaciones = ', '.join(f"{campo} = ?" for campo in campos)
+        with self._conectar() as conexion, conexion:
+            conexion.execute(f"UPDATE trabajos SET {asignaciones} WHERE id = ?",
+                             (*campos.values(), trabajo_id))
+
+    def _encolar(self, trabajo_id):
+        self.cancelaciones[trabajo_id] = threading.Event()
+        try:
+            self.servicio.enviar(self._ejecutar, trabajo_id)
+        except ServicioSaturado:
+            del self.cancelaciones[trabajo_id]
+            raise
+
+    def _ejecutar(self, detector, trabajo_id):
+        cancelar = self.cancelaciones[trabajo_id]
+        try:
+            # Un trabajo cancelado mientras esperaba no llega a abrir el video
+            with self.lock:
+                if cancelar.is_set():
+                    return
+                self._actualizar(trabajo_id, estado=PROCESANDO)
+
+            self.ejecutar(detector, self.obtener(trabajo_id), cancelar)
+
+            if cancelar.is_set():
+                self._actualizar(trabajo_id, estado=CANCELADO, mensaje='Cancelado por el usuario')
+            else:
+                self._actualizar(trabajo_id, estado=COMPLETADO, progreso=100.0)
+        except Exception as e:
+            self._actualizar(trabajo_id, estado=ERROR, mensaje=str(e))
+            raise
+        finally:
+            del self.cancelaciones[trabajo_id]
+
+    def crear(self, path_entrada, path_salida, **parametros):
+        """
+        Registra un trabajo y lo encola en el servicio de inferencia
+
+        Args:
+            path_entrada (str): Ruta del video a procesar
+            path_salida (str): Ruta del video procesado
+            **parametros: Parámetros del procesamiento, deben ser serializables a JSON
+
+        Returns:
+            str: ID del trabajo
+
+        Raises:
+            ServicioSaturado: Si ya hay max_trabajos activos o la cola del servicio está llena
+        """
+        trabajo_id = str(uuid.uuid4())
+        ahora = time.time()
+        with self.lock:
+            with self._conectar() as conexion, conexion:
+                activos = conexion.execute(
+                    f"SELECT COUNT(*) FROM trabajos WHERE estado IN ({', '.join('?' * len(ESTADOS_ACTIVOS))})",
+                    ESTADOS_ACTIVOS).fetchone()[0]
+                if activos >= self.max_trabajos:
+                    raise ServicioSaturado(f"Hay {activos} trabajos activos")
+                conexion.execute(
+                    "INSERT INTO trabajos (id, estado, path_entrada, path_salida, parametros, creado, actualizado) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (trabajo_id, EN_COLA, path_entrada, path_salida, json.dumps(parametros), ahora, ahora))
+            try:
+                self._encolar(trabajo_id)
+            except ServicioSaturado:
+                with self._conectar() as conexion, conexion:
+                    conexion.execute("DELETE FROM trabajos WHERE id = ?", (trabajo_id,))
+                raise
+        return trabajo_id
+
+    def obtener(self, trabajo_id):
+        """
+        Devuelve el estado de un trabajo
+
+        Args:
+            trabajo_id (str): ID del trabajo
+
+        Returns:
+            dict: Campos del trabajo con los parámetros ya decodificados, o None si no existe
+        """
+        with self._conectar() as conexion:
+            fila = conexion.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+        if fila is None:
+            return None
+        trabajo = dict(fila)
+        trabajo['parametros'] = json.loads(trabajo['parametros'])
+        return trabajo
+
+    def buscar_activo(self, path_salida):
+        """
+        Busca un trabajo en espera o en curso que ya escribe en una salida
+
+        Args:
+            path_salida (str): Ruta del video de salida
+
+        Returns:
+            str: ID del trabajo, o None si ninguno activo escribe en esa ruta
+        """
+        with self._conectar() as conexion:
+            fila = conexion.execute(
+                f"SELECT id FROM trabajos WHERE path_salida = ? AND estado IN ({', '.join('?' * len(ESTADOS_ACTIVOS))}) "
+                "ORDER BY creado", (path_salida, *ESTADOS_ACTIVOS)).fetchone()
+        return None if fila is None else fila['id']
+
+    def actualizar_progreso(self, trabajo_id, progreso, mensaje=None):
+        """
+        Guarda el progreso de un trabajo en curso
+
+        Args:
+            trabajo_id (str): ID del trabajo
+            progreso (float): Porcentaje procesado
+            mensaje (str): Mensaje de estado (opcional)
+        """
+        self._actualizar(trabajo_id, progreso=progreso, mensaje=mensaje)
+
+    def cancelar(self, trabajo_id):
+        """
+        Cancela un trabajo en espera o en curso. Uno en curso se detiene antes del siguiente lote de frames
+
+        Args:
+            trabajo_id (str): ID del trabajo
+
+        Returns:
+            bool: True si el trabajo estaba activo y se canceló
+        """
+        with self.lock:
+            trabajo = self.obtener(trabajo_id)
+            if trabajo is None or trabajo['estado'] not in ESTADOS_ACTIVOS:
+                return False
+            if trabajo_id in self.cancelaciones:
+                self.cancelaciones[trabajo_id].set()
+            if trabajo['estado'] == EN_COLA:
+                self._actualizar(trabajo_id, estado=CANCELADO, mensaje='Cancelado por el usuario')
+        return True
+
+    def reanudar(self):
+        """
+        Vuelve a encolar los trabajos que quedaron activos cuando se detuvo el servidor.
+        Los que no caben en la cola del servicio se marcan como error
+
+        Returns:
+            int: Número de trabajos reanudados
+        """
+        with self._conectar() as conexion:
+            pendientes = [fila['id'] for fila in conexion.execute(
+                f"SELECT id FROM trabajos WHERE estado IN ({', '.join('?' * len(ESTADOS_ACTIVOS))}) ORDER BY creado",
+                ESTADOS_ACTIVOS)]
+
+        reanudados = 0
+        for trabajo_id in pendientes:
+            self._actualizar(trabajo_id, estado=EN_COLA, progreso=0.0)
+            try:
+                self._encolar(trabajo_id)
+                reanudados += 1
+            except ServicioSaturado:
+                self._actualizar(trabajo_id, estado=ERROR, mensaje='No se pudo reanudar: servicio saturado')
+        return reanudados
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+
+# La versión 2 añade el total de frames y la marca de archivo completo
+VERSION_FORMATO = 2
+
+
+class EscritorDetecciones:
+    def __init__(self, path, width, height):
+        """
+        Guarda las detecciones de un video en un archivo .npz por columnas: frame, caja,
+        confianza y clase de cada detección, más un índice de desplazamientos por frame. Las
+        detecciones se acumulan en memoria y se escriben una sola vez al cerrar con guardar():
+        un archivo a medias no sirve para renderizar, así que volcados intermedios solo
+        reescribirían lo mismo cada vez
+
+        Args:
+            path (str): Ruta del archivo .npz
+            width (int): Ancho de los frames del video
+            height (int): Alto de los frames del video
+        """
+        self.path = path
+        self.width = width
+        self.height = height
+        self.cajas = []
+        self.confianzas = []
+        self.clases = []
+        # desplazamientos[i]:desplazamientos[i + 1] son las filas del frame i
+        self.desplazamientos = [0]
+
+    def agregar(self, cajas, confianzas, clases=None):
+        """
+        Añade las detecciones del siguiente frame; un frame sin matrículas también se añade
+
+        Args:
+            cajas (np.ndarray): Cajas (N, 4) en formato x1, y1, x2, y2
+            confianzas (np.ndarray): Confianzas (N,)
+            clases (np.ndarray): Clases (N,); si es None, todas son la clase 0 (matrícula)
+        """
+        cajas = np.asarray(cajas, dtype=np.float32).reshape(-1, 4)
+        self.cajas.append(cajas)
+        self.confianzas.append(np.asarray(confianzas, dtype=np.float32).reshape(-1))
+        self.clases.append(np.zeros(len(cajas), dtype=np.int16) if clases is None
+                           else np.asarray(clases, dtype=np.int16).reshape(-1))
+        self.desplazamientos.append(self.desplazamientos[-1] + len(cajas))
+
+    def guardar(self, completo=False):
+        """
+        Escribe en el disco las detecciones añadidas; se llama una vez, al terminar el video
+
+        Args:
+            completo (bool): Si ya están todos los frames del video. Solo un archivo completo se
+                puede usar para renderizar
+        """
+        # Se escribe a un temporal y se reemplaza: el archivo nunca queda a medias
+        desplazamientos = np.array(self.desplazamientos, dtype=np.int64)
+        frames = np.repeat(np.arange(len(desplazamientos) - 1, dtype=np.int32), np.diff(desplazamientos))
+        temporal = self.path + '.tmp'
+        with open(temporal, 'wb') as f:
+            np.savez(f,
+                     version=np.int32(VERSION_FORMATO),
+                     tamano=np.array((self.width, self.height), dtype=np.int32),
+                     total_frames=np.int64(len(desplazamientos) - 1),
+                     completo=np.bool_(completo),
+                     frames=frames,
+                     cajas=np.concatenate(self.cajas) if self.cajas else np.zeros((0, 4), dtype=np.float32),
+                     confianzas=np.concatenate(self.confianzas) if self.confianzas else np.zeros(0, dtype=np.float32),
+                     clases=np.concatenate(self.clases) if self.clases else np.zeros(0, dtype=np.int16),
+                     desplazamientos=desplazamientos)
+        os.replace(temporal, self.path)
+
+    def descartar(self):
+        for path in (self.path, self.path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class LectorDetecciones:
+    def __init__(self, path):
+        """
+        Lee las detecciones guardadas por EscritorDetecciones para volver a renderizar un video
+        sin llamar al modelo
+
+        Args:
+            path (str): Ruta del archivo .npz
+
+        Raises:
+            ValueError: Si el archivo es de otra versión o no tiene las detecciones de todos los frames
+        """
+        with np.load(path) as datos:
+            if int(datos['version']) != VERSION_FORMATO:
+                raise ValueError(f"Versión de detecciones no soportada: {int(datos['version'])}")
+            # Renderizar desde un archivo a medias dejaría frames sin anonimizar
+            if not bool(datos['completo']):
+                raise ValueError(f"Las detecciones de {path} están incompletas")
+            self.total_frames = int(datos['total_frames'])
+            self.width, self.height = (int(v) for v in datos['tamano'])
+            self.frames = datos['frames']
+            self.cajas = datos['cajas']
+            self.confianzas = datos['confianzas']
+            self.clases = datos['clases']
+            self.desplazamientos = datos['desplazamientos']
+        if len(self.desplazamientos) - 1 != self.total_frames:
+            raise ValueError(f"Las detecciones de {path} tienen {len(self.desplazamientos) - 1} frames, "
+                             f"se esperaban {self.total_frames}")
+
+    def __len__(self):
+        return self.total_frames
+
+    def frame(self, indice):
+        """
+        Args:
+            indice (int): Índice del frame, empezando en 0
+
+        Returns:
+            tuple: Cajas (N, 4) y confianzas (N,) del frame
+
+        Raises:
+            IndexError: Si el frame no está guardado; el video tiene más frames que las detecciones
+        """
+        if not 0 <= indice < len(self):
+            raise IndexError(f"Frame {indice} fuera de las detecciones guardadas ({len(self)} frames)")
+        inicio, fin = self.desplazamientos[indice], self.desplazamientos[indice + 1]
+        return self.cajas[inicio:fin], self.confianzas[inicio:fin]
@@ -1,22 +1,25 @@
 import cv2
 import os
+from anonimizador import Anonimizador
 
 modelo_path = os.path.join("modelos", "haarcascade_russian_plate_number.xml")
 detector_placas = cv2.CascadeClassifier(modelo_path)
 
-def difuminar_matricula(imagen_path, salida_path):
-    imagen = cv2.imread(imagen_path)
+def difuminar_imagen(imagen, anonimizador=None):
+    # Trabaja sobre la imagen ya decodificada y la modifica en el sitio
+    if anonimizador is None:
+        anonimizador = Anonimizador()
     gris = cv2.cvtColor(imagen, cv2.COLOR_BGR2GRAY)
 
     placas = detector_placas.detectMultiScale(gris, scaleFactor=1.1, minNeighbors=4)
 
-    for (x, y, w, h) in placas:
-        region = imagen[y:y+h, x:x+w]
-        w_region = w
-        h_region = h
-        ksize = (max(31, w_region // 3 * 2 | 1), max(31, h_region // 3 * 2 | 1))  # Siempre impar
-        region_borrosa = cv2.GaussianBlur(region, ksize, 0)
-        imagen[y:y+h, x:x+w] = region_borrosa
+    # Pasar de (x, y, w, h) a (x1, y1, x2, y2) y anonimizar todas las placas de una vez
+    cajas = [(x, y, x + w, y + h) for (x, y, w, h) in placas]
+    anonimizador(imagen, cajas)
+    return True if len(placas) > 0 else False
 
+def difuminar_matricula(imagen_path, salida_path, anonimizador=None):
+    imagen = cv2.imread(imagen_path)
+    hay_placa = difuminar_imagen(imagen, anonimizador)
     cv2.imwrite(salida_path, imagen)
-    return True if len(placas) > 0 else False
\ No newline at end of file
+    return hay_placa
\ No newline at end of file
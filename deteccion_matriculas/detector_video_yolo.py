@@ -5,22 +5,92 @@ import argparse
 import numpy as np
 from pathlib import Path
 import subprocess
+from seguimiento import DetectorConSeguimiento, FiltroFramesEstaticos
+from teselas import InferenciaTeselas
+from cascada import CompuertaCascada
+from anonimizador import Anonimizador, METODOS
+from detecciones import EscritorDetecciones, LectorDetecciones
 
-def convertir_a_h264(video_entrada, video_salida):
-    """
-    Convierte un video a formato MP4 compatible con navegadores (H.264 + AAC)
-    usando FFmpeg.
-    """
-    comando = [
-        'ffmpeg',
-        '-y',                      # Sobrescribe si ya existe
-        '-i', video_entrada,       # Video de entrada
-        '-vcodec', 'libx264',      # Video codec H.264
-        '-acodec', 'aac',          # Audio codec AAC
-        '-strict', 'experimental', # Permite usar AAC
-        video_salida
-    ]
-    subprocess.run(comando, check=True)
+class EscritorH264:
+    def __init__(self, salida_path, width, height, fps, audio_path=None):
+        """
+        Codifica los frames directamente a MP4 compatible con navegadores (H.264 + AAC)
+        enviándolos crudos a un único proceso de FFmpeg por su entrada estándar
+        
+        Args:
+            salida_path (str): Ruta del video de salida
+            width (int): Ancho de los frames
+            height (int): Alto de los frames
+            fps (float): Frames por segundo del video de salida
+            audio_path (str): Video del que copiar la pista de audio, si la tiene (opcional)
+        """
+        comando = [
+            'ffmpeg',
+            '-y',                                  # Sobrescribe si ya existe
+            '-loglevel', 'error',
+            '-f', 'rawvideo',                      # Frames crudos por stdin
+            '-pix_fmt', 'bgr24',                   # Formato de los frames de OpenCV
+            '-s', f'{width}x{height}',
+            '-r', str(fps),
+            '-i', '-',
+        ]
+        if audio_path:
+            comando += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0?']  # El audio es opcional
+        comando += [
+            '-vcodec', 'libx264',                  # Video codec H.264
+            '-pix_fmt', 'yuv420p',                 # Necesario para los navegadores
+            '-preset', 'veryfast',
+            '-acodec', 'aac',                      # Audio codec AAC
+            '-shortest',
+            '-movflags', '+faststart',             # Permite reproducir mientras se descarga
+            salida_path
+        ]
+        self.proceso = subprocess.Popen(comando, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    def write(self, frame):
+        """
+        Envía un frame a FFmpeg
+        
+        Raises:
+            subprocess.CalledProcessError: Si FFmpeg terminó antes de recibir el frame
+        """
+        try:
+            self.proceso.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError as e:
+            # FFmpeg murió a mitad de la codificación: su stderr explica por qué
+            error = self.proceso.stderr.read()
+            self.proceso.wait()
+            raise subprocess.CalledProcessError(self.proceso.returncode, self.proceso.args, stderr=error) from e
+    
+    def release(self):
+        """
+        Cierra la entrada de FFmpeg y espera a que termine de escribir el video
+        
+        Raises:
+            subprocess.CalledProcessError: Si FFmpeg termina con error
+        """
+        if self.proceso.stdin.closed:
+            return
+        try:
+            self.proceso.stdin.close()
+        except BrokenPipeError:
+            pass
+        error = self.proceso.stderr.read()
+        if self.proceso.wait() != 0:
+            raise subprocess.CalledProcessError(self.proceso.returncode, self.proceso.args, stderr=error)
+    
+    def abortar(self):
+        """
+        Detiene FFmpeg sin terminar el video, tras un error o una cancelación
+        """
+        if self.proceso.poll() is None:
+            self.proceso.kill()
+        self.proceso.wait()
+        for flujo in (self.proceso.stdin, self.proceso.stderr):
+            try:
+                flujo.close()
+            except BrokenPipeError:
+                pass
 
 
 class DetectorVideoYOLO:
@@ -40,8 +110,99 @@ class DetectorVideoYOLO:
         self.modelo = YOLO(modelo_path)
         print(f"Modelo cargado desde: {modelo_path}")
     
+    @staticmethod
+    def _extraer_cajas(resultado):
+        """
+        Extrae las cajas y confianzas de un resultado de YOLO
+        
+        Args:
+            resultado: Resultado de YOLO de un frame
+        
+        Returns:
+            tuple: Cajas (N, 4) en formato x1, y1, x2, y2 y confianzas (N,)
+        """
+        if resultado.boxes is None or len(resultado.boxes) == 0:
+            return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32)
+        return resultado.boxes.xyxy.cpu().numpy(), resultado.boxes.conf.cpu().numpy()
+    
+    def _detectar_lote(self, frames, confianza, teselas=None):
+        """
+        Detecta las matrículas de varios frames en una sola llamada al modelo
+        
+        Args:
+            frames (list): Frames BGR
+            confianza (float): Umbral de confianza para las detecciones
+            teselas (InferenciaTeselas): Si se indica, las teselas de todos los frames se infieren
+                juntas y sus detecciones se fusionan por frame (opcional)
+        
+        Returns:
+            list: Cajas (N, 4) y confianzas (N,) de cada frame
+        """
+        if teselas is None:
+            return [self._extraer_cajas(r) for r in self.modelo(frames, conf=confianza, verbose=False)]
+        
+        recortes = [teselas.recortes(frame) for frame in frames]
+        todos = [recorte for recortes_frame in recortes for recorte in recortes_frame]
+        kwargs = {'imgsz': teselas.tamano} if teselas.tamano is not None else {}
+        detecciones = [self._extraer_cajas(r) for r in self.modelo(todos, conf=confianza, verbose=False, **kwargs)]
+        
+        resultado = []
+        inicio = 0
+        for frame, recortes_frame in zip(frames, recortes):
+            fin = inicio + len(recortes_frame)
+            resultado.append(teselas.fusionar(frame, detecciones[inicio:fin]))
+            inicio = fin
+        return resultado
+    
+    def _detectar_frame(self, frame, confianza, teselas=None):
+        return self._detectar_lote([frame], confianza, teselas)[0]
+    
+    def _procesar_detecciones(self, frame, cajas, confianzas, difuminar, anonimizador=None):
+        """
+        Difumina o dibuja sobre el frame las matrículas detectadas
+        
+        Args:
+            frame (np.ndarray): Frame BGR que se modifica en el sitio
+            cajas (np.ndarray): Cajas (N, 4) en formato x1, y1, x2, y2
+            confianzas (np.ndarray): Confianzas (N,) de las cajas
+            difuminar (bool): Si difuminar las matrículas detectadas
+            anonimizador (Anonimizador): Cómo ocultar las matrículas; si es None, el de por defecto
+        
+        Returns:
+            int: Número de matrículas del frame
+        """
+        if difuminar:
+            # Ocultar todas las matrículas del frame en una sola llamada
+            (anonimizador or Anonimizador())(frame, cajas)
+            return len(cajas)
+        
+        for caja, conf in zip(cajas, confianzas):
+            # Obtener coordenadas
+            x1, y1, x2, y2 = map(int, caja)
+            x1, y1 = max(x1, 0), max(y1, 0)
+            
+            # Dibujar rectángulo y etiqueta
+            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            
+            # Etiqueta con confianza
+            label = f"Matricula: {conf:.2f}"
+            label_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)[0]
+            
+            # Fondo para el texto
+            cv2.rectangle(frame, (x1, y1 - label_size[1] - 10), 
+                        (x1 + label_size[0], y1), (0, 255, 0), -1)
+            
+            # Texto
+            cv2.putText(frame, label, (x1, y1 - 5), 
+                      cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
+        
+        return len(cajas)
+    
     def detectar_matriculas_video(self, video_path, salida_path=None, mostrar_video=True, 
-                                 difuminar=False, confianza=0.5, progress_callback=None):
+                                 difuminar=False, confianza=0.5, progress_callback=None,
+                                 batch_size=1, cancelar=None, detectar_cada=1, umbral_estatico=0.0,
+                                 teselas=None, cascada=None, anonimizador=None, escritor_detecciones=None,
+                                 detecciones=None, rango=None):
         """
         Detecta matrículas en un video
         
@@ -52,20 +213,68 @@ class DetectorVideoYOLO:
             difuminar (bool): Si difuminar las matrículas detectadas
             confianza (float): Umbral de confianza para las detecciones
             progress_callback (callable): Función de callback para actualizar el progreso
+            batch_size (int): Número de frames que se pasan juntos al modelo en cada llamada
+            cancelar (threading.Event): Si se activa, detiene el procesamiento antes del siguiente
+                lote y descarta el video de salida
+            detectar_cada (int): Si es mayor que 1, el modelo solo corre cada detectar_cada frames
+                (o antes si cambia la escena o se pierde el seguimiento) y las cajas se siguen con
+                flujo óptico en el resto. En ese modo batch_size solo agrupa la lectura de frames
+            umbral_estatico (float): Diferencia máxima de gris (0-255) entre miniaturas con el último frame
+                procesado por debajo de la cual un frame reutiliza sus detecciones sin llamar al modelo.
+                0 lo desactiva
+            teselas (InferenciaTeselas): Inferir teselas solapadas o solo la región de interés de cada
+                frame en lugar del frame completo (opcional)
+            cascada (CompuertaCascada): Primera etapa barata (Haar, movimiento y periodo máximo) que
+                decide qué frames pasan por YOLO; el resto reutiliza las detecciones de la última
+                llamada a YOLO (opcional)
+            anonimizador (Anonimizador): Cómo ocultar las matrículas si difuminar es True; si es None,
+                desenfoque de caja equivalente al gaussiano original
+            escritor_detecciones (EscritorDetecciones): Guarda las cajas de cada frame mientras se
+                procesa, para volver a renderizar el video sin el modelo (opcional)
+            detecciones (LectorDetecciones): Detecciones guardadas del mismo video. Si se indica, no
+                se llama al modelo: se aplican las cajas guardadas de cada frame, por lo que el video
+                se renderiza a la velocidad de decodificación y codificación (opcional)
+            rango (tuple): Frames (inicio, fin) del video a procesar, fin excluido. El video de salida
+                contiene solo esos frames y no lleva audio; es un trozo del procesamiento en paralelo.
+                Si inicio es un fotograma clave, el salto al inicio es exacto (opcional)
         """
+        if batch_size < 1:
+            raise ValueError(f"batch_size debe ser al menos 1: {batch_size}")
+        if cascada is not None and detectar_cada > 1:
+            raise ValueError("La cascada no se puede combinar con el seguimiento (detectar_cada > 1)")
+        
+        seguimiento = None
+        if detectar_cada > 1:
+            seguimiento = DetectorConSeguimiento(lambda frame: self._detectar_frame(frame, confianza, teselas),
+                                                 detectar_cada=detectar_cada)
+        estatico = FiltroFramesEstaticos(umbral_estatico) if umbral_estatico > 0 else None
+        
         # Abrir video
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
             raise ValueError(f"No se pudo abrir el video: {video_path}")
         
         # Obtener propiedades del video
-        fps = int(cap.get(cv2.CAP_PROP_FPS))
+        fps_exacto = cap.get(cv2.CAP_PROP_FPS)
+        fps = int(fps_exacto)
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         
+        # Procesar solo un trozo del video
+        primer_frame = 0
+        if rango is not None:
+            primer_frame, fin = rango
+            cap.set(cv2.CAP_PROP_POS_FRAMES, primer_frame)
+            total_frames = min(fin, total_frames) - primer_frame
+        
         print(f"Video: {width}x{height}, {fps} FPS, {total_frames} frames")
         
+        if detecciones is not None and (detecciones.width, detecciones.height) != (width, height):
+            cap.release()
+            raise ValueError(f"Las detecciones son de un video de {detecciones.width}x{detecciones.height}, "
+                             f"no de {width}x{height}")
+        
         # Información del video para el progreso
         video_info = {
             'width': width,
@@ -85,123 +294,207 @@ class DetectorVideoYOLO:
                 'status': 'iniciando'
             })
         
-        # Configurar escritor de video si se especifica salida
+        # Configurar escritor de video si se especifica salida; el audio se copia del video original
+        # y los fps exactos evitan que se desincronice
         out = None
         if salida_path:
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            out = cv2.VideoWriter(salida_path, fourcc, fps, (width, height))
+            out = EscritorH264(salida_path, width, height, fps_exacto, audio_path=video_path if rango is None else None)
         
         frame_count = 0
         detecciones_totales = 0
+        cancelado = False
+        detenido = False
+        terminado = False
+        
+        # Frames ya emitidos según el origen de sus cajas: 'detectado', 'seguido', 'omitido' (estático),
+        # 'sin_yolo' (descartado por la cascada), el motivo de la cascada ('haar', 'movimiento' o
+        # 'periodo') o 'renderizado'. Se cuentan al avanzar frame_count, no al decidir todo el lote,
+        # para que el progreso enviado a mitad de un lote sea coherente
+        origenes_emitidos = dict.fromkeys(('detectado', 'seguido', 'omitido', 'sin_yolo', 'haar', 'movimiento',
+                                           'periodo', 'renderizado'), 0)
+        
+        def estadisticas():
+            # Frames en los que corrió el modelo frente a frames con cajas seguidas o reutilizadas
+            frames_detectados = (origenes_emitidos['detectado'] + origenes_emitidos['haar']
+                                 + origenes_emitidos['movimiento'] + origenes_emitidos['periodo'])
+            resumen = {
+                'frames_detectados': frames_detectados,
+                'frames_seguidos': origenes_emitidos['seguido'],
+                'frames_omitidos': origenes_emitidos['omitido'],
+                'ratio_detectados': frames_detectados / frame_count if frame_count else 0.0
+            }
+            if cascada is not None:
+                resumen.update({
+                    'frames_yolo_haar': origenes_emitidos['haar'],
+                    'frames_yolo_movimiento': origenes_emitidos['movimiento'],
+                    'frames_yolo_periodo': origenes_emitidos['periodo'],
+                    'frames_sin_yolo': origenes_emitidos['sin_yolo']
+                })
+            return resumen
+        
+        # Detecciones del último frame procesado, reutilizadas en los frames repetidos
+        ultimas_cajas = (np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32))
         
         try:
-            while True:
-                ret, frame = cap.read()
-                if not ret:
+            fin_video = False
+            while not fin_video:
+                # Comprobar la cancelación antes de leer y procesar el siguiente lote
+                if cancelar is not None and cancelar.is_set():
+                    print("Procesamiento cancelado")
+                    cancelado = True
                     break
                 
-                frame_count += 1
-                
-                # Actualizar progreso cada 10 frames o en el último frame
-                if frame_count % 10 == 0 or frame_count == total_frames:
-                    progress = (frame_count / total_frames) * 100
-                    if progress_callback:
-                        progress_callback({
-                            **video_info,
-                            'current_frame': frame_count,
-                            'progress': progress,
-                            'message': f'Procesando: {progress:.1f}% - Frame {frame_count}/{total_frames}'
-                        })
+                # Leer hasta batch_size frames para inferirlos en una sola llamada al modelo
+                lote = []
+                while len(lote) < batch_size:
+                    # Un trozo termina en su último frame aunque el video siga
+                    if rango is not None and frame_count + len(lote) >= total_frames:
+                        fin_video = True
+                        break
+                    ret, frame = cap.read()
+                    if not ret:
+                        fin_video = True
+                        break
+                    lote.append(frame)
                 
-                # Realizar detección
-                resultados = self.modelo(frame, conf=confianza, verbose=False)
+                # El último lote puede estar incompleto o vacío
+                if not lote:
+                    break
                 
-                # Procesar detecciones
-                for r in resultados:
-                    if r.boxes is not None and len(r.boxes) > 0:
-                        for box in r.boxes:
-                            # Obtener coordenadas
-                            x1, y1, x2, y2 = map(int, box.xyxy[0])
-                            conf = float(box.conf[0])
-                            
-                            detecciones_totales += 1
-                            
-                            if difuminar:
-                                # Difuminar la región de la matrícula
-                                region = frame[y1:y2, x1:x2]
-                                if region.size > 0:
-                                    w = x2 - x1
-                                    h = y2 - y1
-                                    ksize = (max(31, w // 3 * 2 | 1), max(31, h // 3 * 2 | 1))  # siempre impar
-                                    region_borrosa = cv2.GaussianBlur(region, ksize, 0)
-                                    frame[y1:y2, x1:x2] = region_borrosa
-                            else:
-                                # Dibujar rectángulo y etiqueta
-                                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                                
-                                # Etiqueta con confianza
-                                label = f"Matricula: {conf:.2f}"
-                                label_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)[0]
-                                
-                                # Fondo para el texto
-                                cv2.rectangle(frame, (x1, y1 - label_size[1] - 10), 
-                                            (x1 + label_size[0], y1), (0, 255, 0), -1)
-                                
-                                # Texto
-                                cv2.putText(frame, label, (x1, y1 - 5), 
-                                          cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
+                if detecciones is not None:
+                    # Solo renderizar: las cajas salen de las detecciones guardadas
+                    cajas_lote = [detecciones.frame(primer_frame + frame_count + i) for i in range(len(lote))]
+                    origenes = ['renderizado'] * len(lote)
+                else:
+                    # Los frames iguales al último procesado, o descartados por la primera etapa de la
+                    # cascada, no se vuelven a procesar
+                    origenes = []
+                    for frame in lote:
+                        if estatico is not None and estatico.repetido(frame):
+                            origenes.append('omitido')
+                        elif cascada is not None and not cascada.decidir(frame):
+                            origenes.append('sin_yolo')
+                        else:
+                            origenes.append(cascada.ultimo_motivo if cascada is not None else 'detectado')
+                    repetidos = [origen in ('omitido', 'sin_yolo') for origen in origenes]
+                    nuevos = [frame for frame, repetido in zip(lote, repetidos) if not repetido]
+                    
+                    # Realizar detección en los frames nuevos del lote, o solo en los frames clave si se siguen las cajas
+                    if seguimiento is None:
+                        cajas_nuevas = iter(self._detectar_lote(nuevos, confianza, teselas) if nuevos else [])
+                    else:
+                        cajas_nuevas = iter([seguimiento.procesar(frame) for frame in nuevos])
+                    
+                    cajas_lote = []
+                    for i, repetido in enumerate(repetidos):
+                        if not repetido:
+                            nuevas = next(cajas_nuevas)
+                            ultimas_cajas = nuevas[:2]
+                            # Con seguimiento, solo los frames clave pasan por el modelo
+                            if seguimiento is not None and not nuevas[2]:
+                                origenes[i] = 'seguido'
+                        cajas_lote.append(ultimas_cajas)
                 
-                # Mostrar progreso
-                if frame_count % 30 == 0:  # Cada 30 frames
-                    progreso = (frame_count / total_frames) * 100
-                    print(f"Progreso: {progreso:.1f}% - Frame {frame_count}/{total_frames}")
+                # Guardar las cajas antes de dibujarlas: sirven para renderizar de nuevo con otras opciones
+                if escritor_detecciones is not None:
+                    for cajas, confianzas in cajas_lote:
+                        escritor_detecciones.agregar(cajas, confianzas)
                 
-                # Guardar frame si hay salida
-                if out:
-                    out.write(frame)
+                for frame, (cajas, confianzas), origen in zip(lote, cajas_lote, origenes):
+                    frame_count += 1
+                    origenes_emitidos[origen] += 1
+                    
+                    # Actualizar progreso cada 10 frames o en el último frame
+                    if frame_count % 10 == 0 or frame_count == total_frames:
+                        progress = (frame_count / total_frames) * 100
+                        if progress_callback:
+                            progress_callback({
+                                **video_info,
+                                **estadisticas(),
+                                'current_frame': frame_count,
+                                'progress': progress,
+                                'message': f'Procesando: {progress:.1f}% - Frame {frame_count}/{total_frames}'
+                            })
+                    
+                    # Procesar detecciones
+                    detecciones_totales += self._procesar_detecciones(frame, cajas, confianzas, difuminar, anonimizador)
+                    
+                    # Mostrar progreso
+                    if frame_count % 30 == 0:  # Cada 30 frames
+                        progreso = (frame_count / total_frames) * 100
+                        print(f"Progreso: {progreso:.1f}% - Frame {frame_count}/{total_frames}")
+                    
+                    # Guardar frame si hay salida
+                    if out:
+                        out.write(frame)
+                    
+                    # Mostrar video
+                    if mostrar_video:
+                        cv2.imshow('Detección de Matrículas', frame)
+                        if cv2.waitKey(1) & 0xFF == ord('q'):
+                            print("Detenido por el usuario")
+                            detenido = True
+                            break
                 
-                # Mostrar video
-                if mostrar_video:
-                    cv2.imshow('Detección de Matrículas', frame)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        print("Detenido por el usuario")
-                        break
+                if detenido:
+                    break
+            
+            # FFmpeg termina de escribir el video; si falla, el error llega al llamador
+            if out:
+                out.release()
+            terminado = not cancelado
         
         finally:
             # Limpiar recursos
             cap.release()
-            if progress_callback and salida_path:
+            
+            # Un trabajo cancelado o fallido no deja un video ni detecciones a medias
+            if not terminado:
+                if out:
+                    out.abortar()
+                if salida_path and os.path.exists(salida_path):
+                    os.remove(salida_path)
+                if escritor_detecciones is not None:
+                    escritor_detecciones.descartar()
+        
+        if cancelado:
+            if progress_callback:
                 progress_callback({
                     **video_info,
-                    'status': 'recodificando',
-                    'message': 'Recodificando video a formato compatible...'
+                    **estadisticas(),
+                    'current_frame': frame_count,
+                    'progress': (frame_count / total_frames) * 100 if total_frames else 0.0,
+                    'status': 'cancelado',
+                    'message': f'Procesamiento cancelado en el frame {frame_count}/{total_frames}.'
                 })
+            return False
         
-            # Liberar recursos
-            cap.release()
-            if out:
-                out.release()
+        # Si se detuvo con 'q', las detecciones no cubren el video y no sirven para renderizar
+        if escritor_detecciones is not None:
+            escritor_detecciones.guardar(completo=not detenido)
         
-            # Si se especificó salida, convertir a formato compatible
-            if salida_path and os.path.exists(salida_path):
-                temp_path = salida_path.replace('.mp4', '_temp.mp4')
-                os.rename(salida_path, temp_path)
-                convertir_a_h264(temp_path, salida_path)
-                os.remove(temp_path)
+        print(f"Procesamiento completado. Total de matrículas detectadas: {detecciones_totales}")
+        if seguimiento is not None or estatico is not None or cascada is not None:
+            resumen = estadisticas()
+            print(f"Frames detectados: {resumen['frames_detectados']}, seguidos: {resumen['frames_seguidos']}, "
+                  f"omitidos por estáticos: {resumen['frames_omitidos']}")
+        if cascada is not None:
+            print(f"Cascada: {resumen['frames_sin_yolo']} frames sin YOLO, YOLO por Haar: "
+                  f"{resumen['frames_yolo_haar']}, por movimiento: {resumen['frames_yolo_movimiento']}, "
+                  f"por periodo: {resumen['frames_yolo_periodo']}")
         
-            print(f"Procesamiento completado. Total de matrículas detectadas: {detecciones_totales}")
+        # Notificar finalización
+        if progress_callback:
+            progress_callback({
+                **video_info,
+                **estadisticas(),
+                'current_frame': total_frames,
+                'progress': 100.0,
+                'status': 'completado',
+                'message': f'Procesamiento completado. {detecciones_totales} matrículas detectadas.'
+            })
         
-            # Notificar finalización
-            if progress_callback:
-                progress_callback({
-                    **video_info,
-                    'current_frame': total_frames,
-                    'progress': 100.0,
-                    'status': 'completado',
-                    'message': f'Procesamiento completado. {detecciones_totales} matrículas detectadas.'
-                })
-            
-            return detecciones_totales > 0
+        return detecciones_totales > 0
 
         print(f"Procesamiento completado:")
         print(f"- Frames procesados: {frame_count}")
@@ -209,7 +502,8 @@ class DetectorVideoYOLO:
         if salida_path:
             print(f"- Video guardado en: {salida_path}")
     
-    def detectar_webcam(self, camara_id=0, difuminar=False, confianza=0.5):
+    def detectar_webcam(self, camara_id=0, difuminar=False, confianza=0.5, detectar_cada=1, teselas=None,
+                        anonimizador=None):
         """
         Detecta matrículas en tiempo real desde la webcam
         
@@ -217,7 +511,18 @@ class DetectorVideoYOLO:
             camara_id (int): ID de la cámara (0 por defecto)
             difuminar (bool): Si difuminar las matrículas detectadas
             confianza (float): Umbral de confianza para las detecciones
+            detectar_cada (int): Máximo de frames entre dos detecciones; en el resto las cajas se
+                siguen con flujo óptico
+            teselas (InferenciaTeselas): Inferir teselas o la región de interés en lugar del frame completo
+            anonimizador (Anonimizador): Cómo ocultar las matrículas si difuminar es True
         """
+        if anonimizador is None:
+            # Un poco más fuerte que el de los videos para no ocultar menos que el
+            # desenfoque (23, 23) con sigma 30 que se usaba antes en la webcam
+            anonimizador = Anonimizador(fuerza=1.25)
+        seguimiento = DetectorConSeguimiento(lambda frame: self._detectar_frame(frame, confianza, teselas),
+                                             detectar_cada=detectar_cada)
+        
         cap = cv2.VideoCapture(camara_id)
         if not cap.isOpened():
             raise ValueError(f"No se pudo abrir la cámara: {camara_id}")
@@ -230,34 +535,27 @@ class DetectorVideoYOLO:
                 if not ret:
                     break
                 
-                # Realizar detección
-                resultados = self.modelo(frame, conf=confianza, verbose=False)
+                # Realizar detección, o seguir las cajas de la última detección
+                cajas, confianzas, _ = seguimiento.procesar(frame)
                 
                 # Procesar detecciones
-                matriculas_detectadas = 0
-                for r in resultados:
-                    if r.boxes is not None and len(r.boxes) > 0:
-                        for box in r.boxes:
-                            matriculas_detectadas += 1
-                            
-                            # Obtener coordenadas
-                            x1, y1, x2, y2 = map(int, box.xyxy[0])
-                            conf = float(box.conf[0])
-                            
-                            if difuminar:
-                                # Difuminar la región de la matrícula
-                                region = frame[y1:y2, x1:x2]
-                                if region.size > 0:
-                                    region_borrosa = cv2.GaussianBlur(region, (23, 23), 30)
-                                    frame[y1:y2, x1:x2] = region_borrosa
-                            else:
-                                # Dibujar rectángulo y etiqueta
-                                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                                
-                                # Etiqueta con confianza
-                                label = f"Matricula: {conf:.2f}"
-                                cv2.putText(frame, label, (x1, y1 - 10), 
-                                          cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+                matriculas_detectadas = len(cajas)
+                if difuminar:
+                    # Ocultar todas las matrículas del frame en una sola llamada
+                    anonimizador(frame, cajas)
+                else:
+                    for caja, conf in zip(cajas, confianzas):
+                        # Obtener coordenadas
+                        x1, y1, x2, y2 = map(int, caja)
+                        x1, y1 = max(x1, 0), max(y1, 0)
+                        
+                        # Dibujar rectángulo y etiqueta
+                        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                        
+                        # Etiqueta con confianza
+                        label = f"Matricula: {conf:.2f}"
+                        cv2.putText(frame, label, (x1, y1 - 10), 
+                                  cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
                 
                 # Mostrar información en pantalla
                 info_text = f"Matriculas detectadas: {matriculas_detectadas}"
@@ -273,6 +571,9 @@ class DetectorVideoYOLO:
         finally:
             cap.release()
             cv2.destroyAllWindows()
+            estadisticas = seguimiento.estadisticas()
+            print(f"Frames detectados: {estadisticas['frames_detectados']}, "
+                  f"seguidos: {estadisticas['frames_seguidos']}")
 
 
 def main():
@@ -283,8 +584,31 @@ def main():
     parser.add_argument('--salida', type=str, help='Ruta del video de salida')
     parser.add_argument('--modelo', type=str, help='Ruta al modelo YOLO personalizado')
     parser.add_argument('--difuminar', action='store_true', help='Difuminar matrículas detectadas')
+    parser.add_argument('--anonimizado', type=str, default='caja', choices=METODOS,
+                        help='Cómo ocultar las matrículas con --difuminar (default: caja)')
+    parser.add_argument('--fuerza', type=float, default=1.0,
+                        help='Intensidad del anonimizado, al menos 1.0 (default: 1.0)')
     parser.add_argument('--confianza', type=float, default=0.5, help='Umbral de confianza (default: 0.5)')
     parser.add_argument('--no-mostrar', action='store_true', help='No mostrar video durante procesamiento')
+    parser.add_argument('--batch', type=int, default=1, help='Frames por llamada al modelo (default: 1)')
+    parser.add_argument('--detectar-cada', type=int, default=1,
+                        help='Detectar cada N frames y seguir las cajas en el resto (default: 1)')
+    parser.add_argument('--umbral-estatico', type=float, default=0.0,
+                        help='Reutilizar las detecciones de los frames con una diferencia máxima de gris '
+                             'menor que este umbral (default: 0, desactivado)')
+    parser.add_argument('--teselas', type=int,
+                        help='Inferir teselas solapadas de este tamaño en píxeles en lugar del frame completo')
+    parser.add_argument('--solape', type=float, default=0.2, help='Solape entre teselas (default: 0.2)')
+    parser.add_argument('--roi', type=str,
+                        help='Polígono de la región de interés como "x1,y1;x2,y2;..." en píxeles del frame')
+    parser.add_argument('--cascada', action='store_true',
+                        help='Ejecutar YOLO solo cuando Haar o el movimiento lo pidan, o cada --periodo-maximo frames')
+    parser.add_argument('--periodo-maximo', type=int, default=30,
+                        help='Máximo de frames seguidos sin YOLO en modo cascada (default: 30)')
+    parser.add_argument('--guardar-detecciones', type=str,
+                        help='Ruta del archivo .npz donde guardar las cajas de cada frame')
+    parser.add_argument('--desde-detecciones', type=str,
+                        help='Renderizar el video con las cajas de un archivo .npz, sin llamar al modelo')
     
     args = parser.parse_args()
     
@@ -293,6 +617,12 @@ def main():
         print("Error: Debe especificar --video o --webcam")
         return
     
+    # Teselas o región de interés
+    teselas = None
+    if args.teselas or args.roi:
+        roi = [tuple(map(int, punto.split(','))) for punto in args.roi.split(';')] if args.roi else None
+        teselas = InferenciaTeselas(tamano=args.teselas, solape=args.solape, roi=roi)
+    
     try:
         # Crear detector
         detector = DetectorVideoYOLO(args.modelo)
@@ -302,7 +632,10 @@ def main():
             detector.detectar_webcam(
                 camara_id=args.camara,
                 difuminar=args.difuminar,
-                confianza=args.confianza
+                confianza=args.confianza,
+                detectar_cada=args.detectar_cada,
+                teselas=teselas,
+                anonimizador=Anonimizador(args.anonimizado, fuerza=max(args.fuerza, 1.25))
             )
         else:
             # Detección en video
@@ -310,12 +643,28 @@ def main():
                 print(f"Error: No se encontró el video: {args.video}")
                 return
             
+            escritor_detecciones = None
+            if args.guardar_detecciones:
+                cap = cv2.VideoCapture(args.video)
+                escritor_detecciones = EscritorDetecciones(args.guardar_detecciones,
+                                                           int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                                           int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                cap.release()
+            
             detector.detectar_matriculas_video(
                 video_path=args.video,
                 salida_path=args.salida,
                 mostrar_video=not args.no_mostrar,
                 difuminar=args.difuminar,
-                confianza=args.confianza
+                confianza=args.confianza,
+                batch_size=args.batch,
+                detectar_cada=args.detectar_cada,
+                umbral_estatico=args.umbral_estatico,
+                teselas=teselas,
+                cascada=CompuertaCascada(periodo_maximo=args.periodo_maximo) if args.cascada else None,
+                anonimizador=Anonimizador(args.anonimizado, fuerza=args.fuerza),
+                escritor_detecciones=escritor_detecciones,
+                detecciones=LectorDetecciones(args.desde_detecciones) if args.desde_detecciones else None
             )
     
     except Exception as e:
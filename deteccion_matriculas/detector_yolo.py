@@ -1,25 +1,35 @@
 from ultralytics import YOLO
 import cv2
 import os
+from anonimizador import Anonimizador
 
 modelo_path = os.path.join("modelos", "license-plate-finetune-v1l.pt")
-modelo = YOLO(modelo_path)
+modelo_por_defecto = None
 
-def difuminar_matricula_yolo(imagen_path, salida_path):
-    imagen = cv2.imread(imagen_path)
-    resultados = modelo(imagen_path)
+def cargar_modelo():
+    # El modelo se carga la primera vez que se usa, no al importar el módulo
+    global modelo_por_defecto
+    if modelo_por_defecto is None:
+        modelo_por_defecto = YOLO(modelo_path)
+    return modelo_por_defecto
+
+def difuminar_imagen_yolo(imagen, modelo=None, anonimizador=None):
+    # El modelo recibe el mismo array BGR que se difumina: la imagen se decodifica una sola vez
+    if modelo is None:
+        modelo = cargar_modelo()
+    if anonimizador is None:
+        anonimizador = Anonimizador()
+    resultados = modelo(imagen)
     hay_placa = False
 
     for r in resultados:
-        for box in r.boxes:
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-            region = imagen[y1:y2, x1:x2]
-            w = x2 - x1
-            h = y2 - y1
-            ksize = (max(31, w // 3 * 2 | 1), max(31, h // 3 * 2 | 1))  # siempre impar
-            region_borrosa = cv2.GaussianBlur(region, ksize, 0)
-            imagen[y1:y2, x1:x2] = region_borrosa
+        if len(r.boxes) > 0:
+            anonimizador(imagen, r.boxes.xyxy.cpu().numpy())
             hay_placa = True
+    return hay_placa
 
+def difuminar_matricula_yolo(imagen_path, salida_path, modelo=None, anonimizador=None):
+    imagen = cv2.imread(imagen_path)
+    hay_placa = difuminar_imagen_yolo(imagen, modelo=modelo, anonimizador=anonimizador)
     cv2.imwrite(salida_path, imagen)
     return hay_placa
\ No newline at end of file
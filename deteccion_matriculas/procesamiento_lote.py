@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+
+from anonimizador import Anonimizador, METODOS
+from detector_yolo import cargar_modelo
+
+EXTENSIONES_IMAGEN = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def entradas_directorio(directorio):
+    """
+    Recorre un directorio buscando imágenes
+
+    Args:
+        directorio (str): Directorio de entrada; se recorre recursivamente
+
+    Returns:
+        list: Pares (nombre relativo, función que devuelve los bytes de la imagen)
+    """
+    entradas = []
+    for raiz, _, archivos in os.walk(directorio):
+        for archivo in archivos:
+            if os.path.splitext(archivo)[1].lower() in EXTENSIONES_IMAGEN:
+                ruta = os.path.join(raiz, archivo)
+                entradas.append((os.path.relpath(ruta, directorio), lambda ruta=ruta: open(ruta, 'rb').read()))
+    return sorted(entradas, key=lambda entrada: entrada[0])
+
+
+def entradas_zip(archivo_zip):
+    """
+    Args:
+        archivo_zip (zipfile.ZipFile): Zip abierto con las imágenes
+
+    Returns:
+        list: Pares (nombre dentro del zip, función que devuelve los bytes de la imagen)
+    """
+    return [(nombre, lambda nombre=nombre: archivo_zip.read(nombre))
+            for nombre in archivo_zip.namelist()
+            if os.path.splitext(nombre)[1].lower() in EXTENSIONES_IMAGEN]
+
+
+def decodificar(entrada):
+    nombre, leer = entrada
+    inicio = time.perf_counter()
+    imagen = cv2.imdecode(np.frombuffer(leer(), dtype=np.uint8), cv2.IMREAD_COLOR)
+    return nombre, imagen, time.perf_counter() - inicio
+
+
+def procesar_lote(entradas, modelo, escribir, anonimizador=None, batch_size=16, hilos=4, confianza=None,
+                  cancelar=None):
+    """
+    Anonimiza muchas imágenes: se decodifican en un pool de hilos mientras el modelo infiere el
+    lote anterior, el modelo recibe lotes de batch_size imágenes (que letterboxea a un tamaño común)
+    y los resultados se codifican y escriben en paralelo. Como mucho se escribe un lote mientras se
+    infiere el siguiente, así que la memoria no crece con el número de imágenes aunque escribir sea
+    más lento que inferir
+
+    Args:
+        entradas (list): Pares (nombre, función que devuelve los bytes de la imagen)
+        modelo: Modelo YOLO
+        escribir (callable): Función escribir(nombre, datos) que guarda una imagen codificada;
+            se llama desde varios hilos a la vez
+        anonimizador (Anonimizador): Cómo ocultar las matrículas; si es None, el de por defecto
+        batch_size (int): Imágenes por llamada al modelo
+        hilos (int): Hilos para decodificar, codificar y escribir
+        confianza (float): Umbral de confianza; si es None, el del modelo
+        cancelar (threading.Event): Si se activa, no se procesan más lotes; el informe solo
+            incluye las imágenes ya procesadas (opcional)
+
+    Returns:
+        dict: Informe con los tiempos por imagen (en ms), el total y las imágenes por segundo
+    """
+    if anonimizador is None:
+        anonimizador = Anonimizador()
+    kwargs = {'verbose': False}
+    if confianza is not None:
+        kwargs['conf'] = confianza
+
+    def codificar_y_escribir(nombre, imagen):
+        inicio = time.perf_counter()
+        extension = os.path.splitext(nombre)[1].lower()
+        escribir(nombre, cv2.imencode(extension, imagen)[1].tobytes())
+        return time.perf_counter() - inicio
+
+    def esperar_escrituras(escrituras):
+        for informe, futuro in escrituras:
+            try:
+                informe['escribir_ms'] = futuro.result() * 1000
+            except ValueError as e:
+                # Un nombre no válido descarta esa imagen, no el lote entero
+                informe['error'] = str(e)
+
+    imagenes = []
+    inicio_total = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        lotes = [entradas[i:i + batch_size] for i in range(0, len(entradas), batch_size)]
+        escrituras = []
+        # Decodificar el siguiente lote mientras el modelo procesa el actual
+        siguiente = [pool.submit(decodificar, entrada) for entrada in lotes[0]] if lotes else []
+        for i in range(len(lotes)):
+            if cancelar is not None and cancelar.is_set():
+                break
+            decodificadas = [futuro.result() for futuro in siguiente]
+            siguiente = [pool.submit(decodificar, entrada) for entrada in lotes[i + 1]] if i + 1 < len(lotes) else []
+
+            validas = []
+            for nombre, imagen, t_decodificar in decodificadas:
+                if imagen is None:
+                    imagenes.append({'nombre': nombre, 'error': 'No se pudo decodificar la imagen'})
+                else:
+                    validas.append((nombre, imagen, t_decodificar))
+            if not validas:
+                continue
+
+            inicio = time.perf_counter()
+            resultados = modelo([imagen for _, imagen, _ in validas], **kwargs)
+            t_inferencia = (time.perf_counter() - inicio) / len(validas)
+
+            # Las imágenes del lote anterior se liberan al terminar de escribirse
+            esperar_escrituras(escrituras)
+            escrituras = []
+            for (nombre, imagen, t_decodificar), r in zip(validas, resultados):
+                inicio = time.perf_counter()
+                cajas = r.boxes.xyxy.cpu().numpy() if r.boxes is not None else np.zeros((0, 4))
+                anonimizador(imagen, cajas)
+                informe = {
+                    'nombre': nombre,
+                    'matriculas': len(cajas),
+                    'decodificar_ms': t_decodificar * 1000,
+                    'inferencia_ms': t_inferencia * 1000,
+                    'anonimizar_ms': (time.perf_counter() - inicio) * 1000
+                }
+                imagenes.append(informe)
+                escrituras.append((informe, pool.submit(codificar_y_escribir, nombre, imagen)))
+
+        esperar_escrituras(escrituras)
+
+    total = time.perf_counter() - inicio_total
+    procesadas = sum('error' not in imagen for imagen in imagenes)
+    return {
+        'imagenes': imagenes,
+        'procesadas': procesadas,
+        'errores': len(imagenes) - procesadas,
+        'con_matricula': sum(imagen.get('matriculas', 0) > 0 for imagen in imagenes),
+        'segundos': total,
+        'imagenes_por_segundo': procesadas / total if total > 0 else 0.0
+    }
+
+
+def escritor_directorio(directorio):
+    """
+    Returns:
+        callable: Función escribir(nombre, datos) que guarda cada imagen en el directorio
+            conservando su ruta relativa; lanza ValueError si el nombre es absoluto o sale del
+            directorio
+    """
+    raiz = os.path.realpath(directorio)
+
+    def escribir(nombre, datos):
+        # Los nombres de un zip pueden ser absolutos o subir con '..' y escribir fuera de la salida
+        ruta = os.path.realpath(os.path.join(raiz, os.path.normpath(nombre)))
+        if os.path.isabs(nombre) or os.path.commonpath([raiz, ruta]) != raiz or ruta == raiz:
+            raise ValueError(f"El nombre sale del directorio de salida: {nombre}")
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        with open(ruta, 'wb') as f:
+            f.write(datos)
+    return escribir
+
+
+def escritor_zip(archivo_zip):
+    """
+    Returns:
+        callable: Función escribir(nombre, datos) que añade cada imagen a un zip abierto en escritura
+    """
+    lock = threading.Lock()
+
+    def escribir(nombre, datos):
+        # zipfile no admite escrituras concurrentes; la codificación sí se hace en paralelo
+        with lock:
+            archivo_zip.writestr(nombre, datos)
+    return escribir
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Anonimizador de matrículas para carpetas o zips de imágenes')
+    parser.add_argument('--entrada', type=str, required=True, help='Directorio o archivo .zip con las imágenes')
+    parser.add_argument('--salida', type=str, required=True, help='Directorio o archivo .zip de salida')
+    parser.add_argument('--modelo', type=str, help='Ruta al modelo YOLO personalizado')
+    parser.add_argument('--batch', type=int, default=16, help='Imágenes por llamada al modelo (default: 16)')
+    parser.add_argument('--hilos', type=int, default=4, help='Hilos de decodificación y escritura (default: 4)')
+    parser.add_argument('--confianza', type=float, help='Umbral de confianza (default: el del modelo)')
+    parser.add_argument('--anonimizado', type=str, default='caja', choices=METODOS,
+                        help='Cómo ocultar las matrículas (default: caja)')
+    parser.add_argument('--fuerza', type=float, default=1.0, help='Intensidad del anonimizado (default: 1.0)')
+    parser.add_argument('--informe', type=str, help='Ruta del informe JSON con los tiempos por imagen')
+
+    args = parser.parse_args()
+
+    modelo = YOLO(args.modelo) if args.modelo else cargar_modelo()
+    anonimizador = Anonimizador(args.anonimizado, fuerza=args.fuerza)
+
+    zip_entrada = zipfile.ZipFile(args.entrada) if zipfile.is_zipfile(args.entrada) else None
+    entradas = entradas_zip(zip_entrada) if zip_entrada else entradas_directorio(args.entrada)
+    print(f"{len(entradas)} imágenes en {args.entrada}")
+
+    try:
+        if args.salida.lower().endswith('.zip'):
+            with zipfile.ZipFile(args.salida, 'w') as zip_salida:
+                informe = procesar_lote(entradas, modelo, escritor_zip(zip_salida), anonimizador,
+                                        batch_size=args.batch, hilos=args.hilos, confianza=args.confianza)
+        else:
+            informe = procesar_lote(entradas, modelo, escritor_directorio(args.salida), anonimizador,
+                                    batch_size=args.batch, hilos=args.hilos, confianza=args.confianza)
+    finally:
+        if zip_entrada:
+            zip_entrada.close()
+
+    print(f"Procesadas: {informe['procesadas']}, con matrícula: {informe['con_matricula']}, "
+          f"errores: {informe['errores']}")
+    print(f"{informe['segundos']:.1f} s, {informe['imagenes_por_segundo']:.1f} imágenes/s")
+    if args.informe:
+        with open(args.informe, 'w') as f:
+            json.dump(informe, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
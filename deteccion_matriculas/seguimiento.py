@@ -0,0 +1,213 @@
+import cv2
+import numpy as np
+
+
+def miniatura(gris, tamano=(64, 36)):
+    """
+    Reduce un frame en escala de grises a una miniatura para compararlo con otros frames
+
+    Args:
+        gris (np.ndarray): Frame en escala de grises
+        tamano (tuple): Ancho y alto de la miniatura
+
+    Returns:
+        np.ndarray: Miniatura en float32
+    """
+    return cv2.resize(gris, tamano, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+class FiltroFramesEstaticos:
+    def __init__(self, umbral=8.0):
+        """
+        Reconoce los frames prácticamente iguales al último frame que pasó el filtro, para
+        reutilizar sus detecciones en lugar de volver a llamar al modelo. Se compara la diferencia
+        máxima entre miniaturas: cada píxel de la miniatura promedia un bloque del frame, lo que
+        absorbe el ruido de compresión sin pasar por alto un vehículo que se mueve en una zona pequeña
+
+        Args:
+            umbral (float): Diferencia máxima de gris (0-255) entre miniaturas por debajo de la cual
+                un frame se considera repetido
+        """
+        self.umbral = umbral
+        self.miniatura = None
+        self.frames_omitidos = 0
+
+    def repetido(self, frame):
+        """
+        Args:
+            frame (np.ndarray): Frame BGR
+
+        Returns:
+            bool: True si el frame es igual al último que pasó el filtro; si no, pasa a ser la referencia
+        """
+        actual = miniatura(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        if self.miniatura is not None and np.abs(actual - self.miniatura).max() <= self.umbral:
+            self.frames_omitidos += 1
+            return True
+        self.miniatura = actual
+        return False
+
+
+class RastreadorFlujoOptico:
+    def __init__(self, max_puntos=30, crecimiento_margen=0.02):
+        """
+        Propaga cajas entre frames con flujo óptico de Lucas-Kanade sobre esquinas de cada caja
+
+        Args:
+            max_puntos (int): Máximo de esquinas que se siguen por caja
+            crecimiento_margen (float): Fracción del ancho y alto que crece cada caja por frame
+                seguido, para que el difuminado siga cubriendo la matrícula aunque el seguimiento derive
+        """
+        self.max_puntos = max_puntos
+        self.crecimiento_margen = crecimiento_margen
+        self.gris = None
+        self.cajas = np.zeros((0, 4), dtype=np.float32)
+        self.puntos = []
+        self.puntos_iniciales = []
+
+    def iniciar(self, gris, cajas):
+        """
+        Reinicia el seguimiento con las cajas de una detección
+
+        Args:
+            gris (np.ndarray): Frame en escala de grises donde se detectaron las cajas
+            cajas (np.ndarray): Cajas (N, 4) en formato x1, y1, x2, y2
+        """
+        self.gris = gris
+        self.cajas = np.asarray(cajas, dtype=np.float32).reshape(-1, 4).copy()
+        self.puntos = []
+        for x1, y1, x2, y2 in self.cajas.astype(int):
+            mascara = np.zeros_like(gris)
+            mascara[max(y1, 0):y2, max(x1, 0):x2] = 255
+            puntos = cv2.goodFeaturesToTrack(gris, self.max_puntos, 0.01, 3, mask=mascara)
+            if puntos is None:
+                # Matrícula sin textura suficiente: seguir una rejilla de 3x3 puntos de la caja
+                xs, ys = np.meshgrid(np.linspace(x1, x2, 5)[1:-1], np.linspace(y1, y2, 5)[1:-1])
+                puntos = np.stack((xs.ravel(), ys.ravel()), 1)
+            self.puntos.append(np.asarray(puntos, dtype=np.float32).reshape(-1, 2))
+        self.puntos_iniciales = [len(p) for p in self.puntos]
+
+    def actualizar(self, gris):
+        """
+        Mueve las cajas al nuevo frame con el desplazamiento mediano de sus puntos y agranda sus márgenes
+
+        Args:
+            gris (np.ndarray): Nuevo frame en escala de grises
+
+        Returns:
+            tuple: Cajas (N, 4) actualizadas y confianza del seguimiento entre 0 y 1, la fracción
+                mínima de puntos que sigue viva en cada caja
+        """
+        if len(self.cajas) == 0:
+            self.gris = gris
+            return self.cajas, 1.0
+
+        anteriores = np.concatenate(self.puntos).reshape(-1, 1, 2)
+        nuevos, estado, _ = cv2.calcOpticalFlowPyrLK(self.gris, gris, anteriores, None,
+                                                     winSize=(21, 21), maxLevel=3)
+        # Comprobación hacia atrás: descartar los puntos que no vuelven a su origen
+        vuelta, estado_vuelta, _ = cv2.calcOpticalFlowPyrLK(gris, self.gris, nuevos, None,
+                                                            winSize=(21, 21), maxLevel=3)
+        error = np.linalg.norm((anteriores - vuelta).reshape(-1, 2), axis=1)
+        validos = (estado.ravel() == 1) & (estado_vuelta.ravel() == 1) & (error < 1.0)
+        desplazamientos = (nuevos - anteriores).reshape(-1, 2)
+        nuevos = nuevos.reshape(-1, 2)
+
+        confianza = 1.0
+        inicio = 0
+        for i, puntos in enumerate(self.puntos):
+            fin = inicio + len(puntos)
+            validos_caja = validos[inicio:fin]
+            if validos_caja.any():
+                dx, dy = np.median(desplazamientos[inicio:fin][validos_caja], axis=0)
+                self.cajas[i] += (dx, dy, dx, dy)
+            self.puntos[i] = nuevos[inicio:fin][validos_caja]
+            confianza = min(confianza, len(self.puntos[i]) / self.puntos_iniciales[i])
+            inicio = fin
+
+        # Agrandar los márgenes y recortar al frame
+        ancho_alto = self.cajas[:, 2:] - self.cajas[:, :2]
+        crecimiento = np.tile(ancho_alto * self.crecimiento_margen / 2, 2) * (-1, -1, 1, 1)
+        self.cajas += crecimiento
+        alto, ancho = gris.shape[:2]
+        self.cajas[:, [0, 2]] = self.cajas[:, [0, 2]].clip(0, ancho)
+        self.cajas[:, [1, 3]] = self.cajas[:, [1, 3]].clip(0, alto)
+
+        self.gris = gris
+        return self.cajas, confianza
+
+
+class DetectorConSeguimiento:
+    def __init__(self, detectar, detectar_cada=5, confianza_minima=0.5, umbral_escena=30.0,
+                 crecimiento_margen=0.02):
+        """
+        Ejecuta el detector solo en frames clave y sigue las cajas con flujo óptico en el resto.
+        Un frame es clave cada detectar_cada frames, cuando cambia la escena o cuando el
+        seguimiento pierde confianza
+
+        Args:
+            detectar (callable): Función detectar(frame) que devuelve las cajas (N, 4) en formato
+                x1, y1, x2, y2 y sus confianzas (N,)
+            detectar_cada (int): Máximo de frames entre dos detecciones
+            confianza_minima (float): Confianza del seguimiento por debajo de la cual se vuelve a detectar
+            umbral_escena (float): Diferencia media de gris con el último frame clave a partir de la
+                cual se considera que la escena cambió
+            crecimiento_margen (float): Crecimiento de las cajas por frame seguido
+        """
+        if detectar_cada < 1:
+            raise ValueError(f"detectar_cada debe ser al menos 1: {detectar_cada}")
+
+        self.detectar = detectar
+        self.detectar_cada = detectar_cada
+        self.confianza_minima = confianza_minima
+        self.umbral_escena = umbral_escena
+        self.rastreador = RastreadorFlujoOptico(crecimiento_margen=crecimiento_margen)
+        self.miniatura_clave = None
+        self.confianzas = np.zeros(0, dtype=np.float32)
+        self.desde_deteccion = 0
+        self.frames_detectados = 0
+        self.frames_seguidos = 0
+
+    def procesar(self, frame):
+        """
+        Obtiene las cajas de un frame, detectándolas o siguiéndolas desde el último frame clave
+
+        Args:
+            frame (np.ndarray): Frame BGR
+
+        Returns:
+            tuple: Cajas (N, 4), confianzas de la última detección (N,) y si el frame fue clave
+        """
+        gris = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        miniatura_frame = miniatura(gris)
+
+        clave = self.miniatura_clave is None or self.desde_deteccion >= self.detectar_cada
+        if not clave:
+            clave = np.abs(miniatura_frame - self.miniatura_clave).mean() > self.umbral_escena
+        if not clave:
+            cajas, confianza = self.rastreador.actualizar(gris)
+            clave = confianza < self.confianza_minima
+
+        if clave:
+            cajas, self.confianzas = self.detectar(frame)
+            self.rastreador.iniciar(gris, cajas)
+            self.miniatura_clave = miniatura_frame
+            self.desde_deteccion = 1
+            self.frames_detectados += 1
+            return cajas, self.confianzas, True
+
+        self.desde_deteccion += 1
+        self.frames_seguidos += 1
+        return cajas.copy(), self.confianzas, False
+
+    def estadisticas(self):
+        """
+        Returns:
+            dict: Frames detectados, frames seguidos y fracción de frames en los que corrió el detector
+        """
+        total = self.frames_detectados + self.frames_seguidos
+        return {
+            'frames_detectados': self.frames_detectados,
+            'frames_seguidos': self.frames_seguidos,
+            'ratio_detectados': self.frames_detectados / total if total else 0.0
+        }
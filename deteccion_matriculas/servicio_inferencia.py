@@ -0,0 +1,144 @@
+import collections
+import threading
+from concurrent.futures import Future, TimeoutError as TiempoAgotado
+
+import numpy as np
+
+from detector_video_yolo import DetectorVideoYOLO
+
+
+class ServicioSaturado(Exception):
+    """La cola de trabajos del servicio de inferencia está llena"""
+
+
+class ServicioInferencia:
+    def __init__(self, modelo_path=None, num_workers=1, max_trabajos=8):
+        """
+        Servicio de inferencia de larga duración: carga los modelos una sola vez y reparte
+        los trabajos de imagen y de video entre un número fijo de workers. Tiene dos carriles:
+        los trabajos prioritarios (peticiones con un cliente esperando) pasan delante de los
+        normales (videos) y los trabajos largos los atienden entre sus lotes con atender_prioritarios
+
+        Args:
+            modelo_path (str): Ruta al modelo YOLO. Si es None, usa el modelo por defecto.
+            num_workers (int): Número de hilos de inferencia, cada uno con su propia copia del modelo
+            max_trabajos (int): Máximo de trabajos en espera en cada carril antes de rechazar los nuevos
+        """
+        self.max_trabajos = max_trabajos
+        self.prioritarios = collections.deque()
+        self.normales = collections.deque()
+        self.condicion = threading.Condition()
+        self.detectores = []
+        for _ in range(num_workers):
+            detector = DetectorVideoYOLO(modelo_path)
+            # Calentar el modelo con un frame vacío para que el primer trabajo no pague la inicialización
+            detector.modelo(np.zeros((640, 640, 3), dtype=np.uint8), verbose=False)
+            self.detectores.append(detector)
+
+        self.hilos = [threading.Thread(target=self._worker, args=(detector,), daemon=True)
+                      for detector in self.detectores]
+        for hilo in self.hilos:
+            hilo.start()
+
+    @staticmethod
+    def _ejecutar(detector, trabajo):
+        funcion, args, kwargs, futuro = trabajo
+        if futuro.set_running_or_notify_cancel():
+            try:
+                futuro.set_result(funcion(detector, *args, **kwargs))
+            except Exception as e:
+                futuro.set_exception(e)
+
+    def _worker(self, detector):
+        while True:
+            with self.condicion:
+                self.condicion.wait_for(lambda: self.prioritarios or self.normales)
+                trabajo = (self.prioritarios or self.normales).popleft()
+            self._ejecutar(detector, trabajo)
+
+    def _encolar(self, cola, funcion, args, kwargs):
+        futuro = Future()
+        with self.condicion:
+            if len(cola) >= self.max_trabajos:
+                raise ServicioSaturado(f"Hay {self.max_trabajos} trabajos en espera")
+            cola.append((funcion, args, kwargs, futuro))
+            self.condicion.notify()
+        return futuro
+
+    def enviar(self, funcion, *args, **kwargs):
+        """
+        Encola un trabajo normal para el siguiente worker libre
+
+        Args:
+            funcion (callable): Trabajo a ejecutar, recibe como primer argumento el
+                DetectorVideoYOLO del worker que lo ejecuta seguido de args y kwargs
+
+        Returns:
+            Future: Resultado del trabajo
+
+        Raises:
+            ServicioSaturado: Si la cola de trabajos normales está llena
+        """
+        return self._encolar(self.normales, funcion, args, kwargs)
+
+    def enviar_prioritario(self, funcion, *args, **kwargs):
+        """
+        Encola un trabajo en el carril prioritario: lo toma el siguiente worker libre antes que
+        cualquier trabajo normal, o un trabajo largo en curso entre dos de sus lotes
+
+        Args:
+            funcion (callable): Trabajo a ejecutar, como en enviar
+
+        Returns:
+            Future: Resultado del trabajo
+
+        Raises:
+            ServicioSaturado: Si la cola de trabajos prioritarios está llena
+        """
+        return self._encolar(self.prioritarios, funcion, args, kwargs)
+
+    def atender_prioritarios(self, detector):
+        """
+        Ejecuta en el hilo actual los trabajos prioritarios en espera. Lo llaman los trabajos
+        largos entre sus lotes, con el detector de su worker, para que una petición de imagen no
+        espere a que termine un video
+
+        Args:
+            detector (DetectorVideoYOLO): Detector del worker que ejecuta el trabajo largo
+        """
+        while True:
+            with self.condicion:
+                if not self.prioritarios:
+                    return
+                trabajo = self.prioritarios.popleft()
+            self._ejecutar(detector, trabajo)
+
+    def ejecutar(self, funcion, *args, timeout=None, **kwargs):
+        """
+        Ejecuta un trabajo en el carril prioritario y espera su resultado sin bloquear más de
+        timeout segundos.
+
+        El timeout limita la espera del llamador, no el trabajo: si vence mientras el trabajo
+        sigue en la cola, se cancela y no llega a ejecutarse; si ya había empezado, no se puede
+        interrumpir y termina en su worker, que sigue ocupado hasta entonces, y su resultado se
+        descarta. Los trabajos largos que deban detenerse al vencer el timeout tienen que
+        comprobar por su cuenta una señal de cancelación
+
+        Args:
+            funcion (callable): Trabajo a ejecutar, como en enviar
+            timeout (float): Segundos máximos de espera, contando el tiempo en la cola; si es None,
+                espera sin límite
+
+        Returns:
+            Resultado del trabajo
+
+        Raises:
+            ServicioSaturado: Si la cola de trabajos prioritarios está llena o el trabajo no termina a tiempo
+        """
+        futuro = self.enviar_prioritario(funcion, *args, **kwargs)
+        try:
+            return futuro.result(timeout=timeout)
+        except TiempoAgotado:
+            # Un trabajo que aún espera en la cola ya no se ejecuta
+            futuro.cancel()
+            raise ServicioSaturado(f"El trabajo no terminó en {timeout} segundos")
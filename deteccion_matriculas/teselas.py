@@ -0,0 +1,144 @@
+import cv2
+import numpy as np
+
+
+def posiciones_teselas(longitud, tamano, paso):
+    """
+    Calcula el inicio de las teselas a lo largo de un eje; la última se alinea con el borde
+    para que todas tengan el mismo tamaño
+
+    Args:
+        longitud (int): Longitud del eje en píxeles
+        tamano (int): Tamaño de la tesela
+        paso (int): Distancia entre el inicio de dos teselas consecutivas
+
+    Returns:
+        list: Inicio de cada tesela
+    """
+    if longitud <= tamano:
+        return [0]
+    posiciones = list(range(0, longitud - tamano, paso))
+    return posiciones + [longitud - tamano]
+
+
+def nms_cajas(cajas, confianzas, umbral=0.5):
+    """
+    Supresión de no máximos entre las detecciones de todas las teselas de un frame. El solape se
+    mide sobre el área de la caja menor y cada caja conservada se amplía a la unión de las que
+    suprime, para que el trozo de matrícula cortado por el borde de una tesela y la matrícula
+    completa de la tesela vecina queden en una sola caja que cubre toda la matrícula
+
+    Args:
+        cajas (np.ndarray): Cajas (N, 4) en formato x1, y1, x2, y2
+        confianzas (np.ndarray): Confianzas (N,)
+        umbral (float): Solape a partir del cual dos cajas se fusionan
+
+    Returns:
+        tuple: Cajas (M, 4) fusionadas y su confianza máxima (M,), por confianza descendente
+    """
+    orden = np.argsort(-confianzas)
+    areas = (cajas[:, 2] - cajas[:, 0]) * (cajas[:, 3] - cajas[:, 1])
+    fusionadas = []
+    confianzas_fusionadas = []
+    while len(orden):
+        i, orden = orden[0], orden[1:]
+        ancho = (np.minimum(cajas[i, 2], cajas[orden, 2]) - np.maximum(cajas[i, 0], cajas[orden, 0])).clip(0)
+        alto = (np.minimum(cajas[i, 3], cajas[orden, 3]) - np.maximum(cajas[i, 1], cajas[orden, 1])).clip(0)
+        solape = ancho * alto / np.maximum(np.minimum(areas[i], areas[orden]), 1e-6)
+        grupo = np.concatenate(([i], orden[solape > umbral]))
+        fusionadas.append(np.concatenate((cajas[grupo, :2].min(0), cajas[grupo, 2:].max(0))))
+        confianzas_fusionadas.append(confianzas[i])
+        orden = orden[solape <= umbral]
+    return (np.array(fusionadas, dtype=np.float32).reshape(-1, 4),
+            np.array(confianzas_fusionadas, dtype=np.float32))
+
+
+class InferenciaTeselas:
+    def __init__(self, tamano=640, solape=0.2, roi=None, umbral_nms=0.5):
+        """
+        Divide los frames en teselas solapadas que se infieren a resolución nativa, para que las
+        matrículas de videos de alta resolución no queden de pocos píxeles al reducir el frame
+
+        Args:
+            tamano (int): Lado de las teselas en píxeles. Si es None, no se tesela y solo se
+                recorta el rectángulo que contiene la región de interés
+            solape (float): Fracción de la tesela que se solapa con su vecina; debe cubrir el
+                ancho de una matrícula para que siempre aparezca completa en alguna tesela
+            roi (list): Polígono [(x, y), ...] con la región de interés (la calzada), en píxeles
+                del frame. Las teselas fuera de él no se infieren y se descartan las detecciones
+                cuyo centro cae fuera (opcional)
+            umbral_nms (float): Solape para fusionar las detecciones de teselas vecinas
+        """
+        if not 0 <= solape < 1:
+            raise ValueError(f"solape debe estar en [0, 1): {solape}")
+
+        self.tamano = tamano
+        self.solape = solape
+        self.roi = None if roi is None else np.array(roi, dtype=np.int32).reshape(-1, 2)
+        self.umbral_nms = umbral_nms
+        # Ventanas y máscara de la región de interés por tamaño de frame
+        self.ventanas = {}
+
+    def _ventanas(self, alto, ancho):
+        if (alto, ancho) in self.ventanas:
+            return self.ventanas[alto, ancho]
+
+        mascara = None
+        x0, y0, x1, y1 = 0, 0, ancho, alto
+        if self.roi is not None:
+            mascara = np.zeros((alto, ancho), dtype=np.uint8)
+            cv2.fillPoly(mascara, [self.roi], 1)
+            x, y, w, h = cv2.boundingRect(self.roi)
+            x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, ancho), min(y + h, alto)
+
+        if self.tamano is None:
+            ventanas = [(x0, y0, x1, y1)]
+        else:
+            paso = max(int(self.tamano * (1 - self.solape)), 1)
+            ventanas = [(x0 + x, y0 + y, min(x0 + x + self.tamano, x1), min(y0 + y + self.tamano, y1))
+                        for y in posiciones_teselas(y1 - y0, self.tamano, paso)
+                        for x in posiciones_teselas(x1 - x0, self.tamano, paso)]
+            # Las teselas que no tocan la región de interés no se infieren
+            if mascara is not None:
+                ventanas = [(a, b, c, d) for a, b, c, d in ventanas if mascara[b:d, a:c].any()]
+
+        self.ventanas[alto, ancho] = (ventanas, mascara)
+        return ventanas, mascara
+
+    def recortes(self, frame):
+        """
+        Args:
+            frame (np.ndarray): Frame BGR
+
+        Returns:
+            list: Teselas del frame, vistas sin copia en el orden de sus ventanas
+        """
+        ventanas, _ = self._ventanas(*frame.shape[:2])
+        return [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in ventanas]
+
+    def fusionar(self, frame, detecciones):
+        """
+        Lleva las detecciones de cada tesela a coordenadas del frame y fusiona las repetidas
+
+        Args:
+            frame (np.ndarray): Frame BGR del que salieron las teselas
+            detecciones (list): Cajas (N, 4) y confianzas (N,) de cada tesela, en coordenadas de la tesela
+
+        Returns:
+            tuple: Cajas (M, 4) y confianzas (M,) en coordenadas del frame
+        """
+        ventanas, mascara = self._ventanas(*frame.shape[:2])
+        cajas = [c + np.array(v[:2] * 2, dtype=np.float32) for (c, _), v in zip(detecciones, ventanas)]
+        cajas = np.concatenate(cajas).reshape(-1, 4) if cajas else np.zeros((0, 4), dtype=np.float32)
+        confianzas = np.concatenate([c for _, c in detecciones]) if detecciones else np.zeros(0, dtype=np.float32)
+
+        # Descartar las detecciones con el centro fuera de la región de interés
+        if mascara is not None and len(cajas):
+            cx = ((cajas[:, 0] + cajas[:, 2]) / 2).astype(int).clip(0, mascara.shape[1] - 1)
+            cy = ((cajas[:, 1] + cajas[:, 3]) / 2).astype(int).clip(0, mascara.shape[0] - 1)
+            dentro = mascara[cy, cx] > 0
+            cajas, confianzas = cajas[dentro], confianzas[dentro]
+
+        if len(ventanas) > 1 and len(cajas) > 1:
+            cajas, confianzas = nms_cajas(cajas, confianzas, self.umbral_nms)
+        return cajas, confianzas
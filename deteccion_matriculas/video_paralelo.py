@@ -0,0 +1,360 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+
+import cv2
+import torch
+
+from anonimizador import Anonimizador, METODOS
+from detector_video_yolo import DetectorVideoYOLO
+
+# Detector del proceso worker; cada proceso carga su propio modelo una sola vez
+detector_worker = None
+
+
+def fotogramas_clave(video_path, fps):
+    """
+    Lee las posiciones de los fotogramas clave del video con ffprobe, sin decodificarlo
+
+    Args:
+        video_path (str): Ruta del video
+        fps (float): Frames por segundo del video
+
+    Returns:
+        list: Índices de los fotogramas clave en orden; vacía si ffprobe no está disponible
+    """
+    comando = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path]
+    try:
+        salida = subprocess.run(comando, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    paquetes = []
+    for linea in salida.splitlines():
+        pts, _, flags = linea.partition(',')
+        if pts and pts != 'N/A':
+            paquetes.append((float(pts), 'K' in flags))
+    if not paquetes:
+        return []
+    # Los paquetes van en orden de decodificación; el primer frame es el de menor pts
+    inicio = min(pts for pts, _ in paquetes)
+    return sorted({round((pts - inicio) * fps) for pts, clave in paquetes if clave})
+
+
+def dividir_en_trozos(claves, total_frames, num_trozos):
+    """
+    Divide un video en trozos de tamaño parecido que empiezan en fotogramas clave, para que cada
+    worker salte a su inicio sin decodificar desde el anterior fotograma clave
+
+    Args:
+        claves (list): Índices de los fotogramas clave; si está vacía, los cortes son equidistantes
+        total_frames (int): Frames del video
+        num_trozos (int): Número de trozos deseado; puede haber menos si hay pocos fotogramas clave
+
+    Returns:
+        list: Rangos (inicio, fin) de cada trozo, fin excluido
+    """
+    candidatos = [clave for clave in claves if 0 < clave < total_frames]
+    cortes = set()
+    for k in range(1, num_trozos):
+        ideal = k * total_frames / num_trozos
+        if candidatos:
+            cortes.add(min(candidatos, key=lambda clave: abs(clave - ideal)))
+        else:
+            cortes.add(int(ideal))
+    limites = [0] + sorted(corte for corte in cortes if 0 < corte < total_frames) + [total_frames]
+    return list(zip(limites[:-1], limites[1:]))
+
+
+def concatenar_segmentos(segmentos, salida_path, audio_path=None):
+    """
+    Une los segmentos con el demuxer concat de FFmpeg copiando el video, sin recodificarlo,
+    y añade la pista de audio del video original
+
+    Args:
+        segmentos (list): Rutas de los segmentos en orden, todos con los mismos parámetros de codificación
+        salida_path (str): Ruta del video de salida
+        audio_path (str): Video del que copiar la pista de audio, si la tiene (opcional)
+
+    Raises:
+        subprocess.CalledProcessError: Si FFmpeg termina con error
+    """
+    lista_path = os.path.join(os.path.dirname(segmentos[0]), 'segmentos.txt')
+    with open(lista_path, 'w') as f:
+        for segmento in segmentos:
+            ruta = os.path.abspath(segmento).replace("'", "'\\''")
+            f.write(f"file '{ruta}'\n")
+
+    comando = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', lista_path]
+    if audio_path:
+        comando += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0?']  # El audio es opcional
+    comando += ['-c:v', 'copy', '-c:a', 'aac', '-shortest', '-movflags', '+faststart', salida_path]
+    subprocess.run(comando, capture_output=True, check=True)
+
+
+def verificar_segmentos(segmentos, rangos):
+    """
+    Comprueba que cada trozo dejó su segmento con todos sus frames antes de unirlos, para que
+    un trozo fallido no deje un hueco en el video final
+
+    Args:
+        segmentos (list): Rutas de los segmentos en orden
+        rangos (list): Rangos (inicio, fin) de cada trozo, fin excluido
+
+    Raises:
+        RuntimeError: Si falta un segmento o no tiene los frames de su trozo
+    """
+    for segmento, (inicio, fin) in zip(segmentos, rangos):
+        if not os.path.exists(segmento):
+            raise RuntimeError(f"Falta el segmento de los frames {inicio}-{fin}: {segmento}")
+        cap = cv2.VideoCapture(segmento)
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+        cap.release()
+        if frames != fin - inicio:
+            raise RuntimeError(f"El segmento de los frames {inicio}-{fin} tiene {frames} frames, "
+                               f"se esperaban {fin - inicio}: {segmento}")
+
+
+def iniciar_worker(modelo_path, hilos):
+    # Limitar los hilos de PyTorch y OpenCV para que los procesos no compitan por los mismos núcleos
+    global detector_worker
+    torch.set_num_threads(hilos)
+    cv2.setNumThreads(hilos)
+    detector_worker = DetectorVideoYOLO(modelo_path)
+
+
+def procesar_trozo(indice, video_path, rango, segmento_path, opciones, cola, cancelar):
+    def progress_callback(datos):
+        cola.put((indice, datos))
+
+    return detector_worker.detectar_matriculas_video(
+        video_path,
+        salida_path=segmento_path,
+        mostrar_video=False,
+        progress_callback=progress_callback,
+        cancelar=cancelar,
+        rango=rango,
+        **opciones
+    )
+
+
+def combinar_progreso(progresos, video_info, procesos):
+    """
+    Combina el último progreso de cada trozo en un solo payload con el formato de
+    detectar_matriculas_video
+
+    Args:
+        progresos (dict): Último payload de progreso de cada trozo
+        video_info (dict): Información del video completo
+        procesos (int): Número de procesos
+
+    Returns:
+        dict: Payload de progreso del video completo
+    """
+    frame_actual = sum(datos.get('current_frame', 0) for datos in progresos.values())
+    # Las estadísticas de frames de cada trozo se suman
+    estadisticas = {}
+    for datos in progresos.values():
+        for clave, valor in datos.items():
+            if clave.startswith('frames_'):
+                estadisticas[clave] = estadisticas.get(clave, 0) + valor
+    if 'frames_detectados' in estadisticas:
+        estadisticas['ratio_detectados'] = estadisticas['frames_detectados'] / frame_actual if frame_actual else 0.0
+
+    total_frames = video_info['total_frames']
+    progress = (frame_actual / total_frames) * 100 if total_frames else 0.0
+    return {
+        **video_info,
+        **estadisticas,
+        'current_frame': frame_actual,
+        'progress': progress,
+        'status': 'procesando',
+        'trozos_completados': sum(datos.get('status') == 'completado' for datos in progresos.values()),
+        'message': f'Procesando en {procesos} procesos: {progress:.1f}% - Frame {frame_actual}/{total_frames}'
+    }
+
+
+def procesar_video_paralelo(video_path, salida_path, modelo_path=None, procesos=None, hilos=None,
+                            trozos_por_proceso=2, progress_callback=None, cancelar=None, **opciones):
+    """
+    Procesa un video largo en paralelo: lo divide en trozos que empiezan en fotogramas clave,
+    los procesa en un pool de procesos con un modelo por proceso y une los segmentos codificados
+    sin recodificarlos
+
+    Args:
+        video_path (str): Ruta al video de entrada
+        salida_path (str): Ruta del video de salida
+        modelo_path (str): Ruta al modelo YOLO. Si es None, usa el modelo por defecto
+        procesos (int): Procesos del pool; por defecto, uno por núcleo
+        hilos (int): Hilos de PyTorch y OpenCV por proceso; por defecto, los núcleos repartidos
+            entre los procesos
+        trozos_por_proceso (int): Trozos por proceso; más de uno reparte mejor la carga cuando
+            unos trozos tienen más matrículas que otros
+        progress_callback (callable): Función de callback que recibe el progreso combinado de
+            todos los procesos
+        cancelar (threading.Event): Si se activa, detiene todos los procesos y descarta el video
+        **opciones: Resto de parámetros de DetectorVideoYOLO.detectar_matriculas_video (difuminar,
+            confianza, batch_size, detectar_cada, umbral_estatico, teselas, cascada, anonimizador).
+            El estado de la cascada, el seguimiento y el filtro de frames estáticos empieza de cero
+            en cada trozo
+
+    Returns:
+        bool: Si se encontró alguna matrícula; False también si se canceló
+
+    Raises:
+        RuntimeError: Si un trozo no dejó su segmento completo
+    """
+    nucleos = os.cpu_count() or 1
+    procesos = procesos or nucleos
+    hilos = hilos or max(1, nucleos // procesos)
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"No se pudo abrir el video: {video_path}")
+    fps_exacto = cap.get(cv2.CAP_PROP_FPS)
+    video_info = {
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        'fps': int(fps_exacto),
+        'total_frames': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+        'current_frame': 0,
+        'progress': 0.0,
+        'status': 'procesando'
+    }
+    cap.release()
+
+    rangos = dividir_en_trozos(fotogramas_clave(video_path, fps_exacto), video_info['total_frames'],
+                               procesos * trozos_por_proceso)
+    print(f"Video: {video_info['width']}x{video_info['height']}, {video_info['total_frames']} frames "
+          f"en {len(rangos)} trozos, {procesos} procesos de {hilos} hilos")
+    if progress_callback:
+        progress_callback({
+            **video_info,
+            'message': f'Video dividido en {len(rangos)} trozos para {procesos} procesos',
+            'status': 'iniciando'
+        })
+
+    # Los segmentos se escriben junto a la salida para que la unión no cruce sistemas de archivos
+    carpeta = tempfile.mkdtemp(prefix='trozos_', dir=os.path.dirname(os.path.abspath(salida_path)))
+    segmentos = [os.path.join(carpeta, f'trozo_{i:04d}.mp4') for i in range(len(rangos))]
+    # spawn: PyTorch no admite fork con hilos ya creados
+    contexto = multiprocessing.get_context('spawn')
+    try:
+        with contexto.Manager() as manager, ProcessPoolExecutor(
+                procesos, mp_context=contexto, initializer=iniciar_worker, initargs=(modelo_path, hilos)) as pool:
+            cola = manager.Queue()
+            cancelar_workers = manager.Event()
+            futuros = [pool.submit(procesar_trozo, i, video_path, rango, segmento, opciones, cola, cancelar_workers)
+                       for i, (rango, segmento) in enumerate(zip(rangos, segmentos))]
+
+            progresos = {}
+            pendientes = futuros
+            while pendientes:
+                _, pendientes = wait(pendientes, timeout=0.5, return_when=FIRST_EXCEPTION)
+                if cancelar is not None and cancelar.is_set():
+                    cancelar_workers.set()
+
+                # Un error en un trozo detiene los demás
+                if any(futuro.done() and futuro.exception() is not None for futuro in futuros):
+                    cancelar_workers.set()
+                    break
+
+                actualizado = False
+                while not cola.empty():
+                    indice, datos = cola.get()
+                    progresos[indice] = datos
+                    actualizado = True
+                if actualizado and progress_callback and not cancelar_workers.is_set():
+                    progress_callback(combinar_progreso(progresos, video_info, procesos))
+
+            # Propagar el primer error de un worker
+            resultados = [futuro.result() for futuro in futuros]
+            cancelado = cancelar_workers.is_set()
+
+        if cancelado:
+            print("Procesamiento cancelado")
+            if progress_callback:
+                progress_callback({
+                    **combinar_progreso(progresos, video_info, procesos),
+                    'status': 'cancelado',
+                    'message': 'Procesamiento cancelado.'
+                })
+            return False
+
+        verificar_segmentos(segmentos, rangos)
+        concatenar_segmentos(segmentos, salida_path, audio_path=video_path)
+    finally:
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+    hay_matriculas = any(resultados)
+    print(f"Procesamiento completado en {len(rangos)} trozos. Video guardado en: {salida_path}")
+    if progress_callback:
+        progress_callback({
+            **combinar_progreso(progresos, video_info, procesos),
+            'current_frame': video_info['total_frames'],
+            'progress': 100.0,
+            'status': 'completado',
+            'message': 'Procesamiento completado.'
+        })
+    return hay_matriculas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Detector de matrículas en paralelo para videos largos')
+    parser.add_argument('--video', type=str, required=True, help='Ruta al video de entrada')
+    parser.add_argument('--salida', type=str, required=True, help='Ruta del video de salida')
+    parser.add_argument('--modelo', type=str, help='Ruta al modelo YOLO personalizado')
+    parser.add_argument('--procesos', type=int, default=os.cpu_count() or 1,
+                        help='Procesos en paralelo (default: uno por núcleo)')
+    parser.add_argument('--hilos', type=int, help='Hilos por proceso (default: núcleos / procesos)')
+    parser.add_argument('--difuminar', action='store_true', help='Difuminar matrículas detectadas')
+    parser.add_argument('--anonimizado', type=str, default='caja', choices=METODOS,
+                        help='Cómo ocultar las matrículas con --difuminar (default: caja)')
+    parser.add_argument('--fuerza', type=float, default=1.0,
+                        help='Intensidad del anonimizado, al menos 1.0 (default: 1.0)')
+    parser.add_argument('--confianza', type=float, default=0.5, help='Umbral de confianza (default: 0.5)')
+    parser.add_argument('--batch', type=int, default=1, help='Frames por llamada al modelo (default: 1)')
+    parser.add_argument('--detectar-cada', type=int, default=1,
+                        help='Detectar cada N frames y seguir las cajas en el resto (default: 1)')
+    parser.add_argument('--umbral-estatico', type=float, default=0.0,
+                        help='Reutilizar las detecciones de los frames con una diferencia máxima de gris '
+                             'menor que este umbral (default: 0, desactivado)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Medir el tiempo con 1, 2, ... hasta --procesos procesos')
+
+    args = parser.parse_args()
+
+    opciones = {
+        'difuminar': args.difuminar,
+        'confianza': args.confianza,
+        'batch_size': args.batch,
+        'detectar_cada': args.detectar_cada,
+        'umbral_estatico': args.umbral_estatico,
+        'anonimizador': Anonimizador(args.anonimizado, fuerza=args.fuerza)
+    }
+
+    if not args.benchmark:
+        procesar_video_paralelo(args.video, args.salida, modelo_path=args.modelo, procesos=args.procesos,
+                                hilos=args.hilos, **opciones)
+        return
+
+    # Escalado del tiempo de pared con el número de procesos; los hilos se reparten entre ellos
+    tiempos = {}
+    for procesos in range(1, args.procesos + 1):
+        inicio = time.perf_counter()
+        procesar_video_paralelo(args.video, args.salida, modelo_path=args.modelo, procesos=procesos,
+                                hilos=args.hilos, **opciones)
+        tiempos[procesos] = time.perf_counter() - inicio
+    print("procesos  segundos  aceleración")
+    for procesos, segundos in tiempos.items():
+        print(f"{procesos:8d}  {segundos:8.1f}  {tiempos[1] / segundos:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@ from utils.datasets import *
 import os
 import sys
 import argparse
+import queue
+import threading
+import time
 import cv2
 from PIL import Image
 import torch
@@ -35,6 +38,163 @@ def Convertir_BGR(img):
 
 
 
+def Preprocesar(frame, img_size, Tensor):
+    #LA imagen viene en Blue, Green, Red y la convertimos a RGB que es la entrada que requiere el modelo
+    RGBimg = Convertir_RGB(frame)
+    imgTensor = transforms.ToTensor()(RGBimg)
+    imgTensor, _ = pad_to_square(imgTensor, 0)
+    imgTensor = resize(imgTensor, img_size)
+    imgTensor = imgTensor.unsqueeze(0)
+    return Variable(imgTensor.type(Tensor))
+
+
+def Detectar(model, imgTensor, conf_thres, nms_thres):
+    with torch.no_grad():
+        detections = model(imgTensor)
+        return non_max_suppression(detections, conf_thres, nms_thres)
+
+
+def Dibujar_detecciones(frame, detections, img_size, classes, colors):
+    for detection in detections:
+        if detection is not None:
+            detection = rescale_boxes(detection, img_size, frame.shape[:2])
+            for x1, y1, x2, y2, conf, cls_conf, cls_pred in detection:
+                box_w = x2 - x1
+                box_h = y2 - y1
+                color = [int(c) for c in colors[int(cls_pred)]]
+                print("Se detectó {} en X1: {}, Y1: {}, X2: {}, Y2: {}".format(classes[int(cls_pred)], x1, y1, x2, y2))
+                frame = cv2.rectangle(frame, (x1, y1 + box_h), (x2, y1), color, 5)
+                cv2.putText(frame, classes[int(cls_pred)], (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 5)# Nombre de la clase detectada
+                cv2.putText(frame, str("%.2f" % float(conf)), (x2, y2 - box_h), cv2.FONT_HERSHEY_SIMPLEX, 0.5,color, 5) # Certeza de prediccion de la clase
+    #Convertimos de vuelta a BGR para que cv2 pueda desplegarlo en los colores correctos
+    return Convertir_BGR(frame)
+
+
+# Marca de fin de video que recorre todas las colas del pipeline
+FIN_PIPELINE = object()
+
+
+def Poner_en_cola(cola, item, detener):
+    # Bloquea mientras la cola esté llena (backpressure) salvo que se pida detener el pipeline
+    while not detener.is_set():
+        try:
+            cola.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def Sacar_de_cola(cola, detener):
+    while not detener.is_set():
+        try:
+            return cola.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return FIN_PIPELINE
+
+
+class EtapaPipeline(threading.Thread):
+    """Hilo que ejecuta una etapa del pipeline entre dos colas acotadas y mide su rendimiento"""
+
+    def __init__(self, nombre, funcion, entrada, salida, detener):
+        super(EtapaPipeline, self).__init__(name=nombre, daemon=True)
+        self.nombre = nombre
+        self.funcion = funcion
+        self.entrada = entrada
+        self.salida = salida
+        self.detener = detener
+        self.frames = 0
+        self.tiempo = 0.0
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.detener.is_set():
+                # La etapa de decodificación no tiene cola de entrada, produce los frames ella misma
+                item = None if self.entrada is None else Sacar_de_cola(self.entrada, self.detener)
+                if item is FIN_PIPELINE:
+                    break
+                inicio = time.perf_counter()
+                resultado = self.funcion(item)
+                self.tiempo += time.perf_counter() - inicio
+                if resultado is FIN_PIPELINE:
+                    break
+                self.frames += 1
+                Poner_en_cola(self.salida, resultado, self.detener)
+        except Exception as e:
+            self.error = e
+            self.detener.set()
+        Poner_en_cola(self.salida, FIN_PIPELINE, self.detener)
+
+
+def Procesar_pipeline(cap, out, model, opt, Tensor, classes, colors):
+    """
+    Procesa el video con las etapas decodificar / preprocesar / inferir / anotar / codificar
+    en hilos separados. Cada etapa es un único hilo y las colas son FIFO, por lo que el orden
+    de los frames se mantiene, y las colas acotadas limitan la memoria usada.
+    """
+    detener = threading.Event()
+    colas = [queue.Queue(maxsize=opt.queue_size) for _ in range(4)]
+
+    def decodificar(_):
+        ret, frame = cap.read()
+        if ret is False:
+            return FIN_PIPELINE
+        return cv2.resize(frame, (1280, 960), interpolation=cv2.INTER_CUBIC)
+
+    def preprocesar(frame):
+        return frame, Preprocesar(frame, opt.img_size, Tensor)
+
+    def inferir(item):
+        frame, imgTensor = item
+        return frame, Detectar(model, imgTensor, opt.conf_thres, opt.nms_thres)
+
+    def anotar(item):
+        frame, detections = item
+        return Dibujar_detecciones(frame, detections, opt.img_size, classes, colors)
+
+    etapas = [
+        EtapaPipeline("decodificar", decodificar, None, colas[0], detener),
+        EtapaPipeline("preprocesar", preprocesar, colas[0], colas[1], detener),
+        EtapaPipeline("inferir", inferir, colas[1], colas[2], detener),
+        EtapaPipeline("anotar", anotar, colas[2], colas[3], detener),
+    ]
+    inicio = time.perf_counter()
+    for etapa in etapas:
+        etapa.start()
+
+    # La codificación y la ventana de cv2 se quedan en el hilo principal
+    frames_codificados, tiempo_codificar = 0, 0.0
+    while True:
+        frame = Sacar_de_cola(colas[-1], detener)
+        if frame is FIN_PIPELINE:
+            break
+        inicio_codificar = time.perf_counter()
+        out.write(frame)
+        tiempo_codificar += time.perf_counter() - inicio_codificar
+        frames_codificados += 1
+        cv2.imshow('frame', frame)
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            detener.set()
+
+    detener.set()
+    for etapa in etapas:
+        etapa.join()
+    tiempo_total = time.perf_counter() - inicio
+
+    # Rendimiento de cada etapa: frames por segundo de tiempo ocupado
+    print("\nEtapa          Frames    FPS")
+    for nombre, frames, tiempo in [(e.nombre, e.frames, e.tiempo) for e in etapas] + [
+        ("codificar", frames_codificados, tiempo_codificar)
+    ]:
+        print("%-12s %8d %8.2f" % (nombre, frames, frames / max(tiempo, 1e-9)))
+    print("%-12s %8d %8.2f" % ("total", frames_codificados, frames_codificados / max(tiempo_total, 1e-9)))
+
+    for etapa in etapas:
+        if etapa.error is not None:
+            raise etapa.error
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--image_folder", type=str, default="data/samples", help="path to dataset")
@@ -49,6 +209,8 @@ if __name__ == "__main__":
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
     parser.add_argument("--directorio_video", type=str, help="Directorio al video")
     parser.add_argument("--checkpoint_model", type=str, help="path to checkpoint model")
+    parser.add_argument("--pipeline", action="store_true", help="run decode/preprocess/infer/annotate/encode in parallel threads and report the throughput of each stage")
+    parser.add_argument("--queue_size", type=int, default=4, help="max frames waiting between two pipeline stages")
     opt = parser.parse_args()
     print(opt)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -61,7 +223,7 @@ if __name__ == "__main__":
     else:
         model.load_state_dict(torch.load(opt.weights_path))
 
-    model.eval()  
+    model.fuse()  # Une las batch norm con las convoluciones y pasa a modo evaluación
     classes = load_classes(opt.class_path)
     Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
     if opt.webcam==1:
@@ -73,46 +235,19 @@ if __name__ == "__main__":
         # frame_height = int(cap.get(4))
         out = cv2.VideoWriter('outp.mp4',cv2.VideoWriter_fourcc('M','J','P','G'), 10, (1280,960))
     colors = np.random.randint(0, 255, size=(len(classes), 3), dtype="uint8")
-    a=[]
-    while cap:
+    if opt.pipeline:
+        Procesar_pipeline(cap, out, model, opt, Tensor, classes, colors)
+    while cap and not opt.pipeline:
         ret, frame = cap.read()
         if ret is False:
             break
         frame = cv2.resize(frame, (1280, 960), interpolation=cv2.INTER_CUBIC)
-        #LA imagen viene en Blue, Green, Red y la convertimos a RGB que es la entrada que requiere el modelo
-        RGBimg=Convertir_RGB(frame)
-        imgTensor = transforms.ToTensor()(RGBimg)
-        imgTensor, _ = pad_to_square(imgTensor, 0)
-        imgTensor = resize(imgTensor, 416)
-        imgTensor = imgTensor.unsqueeze(0)
-        imgTensor = Variable(imgTensor.type(Tensor))
-
-
-        with torch.no_grad():
-            detections = model(imgTensor)
-            detections = non_max_suppression(detections, opt.conf_thres, opt.nms_thres)
-
-
-        for detection in detections:
-            if detection is not None:
-                detection = rescale_boxes(detection, opt.img_size, RGBimg.shape[:2])
-                for x1, y1, x2, y2, conf, cls_conf, cls_pred in detection:
-                    box_w = x2 - x1
-                    box_h = y2 - y1
-                    color = [int(c) for c in colors[int(cls_pred)]]
-                    print("Se detectó {} en X1: {}, Y1: {}, X2: {}, Y2: {}".format(classes[int(cls_pred)], x1, y1, x2, y2))
-                    frame = cv2.rectangle(frame, (x1, y1 + box_h), (x2, y1), color, 5)
-                    cv2.putText(frame, classes[int(cls_pred)], (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 5)# Nombre de la clase detectada
-                    cv2.putText(frame, str("%.2f" % float(conf)), (x2, y2 - box_h), cv2.FONT_HERSHEY_SIMPLEX, 0.5,color, 5) # Certeza de prediccion de la clase
-        #
-        #Convertimos de vuelta a BGR para que cv2 pueda desplegarlo en los colores correctos
-        
-        if opt.webcam==1:
-            cv2.imshow('frame', Convertir_BGR(RGBimg))
-            out.write(RGBimg)
-        else:
-            out.write(Convertir_BGR(RGBimg))
-            cv2.imshow('frame', RGBimg)
+        imgTensor = Preprocesar(frame, opt.img_size, Tensor)
+        detections = Detectar(model, imgTensor, opt.conf_thres, opt.nms_thres)
+        frame = Dibujar_detecciones(frame, detections, opt.img_size, classes, colors)
+
+        out.write(frame)
+        cv2.imshow('frame', frame)
         #cv2.waitKey(0)
 
         if cv2.waitKey(25) & 0xFF == ord('q'):
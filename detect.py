@@ -33,6 +33,7 @@ if __name__ == "__main__":
     parser.add_argument("--n_cpu", type=int, default=1, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
     parser.add_argument("--checkpoint_model", type=str, help="path to checkpoint model")
+    parser.add_argument("--rect", action="store_true", help="letterbox batches of similar aspect ratio to rectangles")
     opt = parser.parse_args()
     print(opt)
 
@@ -50,14 +51,16 @@ if __name__ == "__main__":
         # Load checkpoint weights
         model.load_state_dict(torch.load(opt.weights_path))
 
-    model.eval()  # Set in evaluation mode
+    model.fuse()  # Fold batch norm into the convolutions and set in evaluation mode
 
-    dataloader = DataLoader(
-        ImageFolder(opt.image_folder, img_size=opt.img_size),
-        batch_size=opt.batch_size,
-        shuffle=False,
-        num_workers=opt.n_cpu,
-    )
+    dataset = ImageFolder(opt.image_folder, img_size=opt.img_size)
+    if opt.rect:
+        # Batches of similar aspect ratio letterboxed to rectangular shapes instead of squares
+        batch_sampler = AspectRatioBatchSampler(image_aspect_ratios(dataset.files), opt.batch_size, opt.img_size)
+        dataset.shapes = batch_sampler.shapes
+        dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=opt.n_cpu)
+    else:
+        dataloader = DataLoader(dataset, batch_size=opt.batch_size, shuffle=False, num_workers=opt.n_cpu)
 
     classes = load_classes(opt.class_path)  # Extracts class labels from file
 
@@ -65,9 +68,10 @@ if __name__ == "__main__":
 
     imgs = []  # Stores image paths
     img_detections = []  # Stores detections for each image index
+    input_shapes = []  # Stores the model input shape for each image index
 
     print("\nPerforming object detection:")
-    prev_time = time.time()
+    prev_time = start_time = time.time()
     for batch_i, (img_paths, input_imgs) in enumerate(dataloader):
         # Configure input
         print("INPUT_IMGS-----", input_imgs)
@@ -88,6 +92,9 @@ if __name__ == "__main__":
         # Save image and detections
         imgs.extend(img_paths)
         img_detections.extend(detections)
+        input_shapes.extend([tuple(input_imgs.shape[2:])] * len(img_paths))
+
+    print("\nImages/sec: %.2f" % (len(imgs) / (time.time() - start_time)))
 
     # Bounding-box colors
     cmap = plt.get_cmap("tab20b")
@@ -95,7 +102,7 @@ if __name__ == "__main__":
 
     print("\nSaving images:")
     # Iterate through images and save plot of detections
-    for img_i, (path, detections) in enumerate(zip(imgs, img_detections)):
+    for img_i, (path, detections, input_shape) in enumerate(zip(imgs, img_detections, input_shapes)):
 
         print("(%d) Image: '%s'" % (img_i, path))
 
@@ -108,7 +115,7 @@ if __name__ == "__main__":
         # Draw bounding boxes and labels of detections
         if detections is not None:
             # Rescale boxes to original image
-            detections = rescale_boxes(detections, opt.img_size, img.shape[:2])
+            detections = rescale_boxes(detections, input_shape if opt.rect else opt.img_size, img.shape[:2])
             unique_labels = detections[:, -1].cpu().unique()
             n_cls_preds = len(unique_labels)
             bbox_colors = random.sample(colors, n_cls_preds)
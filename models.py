@@ -1,5 +1,7 @@
 from __future__ import division
 
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,11 +9,14 @@ from torch.autograd import Variable
 import numpy as np
 
 from utils.parse_config import *
-from utils.utils import build_targets, to_cpu, non_max_suppression
+from utils.utils import build_targets, build_targets_layers, to_cpu, non_max_suppression
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 
+# Epsilon of every batch norm layer, also needed to write fused layers back as batch norm
+BN_EPS = 1e-5
+
 
 def create_modules(module_defs):
     """
@@ -40,7 +45,7 @@ def create_modules(module_defs):
                 ),
             )
             if bn:
-                modules.add_module(f"batch_norm_{module_i}", nn.BatchNorm2d(filters, momentum=0.9, eps=1e-5))
+                modules.add_module(f"batch_norm_{module_i}", nn.BatchNorm2d(filters, momentum=0.9, eps=BN_EPS))
             if module_def["activation"] == "leaky":
                 modules.add_module(f"leaky_{module_i}", nn.LeakyReLU(0.1))
 
@@ -83,6 +88,38 @@ def create_modules(module_defs):
     return hyperparams, module_list
 
 
+def compile_execution_plan(module_defs):
+    """
+    Resolves the inputs of every route and shortcut layer to absolute layer indices and computes
+    the liveness of every layer output. Returns one (type, inputs, release, save) step per layer:
+    'save' tells if the output is read again by a later layer and 'release' lists the outputs
+    whose last reader is this layer, so they can be freed right after it runs.
+    """
+    inputs = []
+    for i, module_def in enumerate(module_defs):
+        if module_def["type"] == "route":
+            layers = [int(x) for x in module_def["layers"].split(",")]
+            inputs.append(tuple(layer_i if layer_i >= 0 else i + layer_i for layer_i in layers))
+        elif module_def["type"] == "shortcut":
+            # The other operand of a shortcut is always the previous output
+            layer_i = int(module_def["from"])
+            inputs.append((layer_i if layer_i >= 0 else i + layer_i,))
+        else:
+            inputs.append(())
+
+    last_use = {}
+    for i, layer_inputs in enumerate(inputs):
+        for layer_i in layer_inputs:
+            last_use[layer_i] = i
+    release = [[] for _ in module_defs]
+    for layer_i, i in last_use.items():
+        release[i].append(layer_i)
+
+    return [
+        (module_def["type"], inputs[i], tuple(release[i]), i in last_use) for i, module_def in enumerate(module_defs)
+    ]
+
+
 class Upsample(nn.Module):
     """ nn.Upsample is deprecated """
 
@@ -119,54 +156,78 @@ class YOLOLayer(nn.Module):
         self.metrics = {}
         self.img_dim = img_dim
         self.grid_size = 0  # grid size
+        self.grid_cache = OrderedDict()  # (grid size, img dim, device, dtype) -> offsets
+        self.grid_cache_size = 8
 
-    def compute_grid_offsets(self, grid_size, cuda=True):
+    def compute_grid_offsets(self, grid_size, device, dtype=torch.float32):
         self.grid_size = grid_size
-        g = self.grid_size
-        FloatTensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
-        self.stride = self.img_dim / self.grid_size
-        # Calculate offsets for each grid
-        self.grid_x = torch.arange(g).repeat(g, 1).view([1, 1, g, g]).type(FloatTensor)
-        self.grid_y = torch.arange(g).repeat(g, 1).t().view([1, 1, g, g]).type(FloatTensor)
-        self.scaled_anchors = FloatTensor([(a_w / self.stride, a_h / self.stride) for a_w, a_h in self.anchors])
-        self.anchor_w = self.scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
-        self.anchor_h = self.scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
+        key = (grid_size, self.img_dim, device, dtype)
+        if key in self.grid_cache:
+            # Mark as most recently used
+            self.grid_cache.move_to_end(key)
+        else:
+            # Rectangular inputs give a (height, width) grid
+            g_h, g_w = grid_size if isinstance(grid_size, tuple) else (grid_size, grid_size)
+            stride = self.img_dim / g_h
+            # Calculate offsets for each grid, as (x, y) pairs
+            grid_y, grid_x = torch.meshgrid(
+                torch.arange(g_h, device=device, dtype=dtype),
+                torch.arange(g_w, device=device, dtype=dtype),
+                indexing="ij",
+            )
+            grid_xy = torch.stack((grid_x, grid_y), -1).view(1, 1, g_h, g_w, 2)
+            scaled_anchors = torch.tensor(
+                [(a_w / stride, a_h / stride) for a_w, a_h in self.anchors], device=device, dtype=dtype
+            )
+            anchor_wh = scaled_anchors.view(1, self.num_anchors, 1, 1, 2)
+            self.grid_cache[key] = (stride, grid_xy, scaled_anchors, anchor_wh)
+            # Evict the least recently used grid
+            if len(self.grid_cache) > self.grid_cache_size:
+                self.grid_cache.popitem(last=False)
+        self.stride, self.grid_xy, self.scaled_anchors, self.anchor_wh = self.grid_cache[key]
 
     def forward(self, x, targets=None, img_dim=None):
+        output, predictions = self.predict(x, img_dim)
+        if targets is None:
+            return output, 0
+        layer_targets = build_targets(
+            pred_boxes=predictions[6],
+            pred_cls=predictions[5],
+            target=targets,
+            anchors=self.scaled_anchors,
+            ignore_thres=self.ignore_thres,
+        )
+        return output, self.compute_loss(predictions, layer_targets)
 
-        # Tensors for cuda support
-        FloatTensor = torch.cuda.FloatTensor if x.is_cuda else torch.FloatTensor
-        LongTensor = torch.cuda.LongTensor if x.is_cuda else torch.LongTensor
-        ByteTensor = torch.cuda.ByteTensor if x.is_cuda else torch.ByteTensor
-
+    def predict(self, x, img_dim=None):
+        """
+        Returns the detections of the layer and the raw predictions the loss needs:
+        (x, y, w, h, pred_conf, pred_cls, pred_boxes)
+        """
         self.img_dim = img_dim
         num_samples = x.size(0)
         grid_size = x.size(2)
+        grid_w = x.size(3)
 
         prediction = (
-            x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_size, grid_size)
+            x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_size, grid_w)
             .permute(0, 1, 3, 4, 2)
             .contiguous()
         )
 
         # Get outputs
-        x = torch.sigmoid(prediction[..., 0])  # Center x
-        y = torch.sigmoid(prediction[..., 1])  # Center y
-        w = prediction[..., 2]  # Width
-        h = prediction[..., 3]  # Height
+        xy = torch.sigmoid(prediction[..., 0:2])  # Center x, y
+        wh = prediction[..., 2:4]  # Width, height
+        x, y = xy[..., 0], xy[..., 1]
+        w, h = wh[..., 0], wh[..., 1]
         pred_conf = torch.sigmoid(prediction[..., 4])  # Conf
         pred_cls = torch.sigmoid(prediction[..., 5:])  # Cls pred.
 
-        # If grid size does not match current we compute new offsets
-        if grid_size != self.grid_size:
-            self.compute_grid_offsets(grid_size, cuda=x.is_cuda)
+        # Get the (cached) offsets for the current grid size, device and type
+        self.compute_grid_offsets(grid_size if grid_w == grid_size else (grid_size, grid_w), x.device, x.dtype)
 
         # Add offset and scale with anchors
-        pred_boxes = FloatTensor(prediction[..., :4].shape)
-        pred_boxes[..., 0] = x.data + self.grid_x
-        pred_boxes[..., 1] = y.data + self.grid_y
-        pred_boxes[..., 2] = torch.exp(w.data) * self.anchor_w
-        pred_boxes[..., 3] = torch.exp(h.data) * self.anchor_h
+        pred_boxes = torch.cat((xy.detach() + self.grid_xy, torch.exp(wh.detach()) * self.anchor_wh), -1)
 
         output = torch.cat(
             (
@@ -177,58 +238,73 @@ class YOLOLayer(nn.Module):
             -1,
         )
 
-        if targets is None:
-            return output, 0
-        else:
-            iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf = build_targets(
-                pred_boxes=pred_boxes,
-                pred_cls=pred_cls,
-                target=targets,
-                anchors=self.scaled_anchors,
-                ignore_thres=self.ignore_thres,
-            )
-
-            # Loss : Mask outputs to ignore non-existing objects (except with conf. loss)
-            loss_x = self.mse_loss(x[obj_mask], tx[obj_mask])
-            loss_y = self.mse_loss(y[obj_mask], ty[obj_mask])
-            loss_w = self.mse_loss(w[obj_mask], tw[obj_mask])
-            loss_h = self.mse_loss(h[obj_mask], th[obj_mask])
-            loss_conf_obj = self.bce_loss(pred_conf[obj_mask], tconf[obj_mask])
-            loss_conf_noobj = self.bce_loss(pred_conf[noobj_mask], tconf[noobj_mask])
-            loss_conf = self.obj_scale * loss_conf_obj + self.noobj_scale * loss_conf_noobj
-            loss_cls = self.bce_loss(pred_cls[obj_mask], tcls[obj_mask])
-            total_loss = loss_x + loss_y + loss_w + loss_h + loss_conf + loss_cls
-
-            # Metrics
-            cls_acc = 100 * class_mask[obj_mask].mean()
-            conf_obj = pred_conf[obj_mask].mean()
-            conf_noobj = pred_conf[noobj_mask].mean()
-            conf50 = (pred_conf > 0.5).float()
-            iou50 = (iou_scores > 0.5).float()
-            iou75 = (iou_scores > 0.75).float()
-            detected_mask = conf50 * class_mask * tconf
-            precision = torch.sum(iou50 * detected_mask) / (conf50.sum() + 1e-16)
-            recall50 = torch.sum(iou50 * detected_mask) / (obj_mask.sum() + 1e-16)
-            recall75 = torch.sum(iou75 * detected_mask) / (obj_mask.sum() + 1e-16)
-
-            self.metrics = {
-                "loss": to_cpu(total_loss).item(),
-                "x": to_cpu(loss_x).item(),
-                "y": to_cpu(loss_y).item(),
-                "w": to_cpu(loss_w).item(),
-                "h": to_cpu(loss_h).item(),
-                "conf": to_cpu(loss_conf).item(),
-                "cls": to_cpu(loss_cls).item(),
-                "cls_acc": to_cpu(cls_acc).item(),
-                "recall50": to_cpu(recall50).item(),
-                "recall75": to_cpu(recall75).item(),
-                "precision": to_cpu(precision).item(),
-                "conf_obj": to_cpu(conf_obj).item(),
-                "conf_noobj": to_cpu(conf_noobj).item(),
-                "grid_size": grid_size,
-            }
-
-            return output, total_loss
+        return output, (x, y, w, h, pred_conf, pred_cls, pred_boxes)
+
+    def compute_loss(self, predictions, layer_targets):
+        """ Returns the loss of the layer given its predictions and its targets, and updates the metrics """
+        x, y, w, h, pred_conf, pred_cls, pred_boxes = predictions
+        iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf = layer_targets
+        grid_size = pred_boxes.size(2)
+        # Loss : Mask outputs to ignore non-existing objects (except with conf. loss)
+        loss_x = self.mse_loss(x[obj_mask], tx[obj_mask])
+        loss_y = self.mse_loss(y[obj_mask], ty[obj_mask])
+        loss_w = self.mse_loss(w[obj_mask], tw[obj_mask])
+        loss_h = self.mse_loss(h[obj_mask], th[obj_mask])
+        loss_conf_obj = self.bce_loss(pred_conf[obj_mask], tconf[obj_mask])
+        loss_conf_noobj = self.bce_loss(pred_conf[noobj_mask], tconf[noobj_mask])
+        loss_conf = self.obj_scale * loss_conf_obj + self.noobj_scale * loss_conf_noobj
+        loss_cls = self.bce_loss(pred_cls[obj_mask], tcls[obj_mask])
+        total_loss = loss_x + loss_y + loss_w + loss_h + loss_conf + loss_cls
+
+        # Metrics
+        cls_acc = 100 * class_mask[obj_mask].mean()
+        conf_obj = pred_conf[obj_mask].mean()
+        conf_noobj = pred_conf[noobj_mask].mean()
+        conf50 = (pred_conf > 0.5).float()
+        iou50 = (iou_scores > 0.5).float()
+        iou75 = (iou_scores > 0.75).float()
+        detected_mask = conf50 * class_mask * tconf
+        precision = torch.sum(iou50 * detected_mask) / (conf50.sum() + 1e-16)
+        recall50 = torch.sum(iou50 * detected_mask) / (obj_mask.sum() + 1e-16)
+        recall75 = torch.sum(iou75 * detected_mask) / (obj_mask.sum() + 1e-16)
+
+        self.metrics = {
+            "loss": to_cpu(total_loss).item(),
+            "x": to_cpu(loss_x).item(),
+            "y": to_cpu(loss_y).item(),
+            "w": to_cpu(loss_w).item(),
+            "h": to_cpu(loss_h).item(),
+            "conf": to_cpu(loss_conf).item(),
+            "cls": to_cpu(loss_cls).item(),
+            "cls_acc": to_cpu(cls_acc).item(),
+            "recall50": to_cpu(recall50).item(),
+            "recall75": to_cpu(recall75).item(),
+            "precision": to_cpu(precision).item(),
+            "conf_obj": to_cpu(conf_obj).item(),
+            "conf_noobj": to_cpu(conf_noobj).item(),
+            "grid_size": grid_size,
+        }
+
+        return total_loss
+
+
+# Size of the write buffer used when saving darknet weights
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def write_array(fp, values):
+    """ Writes the raw contents of a tensor or array to the binary file 'fp' without an intermediate bytes copy """
+    if torch.is_tensor(values):
+        values = values.detach().cpu().numpy()
+    fp.write(np.ascontiguousarray(values).data)
+
+
+def fold_batch_norm(conv_weight, bn_bias, bn_weight, bn_running_mean, bn_running_var, eps=BN_EPS):
+    """ Returns the weight and bias of a convolution equivalent to 'conv_weight' followed by batch norm """
+    scale = bn_weight / torch.sqrt(bn_running_var + eps)
+    weight = conv_weight * scale.view(-1, 1, 1, 1)
+    bias = bn_bias - bn_running_mean * scale
+    return weight, bias
 
 
 class Darknet(nn.Module):
@@ -238,46 +314,114 @@ class Darknet(nn.Module):
         super(Darknet, self).__init__()
         self.module_defs = parse_model_config(config_path)
         self.hyperparams, self.module_list = create_modules(self.module_defs)
+        self.execution_plan = compile_execution_plan(self.module_defs)
         self.yolo_layers = [layer[0] for layer in self.module_list if hasattr(layer[0], "metrics")]
         self.img_size = img_size
         self.seen = 0
         self.header_info = np.array([0, 0, 0, self.seen, 0], dtype=np.int32)
+        self.fused = False
+
+    def fuse(self):
+        """
+        Folds every batch norm layer into the weights and bias of the preceding convolution.
+        The fused model is only meant for inference, so it is put in evaluation mode.
+        """
+        self.eval()
+        if self.fused:
+            return self
+        for module_def, module in zip(self.module_defs, self.module_list):
+            if module_def["type"] == "convolutional" and module_def["batch_normalize"]:
+                conv_layer, bn_layer = module[0], module[1]
+                fused_conv = nn.Conv2d(
+                    in_channels=conv_layer.in_channels,
+                    out_channels=conv_layer.out_channels,
+                    kernel_size=conv_layer.kernel_size,
+                    stride=conv_layer.stride,
+                    padding=conv_layer.padding,
+                    bias=True,
+                ).to(conv_layer.weight.device)
+                weight, bias = fold_batch_norm(
+                    conv_layer.weight.data,
+                    bn_layer.bias.data,
+                    bn_layer.weight.data,
+                    bn_layer.running_mean,
+                    bn_layer.running_var,
+                    bn_layer.eps,
+                )
+                fused_conv.weight.data.copy_(weight)
+                fused_conv.bias.data.copy_(bias)
+                module[0] = fused_conv
+                del module[1]
+        self.fused = True
+        return self
 
     def forward(self, x, targets=None):
         img_dim = x.shape[2]
         loss = 0
-        layer_outputs, yolo_outputs = [], []
-        for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
-            if module_def["type"] in ["convolutional", "upsample", "maxpool"]:
+        # Only the outputs read again by a later route or shortcut are kept
+        layer_outputs, yolo_outputs, yolo_predictions = {}, [], []
+        for i, ((layer_type, inputs, release, save), module) in enumerate(zip(self.execution_plan, self.module_list)):
+            if layer_type in ["convolutional", "upsample", "maxpool"]:
                 x = module(x)
-            elif module_def["type"] == "route":
-                x = torch.cat([layer_outputs[int(layer_i)] for layer_i in module_def["layers"].split(",")], 1)
-            elif module_def["type"] == "shortcut":
-                layer_i = int(module_def["from"])
-                x = layer_outputs[-1] + layer_outputs[layer_i]
-            elif module_def["type"] == "yolo":
-                x, layer_loss = module[0](x, targets, img_dim)
-                loss += layer_loss
+            elif layer_type == "route":
+                route_inputs = [layer_outputs[layer_i] for layer_i in inputs]
+                x = torch.cat(route_inputs, 1) if len(route_inputs) > 1 else route_inputs[0]
+            elif layer_type == "shortcut":
+                x = x + layer_outputs[inputs[0]]
+            elif layer_type == "yolo":
+                x, predictions = module[0].predict(x, img_dim)
                 yolo_outputs.append(x)
-            layer_outputs.append(x)
+                yolo_predictions.append(predictions)
+            for layer_i in release:
+                del layer_outputs[layer_i]
+            if save:
+                layer_outputs[i] = x
+        if targets is not None:
+            # The targets of every YOLO layer are built in a single call
+            layer_targets = build_targets_layers(
+                pred_boxes=[predictions[6] for predictions in yolo_predictions],
+                pred_cls=[predictions[5] for predictions in yolo_predictions],
+                target=targets,
+                anchors=[yolo_layer.scaled_anchors for yolo_layer in self.yolo_layers],
+                ignore_thres=self.yolo_layers[0].ignore_thres,
+            )
+            for yolo_layer, predictions, targets_i in zip(self.yolo_layers, yolo_predictions, layer_targets):
+                loss += yolo_layer.compute_loss(predictions, targets_i)
         yolo_outputs = to_cpu(torch.cat(yolo_outputs, 1))
         return yolo_outputs if targets is None else (loss, yolo_outputs)
 
+    def darknet_weights_count(self, cutoff=None):
+        """Number of float32 values a darknet weights file holds for the layers before 'cutoff'"""
+        count = 0
+        for module_def, module in zip(self.module_defs[:cutoff], self.module_list[:cutoff]):
+            if module_def["type"] == "convolutional":
+                conv_layer = module[0]
+                # Batch norm bias, weights, running mean and running variance, or conv. bias
+                count += conv_layer.out_channels * (4 if module_def["batch_normalize"] else 1)
+                count += conv_layer.weight.numel()
+        return count
+
     def load_darknet_weights(self, weights_path):
         """Parses and loads the weights stored in 'weights_path'"""
 
-        # Open the weights file
-        with open(weights_path, "rb") as f:
-            header = np.fromfile(f, dtype=np.int32, count=5)  # First five are header values
-            self.header_info = header  # Needed to write header when saving weights
-            self.seen = header[3]  # number of images seen during training
-            weights = np.fromfile(f, dtype=np.float32)  # The rest are weights
-
         # Establish cutoff for loading backbone weights
         cutoff = None
         if "darknet53.conv.74" in weights_path:
             cutoff = 75
 
+        header = np.fromfile(weights_path, dtype=np.int32, count=5)  # First five are header values
+        # Map the rest of the file (the weights) instead of reading it, layers are copied straight from the mapping
+        weights = np.memmap(weights_path, dtype=np.float32, mode="c", offset=header.nbytes)
+
+        # Validate the file against the model definition before touching any layer
+        num_weights = self.darknet_weights_count(cutoff)
+        if weights.size < num_weights or (cutoff is None and weights.size != num_weights):
+            raise ValueError(
+                f"'{weights_path}' has {weights.size} weights but the model definition needs {num_weights}"
+            )
+        self.header_info = header  # Needed to write header when saving weights
+        self.seen = header[3]  # number of images seen during training
+
         ptr = 0
         for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
             if i == cutoff:
@@ -286,24 +430,17 @@ class Darknet(nn.Module):
                 conv_layer = module[0]
                 if module_def["batch_normalize"]:
                     # Load BN bias, weights, running mean and running variance
-                    bn_layer = module[1]
-                    num_b = bn_layer.bias.numel()  # Number of biases
-                    # Bias
-                    bn_b = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(bn_layer.bias)
-                    bn_layer.bias.data.copy_(bn_b)
-                    ptr += num_b
-                    # Weight
-                    bn_w = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(bn_layer.weight)
-                    bn_layer.weight.data.copy_(bn_w)
-                    ptr += num_b
-                    # Running Mean
-                    bn_rm = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(bn_layer.running_mean)
-                    bn_layer.running_mean.data.copy_(bn_rm)
-                    ptr += num_b
-                    # Running Var
-                    bn_rv = torch.from_numpy(weights[ptr : ptr + num_b]).view_as(bn_layer.running_var)
-                    bn_layer.running_var.data.copy_(bn_rv)
-                    ptr += num_b
+                    num_b = conv_layer.out_channels  # Number of biases
+                    bn_b, bn_w, bn_rm, bn_rv = [
+                        torch.from_numpy(weights[ptr + k * num_b : ptr + (k + 1) * num_b]) for k in range(4)
+                    ]
+                    ptr += 4 * num_b
+                    if not self.fused:
+                        bn_layer = module[1]
+                        bn_layer.bias.data.copy_(bn_b)
+                        bn_layer.weight.data.copy_(bn_w)
+                        bn_layer.running_mean.data.copy_(bn_rm)
+                        bn_layer.running_var.data.copy_(bn_rv)
                 else:
                     # Load conv. bias
                     num_b = conv_layer.bias.numel()
@@ -313,33 +450,42 @@ class Darknet(nn.Module):
                 # Load conv. weights
                 num_w = conv_layer.weight.numel()
                 conv_w = torch.from_numpy(weights[ptr : ptr + num_w]).view_as(conv_layer.weight)
+                if self.fused and module_def["batch_normalize"]:
+                    # Fold the loaded batch norm into the fused convolution
+                    conv_w, conv_b = fold_batch_norm(conv_w, bn_b, bn_w, bn_rm, bn_rv)
+                    conv_layer.bias.data.copy_(conv_b)
                 conv_layer.weight.data.copy_(conv_w)
                 ptr += num_w
+        del weights
 
     def save_darknet_weights(self, path, cutoff=-1):
         """
             @:param path    - path of the new weights file
             @:param cutoff  - save layers between 0 and cutoff (cutoff = -1 -> all are saved)
         """
-        fp = open(path, "wb")
-        self.header_info[3] = self.seen
-        self.header_info.tofile(fp)
-
-        # Iterate through layers
-        for i, (module_def, module) in enumerate(zip(self.module_defs[:cutoff], self.module_list[:cutoff])):
-            if module_def["type"] == "convolutional":
-                conv_layer = module[0]
-                # If batch norm, load bn first
-                if module_def["batch_normalize"]:
-                    bn_layer = module[1]
-                    bn_layer.bias.data.cpu().numpy().tofile(fp)
-                    bn_layer.weight.data.cpu().numpy().tofile(fp)
-                    bn_layer.running_mean.data.cpu().numpy().tofile(fp)
-                    bn_layer.running_var.data.cpu().numpy().tofile(fp)
-                # Load conv bias
-                else:
-                    conv_layer.bias.data.cpu().numpy().tofile(fp)
-                # Load conv weights
-                conv_layer.weight.data.cpu().numpy().tofile(fp)
-
-        fp.close()
+        with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as fp:
+            self.header_info[3] = self.seen
+            write_array(fp, self.header_info.astype(np.int32))
+
+            # Iterate through layers
+            for i, (module_def, module) in enumerate(zip(self.module_defs[:cutoff], self.module_list[:cutoff])):
+                if module_def["type"] == "convolutional":
+                    conv_layer = module[0]
+                    # If batch norm, load bn first
+                    if module_def["batch_normalize"] and self.fused:
+                        # Write the fused bias as an identity batch norm
+                        write_array(fp, conv_layer.bias)
+                        write_array(fp, np.ones(conv_layer.out_channels, dtype=np.float32))
+                        write_array(fp, np.zeros(conv_layer.out_channels, dtype=np.float32))
+                        write_array(fp, np.full(conv_layer.out_channels, 1 - BN_EPS, dtype=np.float32))
+                    elif module_def["batch_normalize"]:
+                        bn_layer = module[1]
+                        write_array(fp, bn_layer.bias)
+                        write_array(fp, bn_layer.weight)
+                        write_array(fp, bn_layer.running_mean)
+                        write_array(fp, bn_layer.running_var)
+                    # Load conv bias
+                    else:
+                        write_array(fp, conv_layer.bias)
+                    # Load conv weights
+                    write_array(fp, conv_layer.weight)
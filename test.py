@@ -20,26 +20,42 @@ from torch.autograd import Variable
 import torch.optim as optim
 
 
-def evaluate(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size):
+def evaluate(
+    model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size, rect=False, coco_map=False, cache_dir=None
+):
     model.eval()
 
     # Get dataloader
-    dataset = ListDataset(path, img_size=img_size, augment=False, multiscale=False)
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=batch_size, shuffle=False, num_workers=1, collate_fn=dataset.collate_fn
-    )
+    if cache_dir:
+        # Images of the cache written by cache_dataset.py are already padded to square, 'path' is not read
+        if rect:
+            raise ValueError("rect batches need the original images, they cannot be served from a dataset cache")
+        dataset = CachedListDataset(cache_dir, img_size=img_size, augment=False, multiscale=False)
+    else:
+        dataset = ListDataset(path, img_size=img_size, augment=False, multiscale=False)
+    if rect:
+        # Batches of similar aspect ratio letterboxed to rectangular shapes instead of squares
+        batch_sampler = AspectRatioBatchSampler(image_aspect_ratios(dataset.img_files), batch_size, img_size)
+        dataset.shapes = batch_sampler.shapes
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_sampler=batch_sampler, num_workers=1, collate_fn=dataset.collate_fn
+        )
+    else:
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, shuffle=False, num_workers=1, collate_fn=dataset.collate_fn
+        )
 
     Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
 
-    labels = []
-    sample_metrics = []  # List of tuples (TP, confs, pred)
+    # With coco_map the COCO thresholds are evaluated together with 'iou_thres', from the same IoU matrices
+    iou_thresholds = np.concatenate(([iou_thres], COCO_IOU_THRESHOLDS)) if coco_map else iou_thres
+    statistics = StatisticsAccumulator(iou_threshold=iou_thresholds)  # Running TP, confs, pred and target labels
     for batch_i, (_, imgs, targets) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects")):
 
-        # Extract labels
-        labels += targets[:, 1].tolist()
         # Rescale target
         targets[:, 2:] = xywh2xyxy(targets[:, 2:])
-        targets[:, 2:] *= img_size
+        targets[:, [2, 4]] *= imgs.size(3)
+        targets[:, [3, 5]] *= imgs.size(2)
 
         imgs = Variable(imgs.type(Tensor), requires_grad=False)
 
@@ -47,12 +63,13 @@ def evaluate(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size
             outputs = model(imgs)
             outputs = non_max_suppression(outputs, conf_thres=conf_thres, nms_thres=nms_thres)
 
-        sample_metrics += get_batch_statistics(outputs, targets, iou_threshold=iou_thres)
+        statistics.update(outputs, targets)
 
-    # Concatenate sample statistics
-    true_positives, pred_scores, pred_labels = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
-    precision, recall, AP, f1, ap_class = ap_per_class(true_positives, pred_scores, pred_labels, labels)
+    precision, recall, AP, f1, ap_class = statistics.compute()
 
+    if coco_map:
+        # Also returns the AP averaged over IoU thresholds .5:.05:.95 of every class
+        return precision[:, 0], recall[:, 0], AP[:, 0], f1[:, 0], ap_class, AP[:, 1:].mean(1)
     return precision, recall, AP, f1, ap_class
 
 
@@ -68,6 +85,10 @@ if __name__ == "__main__":
     parser.add_argument("--nms_thres", type=float, default=0.5, help="iou thresshold for non-maximum suppression")
     parser.add_argument("--n_cpu", type=int, default=8, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--rect", action="store_true", help="letterbox batches of similar aspect ratio to rectangles")
+    parser.add_argument(
+        "--dataset_cache", type=str, help="if specified evaluates on the cache written by cache_dataset.py"
+    )
     opt = parser.parse_args()
     print(opt)
 
@@ -88,7 +109,8 @@ if __name__ == "__main__":
 
     print("Compute mAP...")
 
-    precision, recall, AP, f1, ap_class = evaluate(
+    start_time = time.time()
+    precision, recall, AP, f1, ap_class, AP_coco = evaluate(
         model,
         path=valid_path,
         iou_thres=opt.iou_thres,
@@ -96,10 +118,17 @@ if __name__ == "__main__":
         nms_thres=opt.nms_thres,
         img_size=opt.img_size,
         batch_size=8,
+        rect=opt.rect,
+        coco_map=True,
+        cache_dir=os.path.join(opt.dataset_cache, "valid") if opt.dataset_cache else None,
     )
+    with open(valid_path, "r") as file:
+        num_images = len(file.readlines())
+    print(f"Images/sec: {num_images / (time.time() - start_time):.2f}")
 
     print("Average Precisions:")
     for i, c in enumerate(ap_class):
-        print(f"+ Class '{c}' ({class_names[c]}) - AP: {AP[i]}")
+        print(f"+ Class '{c}' ({class_names[c]}) - AP: {AP[i]} - AP@[.5:.95]: {AP_coco[i]}")
 
-    print(f"mAP: {AP.mean()}")
\ No newline at end of file
+    print(f"mAP: {AP.mean()}")
+    print(f"mAP@[.5:.95]: {AP_coco.mean()}")
\ No newline at end of file
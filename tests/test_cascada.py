@@ -0,0 +1,25 @@
+import os
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("ultralytics")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "deteccion_matriculas"))
+
+from cascada import CompuertaCascada  # noqa: E402
+
+
+def test_configured_gate_survives_pickling():
+    """ The parallel video mode sends the gate to spawned workers inside its options """
+    compuerta = CompuertaCascada(escala=1.0, min_vecinos=4, periodo_maximo=5, umbral_movimiento=3.0)
+    compuerta.decidir(np.zeros((64, 64, 3), dtype=np.uint8))
+
+    copia = pickle.loads(pickle.dumps(compuerta))
+
+    assert (copia.escala, copia.min_vecinos, copia.periodo_maximo, copia.umbral_movimiento) == (1.0, 4, 5, 3.0)
+    assert copia.estadisticas() == compuerta.estadisticas()
+    assert copia.lock is not compuerta.lock
+    with copia.lock:
+        copia.frames_saltados += 1
@@ -0,0 +1,56 @@
+import copy
+
+import torch
+
+from models import Darknet
+
+CONFIG_PATH = "config/yolov3.cfg"
+IMG_SIZE = 128
+
+
+def random_model():
+    """ Darknet with random batch norm statistics, so folding them is not a no-op """
+    torch.manual_seed(0)
+    model = Darknet(CONFIG_PATH, img_size=IMG_SIZE)
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.1, 0.1)
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 1.5)
+    return model.eval()
+
+
+def detections(model, images):
+    with torch.no_grad():
+        return model(images)
+
+
+def test_fuse_matches_unfused():
+    model = random_model()
+    images = torch.rand(2, 3, IMG_SIZE, IMG_SIZE)
+    expected = detections(model, images)
+
+    fused = copy.deepcopy(model).fuse()
+    assert not any(isinstance(module, torch.nn.BatchNorm2d) for module in fused.modules())
+    assert torch.allclose(detections(fused, images), expected, rtol=1e-3, atol=1e-3)
+
+
+def test_fused_weights_round_trip(tmp_path):
+    model = random_model()
+    images = torch.rand(1, 3, IMG_SIZE, IMG_SIZE)
+    expected = detections(model, images)
+
+    # Fused weights are written as identity batch norm and load into an unfused model
+    fused_path = str(tmp_path / "fused.weights")
+    copy.deepcopy(model).fuse().save_darknet_weights(fused_path)
+    unfused = Darknet(CONFIG_PATH, img_size=IMG_SIZE).eval()
+    unfused.load_darknet_weights(fused_path)
+    assert torch.allclose(detections(unfused, images), expected, rtol=1e-3, atol=1e-3)
+
+    # Unfused weights fold their batch norm while loading into a fused model
+    unfused_path = str(tmp_path / "unfused.weights")
+    model.save_darknet_weights(unfused_path)
+    fused = Darknet(CONFIG_PATH, img_size=IMG_SIZE).fuse()
+    fused.load_darknet_weights(unfused_path)
+    assert torch.allclose(detections(fused, images), expected, rtol=1e-3, atol=1e-3)
@@ -0,0 +1,64 @@
+import torch
+
+from utils.utils import bbox_iou, non_max_suppression, xywh2xyxy
+
+
+def reference_non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4):
+    """ Per-box loop that non_max_suppression replaced, kept to check that the outputs match """
+    prediction[..., :4] = xywh2xyxy(prediction[..., :4])
+    output = [None for _ in range(len(prediction))]
+    for image_i, image_pred in enumerate(prediction):
+        image_pred = image_pred[image_pred[:, 4] >= conf_thres]
+        if not image_pred.size(0):
+            continue
+        score = image_pred[:, 4] * image_pred[:, 5:].max(1)[0]
+        image_pred = image_pred[(-score).argsort()]
+        class_confs, class_preds = image_pred[:, 5:].max(1, keepdim=True)
+        detections = torch.cat((image_pred[:, :5], class_confs.float(), class_preds.float()), 1)
+        keep_boxes = []
+        while detections.size(0):
+            large_overlap = bbox_iou(detections[0, :4].unsqueeze(0), detections[:, :4]) > nms_thres
+            label_match = detections[0, -1] == detections[:, -1]
+            invalid = large_overlap & label_match
+            weights = detections[invalid, 4:5]
+            detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
+            keep_boxes += [detections[0]]
+            detections = detections[~invalid]
+        if keep_boxes:
+            output[image_i] = torch.stack(keep_boxes)
+
+    return output
+
+
+def random_prediction(batch_size, num_anchors, num_classes, img_size=416):
+    prediction = torch.rand(batch_size, num_anchors, 5 + num_classes)
+    prediction[..., :2] *= img_size
+    prediction[..., 2:4] = prediction[..., 2:4] * img_size / 4 + 4
+    return prediction
+
+
+def test_matches_reference_loop():
+    torch.manual_seed(0)
+    for batch_size, num_anchors, num_classes, conf_thres in ((1, 300, 1, 0.2), (4, 2000, 5, 0.5), (3, 1000, 80, 0.9)):
+        prediction = random_prediction(batch_size, num_anchors, num_classes)
+        # Some images without any detection above the threshold
+        prediction[0, :, 4] *= conf_thres
+        expected = reference_non_max_suppression(prediction.clone(), conf_thres, 0.4)
+        output = non_max_suppression(prediction.clone(), conf_thres, 0.4, max_det=None, max_nms=None)
+
+        assert len(output) == len(expected)
+        for detections, expected_detections in zip(output, expected):
+            if expected_detections is None:
+                assert detections is None
+                continue
+            assert detections.shape == expected_detections.shape
+            assert torch.allclose(detections, expected_detections, atol=1e-3)
+
+
+def test_merge_memory_stays_per_group():
+    # test.py settings: almost every anchor passes conf_thres and the batch is suppressed at once
+    torch.manual_seed(0)
+    prediction = random_prediction(8, 10647, 80)
+    output = non_max_suppression(prediction, conf_thres=0.001, nms_thres=0.5)
+    assert len(output) == 8
+    assert all(detections is not None and len(detections) <= 300 for detections in output)
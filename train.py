@@ -36,6 +36,9 @@ if __name__ == "__main__":
     parser.add_argument("--evaluation_interval", type=int, default=1, help="interval evaluations on validation set")
     parser.add_argument("--compute_map", default=False, help="if True computes mAP every tenth batch")
     parser.add_argument("--multiscale_training", default=True, help="allow for multi-scale training")
+    parser.add_argument(
+        "--dataset_cache", type=str, help="if specified trains and evaluates from the cache written by cache_dataset.py"
+    )
     opt = parser.parse_args()
     print(opt)
 
@@ -64,7 +67,12 @@ if __name__ == "__main__":
             model.load_darknet_weights(opt.pretrained_weights)
 
     # Get dataloader
-    dataset = ListDataset(train_path, augment=True, multiscale=opt.multiscale_training)
+    if opt.dataset_cache:
+        dataset = CachedListDataset(
+            os.path.join(opt.dataset_cache, "train"), augment=True, multiscale=opt.multiscale_training
+        )
+    else:
+        dataset = ListDataset(train_path, augment=True, multiscale=opt.multiscale_training)
     dataloader = torch.utils.data.DataLoader(
         dataset,
         batch_size=opt.batch_size,
@@ -158,6 +166,7 @@ if __name__ == "__main__":
                 nms_thres=0.5,
                 img_size=opt.img_size,
                 batch_size=8,
+                cache_dir=os.path.join(opt.dataset_cache, "valid") if opt.dataset_cache else None,
             )
             evaluation_metrics = [
                 ("val_precision", precision.mean()),
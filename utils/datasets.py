@@ -1,14 +1,16 @@
 import glob
+import json
 import random
 import os
 import sys
+import math
 import numpy as np
 from PIL import Image
 import torch
 import torch.nn.functional as F
 
 from utils.augmentations import horisontal_flip
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torchvision.transforms as transforms
 
 
@@ -25,6 +27,62 @@ def pad_to_square(img, pad_value):
     return img, pad
 
 
+def letterbox(img, shape, pad_value=0):
+    """
+    Resizes 'img' keeping its aspect ratio to fit in 'shape' (height, width) and pads the rest.
+    Returns the image, the (left, right, top, bottom) padding and the resize scale
+    """
+    _, h, w = img.shape
+    scale = min(shape[0] / h, shape[1] / w)
+    new_h, new_w = min(round(h * scale), shape[0]), min(round(w * scale), shape[1])
+    img = F.interpolate(img.unsqueeze(0), size=(new_h, new_w), mode="nearest").squeeze(0)
+    pad_w, pad_h = shape[1] - new_w, shape[0] - new_h
+    pad = (pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2)
+    img = F.pad(img, pad, "constant", value=pad_value)
+
+    return img, pad, scale
+
+
+def rect_shape(min_aspect_ratio, max_aspect_ratio, img_size, stride=32):
+    """ Smallest (height, width) with sides multiple of 'stride' that fits images of the given height / width ratios """
+    if max_aspect_ratio < 1:
+        return math.ceil(img_size * max_aspect_ratio / stride) * stride, img_size
+    if min_aspect_ratio > 1:
+        return img_size, math.ceil(img_size / min_aspect_ratio / stride) * stride
+    return img_size, img_size
+
+
+def image_aspect_ratios(paths):
+    """ Height / width of every image, read from the file headers without decoding the images """
+    aspect_ratios = []
+    for path in paths:
+        w, h = Image.open(path.rstrip()).size
+        aspect_ratios.append(h / w)
+    return np.array(aspect_ratios)
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Groups images of similar aspect ratio into batches and gives every batch the smallest
+    rectangular input shape that fits all its images. The shape of every image index is
+    in 'shapes', to be given to the dataset
+    """
+
+    def __init__(self, aspect_ratios, batch_size, img_size, stride=32):
+        order = np.argsort(aspect_ratios, kind="stable")
+        self.batches = [order[i : i + batch_size].tolist() for i in range(0, len(order), batch_size)]
+        self.shapes = {}
+        for batch in self.batches:
+            shape = rect_shape(aspect_ratios[batch].min(), aspect_ratios[batch].max(), img_size, stride)
+            self.shapes.update({index: shape for index in batch})
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
 def resize(image, size):
     image = F.interpolate(image.unsqueeze(0), size=size, mode="nearest").squeeze(0)
     return image
@@ -40,15 +98,20 @@ class ImageFolder(Dataset):
     def __init__(self, folder_path, img_size=416):
         self.files = sorted(glob.glob("%s/*.*" % folder_path))
         self.img_size = img_size
+        self.shapes = None  # Rectangular (height, width) input shape per index, see AspectRatioBatchSampler
 
     def __getitem__(self, index):
         img_path = self.files[index % len(self.files)]
         # Extract image as PyTorch tensor
         img = transforms.ToTensor()(Image.open(img_path))
-        # Pad to square resolution
-        img, _ = pad_to_square(img, 0)
-        # Resize
-        img = resize(img, self.img_size)
+        if self.shapes is not None:
+            # Resize and pad to the rectangular shape of its batch
+            img, _, _ = letterbox(img, self.shapes[index % len(self.files)], 0)
+        else:
+            # Pad to square resolution
+            img, _ = pad_to_square(img, 0)
+            # Resize
+            img = resize(img, self.img_size)
 
         return img_path, img
 
@@ -73,6 +136,7 @@ class ListDataset(Dataset):
         self.min_size = self.img_size - 3 * 32
         self.max_size = self.img_size + 3 * 32
         self.batch_count = 0
+        self.shapes = None  # Rectangular (height, width) input shape per index, see AspectRatioBatchSampler
 
     def __getitem__(self, index):
 
@@ -92,8 +156,13 @@ class ListDataset(Dataset):
 
         _, h, w = img.shape
         h_factor, w_factor = (h, w) if self.normalized_labels else (1, 1)
-        # Pad to square resolution
-        img, pad = pad_to_square(img, 0)
+        if self.shapes is not None:
+            # Resize and pad to the rectangular shape of its batch
+            img, pad, scale = letterbox(img, self.shapes[index % len(self.img_files)], 0)
+        else:
+            # Pad to square resolution
+            img, pad = pad_to_square(img, 0)
+            scale = 1
         _, padded_h, padded_w = img.shape
 
         # ---------
@@ -105,11 +174,11 @@ class ListDataset(Dataset):
         targets = None
         if os.path.exists(label_path):
             boxes = torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
-            # Extract coordinates for unpadded + unscaled image
-            x1 = w_factor * (boxes[:, 1] - boxes[:, 3] / 2)
-            y1 = h_factor * (boxes[:, 2] - boxes[:, 4] / 2)
-            x2 = w_factor * (boxes[:, 1] + boxes[:, 3] / 2)
-            y2 = h_factor * (boxes[:, 2] + boxes[:, 4] / 2)
+            # Extract coordinates for unpadded image
+            x1 = scale * w_factor * (boxes[:, 1] - boxes[:, 3] / 2)
+            y1 = scale * h_factor * (boxes[:, 2] - boxes[:, 4] / 2)
+            x2 = scale * w_factor * (boxes[:, 1] + boxes[:, 3] / 2)
+            y2 = scale * h_factor * (boxes[:, 2] + boxes[:, 4] / 2)
             # Adjust for added padding
             x1 += pad[0]
             y1 += pad[2]
@@ -118,8 +187,8 @@ class ListDataset(Dataset):
             # Returns (x, y, w, h)
             boxes[:, 1] = ((x1 + x2) / 2) / padded_w
             boxes[:, 2] = ((y1 + y2) / 2) / padded_h
-            boxes[:, 3] *= w_factor / padded_w
-            boxes[:, 4] *= h_factor / padded_h
+            boxes[:, 3] *= scale * w_factor / padded_w
+            boxes[:, 4] *= scale * h_factor / padded_h
 
             targets = torch.zeros((len(boxes), 6))
             targets[:, 1:] = boxes
@@ -142,10 +211,119 @@ class ListDataset(Dataset):
         # Selects new image size every tenth batch
         if self.multiscale and self.batch_count % 10 == 0:
             self.img_size = random.choice(range(self.min_size, self.max_size + 1, 32))
-        # Resize images to input shape
-        imgs = torch.stack([resize(img, self.img_size) for img in imgs])
+        # Resize images to input shape, rectangular batches already share their shape
+        if self.shapes is not None:
+            imgs = torch.stack(imgs)
+        else:
+            imgs = torch.stack([resize(img, self.img_size) for img in imgs])
         self.batch_count += 1
         return paths, imgs, targets
 
     def __len__(self):
         return len(self.img_files)
+
+
+def build_dataset_cache(list_path, cache_dir, img_size=512, shard_size=1024, normalized_labels=True):
+    """
+    Decodes, pads to square and resizes every image of 'list_path' once and stores them as uint8
+    memory-mapped shards in 'cache_dir', together with the normalized labels and their offset index
+    """
+    dataset = ListDataset(
+        list_path, img_size=img_size, augment=False, multiscale=False, normalized_labels=normalized_labels
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    num_images = len(dataset)
+
+    labels, label_offsets, has_labels = [], [0], []
+    shard = None
+    for index in range(num_images):
+        if index % shard_size == 0:
+            if shard is not None:
+                shard.flush()
+            shard_path = os.path.join(cache_dir, "images_%05d.npy" % (index // shard_size))
+            shard_shape = (min(shard_size, num_images - index), 3, img_size, img_size)
+            shard = np.lib.format.open_memmap(shard_path, mode="w+", dtype=np.uint8, shape=shard_shape)
+
+        _, img, targets = dataset[index]
+        shard[index % shard_size] = (resize(img, img_size) * 255).round().byte().numpy()
+        has_labels.append(targets is not None)
+        if targets is not None:
+            labels.append(targets[:, 1:].numpy().astype(np.float32))
+        label_offsets.append(label_offsets[-1] + (len(targets) if targets is not None else 0))
+    if shard is not None:
+        shard.flush()
+
+    np.save(
+        os.path.join(cache_dir, "labels.npy"),
+        np.concatenate(labels, 0) if labels else np.zeros((0, 5), dtype=np.float32),
+    )
+    np.save(os.path.join(cache_dir, "label_offsets.npy"), np.array(label_offsets, dtype=np.int64))
+    np.save(os.path.join(cache_dir, "has_labels.npy"), np.array(has_labels, dtype=bool))
+    with open(os.path.join(cache_dir, "index.json"), "w") as file:
+        json.dump(
+            {
+                "img_size": img_size,
+                "shard_size": shard_size,
+                "img_files": [path.rstrip() for path in dataset.img_files],
+            },
+            file,
+        )
+
+
+class CachedListDataset(ListDataset):
+    """ListDataset served from the memory-mapped shards written by build_dataset_cache"""
+
+    def __init__(self, cache_dir, img_size=416, augment=True, multiscale=True):
+        with open(os.path.join(cache_dir, "index.json"), "r") as file:
+            index = json.load(file)
+        self.cache_dir = cache_dir
+        self.img_files = index["img_files"]
+        self.shard_size = index["shard_size"]
+        self.img_size = img_size
+        self.max_objects = 100
+        self.augment = augment
+        self.multiscale = multiscale
+        self.min_size = self.img_size - 3 * 32
+        self.max_size = self.img_size + 3 * 32
+        self.batch_count = 0
+        self.shapes = None
+        self.cache = None
+
+    def open_cache(self):
+        # Mapped lazily so every DataLoader worker maps the same files and shares their pages
+        num_shards = (len(self.img_files) + self.shard_size - 1) // self.shard_size
+        shards = [
+            np.load(os.path.join(self.cache_dir, "images_%05d.npy" % i), mmap_mode="c") for i in range(num_shards)
+        ]
+        labels = np.load(os.path.join(self.cache_dir, "labels.npy"), mmap_mode="c")
+        label_offsets = np.load(os.path.join(self.cache_dir, "label_offsets.npy"))
+        has_labels = np.load(os.path.join(self.cache_dir, "has_labels.npy"))
+        self.cache = shards, labels, label_offsets, has_labels
+
+    def __getstate__(self):
+        # Mappings are not sent to the workers, each one opens its own
+        state = self.__dict__.copy()
+        state["cache"] = None
+        return state
+
+    def __getitem__(self, index):
+        if self.cache is None:
+            self.open_cache()
+        shards, labels, label_offsets, has_labels = self.cache
+
+        index = index % len(self.img_files)
+        img_path = self.img_files[index]
+        img = torch.from_numpy(shards[index // self.shard_size][index % self.shard_size]).float().div_(255)
+
+        targets = None
+        if has_labels[index]:
+            boxes = torch.from_numpy(labels[label_offsets[index] : label_offsets[index + 1]])
+            targets = torch.zeros((len(boxes), 6))
+            targets[:, 1:] = boxes
+
+        # Apply augmentations
+        if self.augment:
+            if np.random.random() < 0.5:
+                img, targets = horisontal_flip(img, targets)
+
+        return img_path, img, targets
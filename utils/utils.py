@@ -1,10 +1,12 @@
 from __future__ import division
 import math
+from collections import OrderedDict
 import time
 import tqdm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torchvision
 from torch.autograd import Variable
 import numpy as np
 import matplotlib.pyplot as plt
@@ -34,8 +36,20 @@ def weights_init_normal(m):
 
 
 def rescale_boxes(boxes, current_dim, original_shape):
-    """ Rescales bounding boxes to the original shape """
+    """
+    Rescales bounding boxes to the original shape. 'current_dim' is the side of the square input,
+    or its (height, width) for rectangular letterboxed inputs
+    """
     orig_h, orig_w = original_shape
+    if isinstance(current_dim, (tuple, list, torch.Size)):
+        # Undo the letterbox: the image was resized by 'scale' and then centered with padding
+        current_h, current_w = current_dim
+        scale = min(current_h / orig_h, current_w / orig_w)
+        pad_x = (current_w - min(round(orig_w * scale), current_w)) // 2
+        pad_y = (current_h - min(round(orig_h * scale), current_h)) // 2
+        boxes[:, [0, 2]] = (boxes[:, [0, 2]] - pad_x) / scale
+        boxes[:, [1, 3]] = (boxes[:, [1, 3]] - pad_y) / scale
+        return boxes
     # The amount of padding that was added
     pad_x = max(orig_h - orig_w, 0) * (current_dim / max(original_shape))
     pad_y = max(orig_w - orig_h, 0) * (current_dim / max(original_shape))
@@ -59,58 +73,75 @@ def xywh2xyxy(x):
     return y
 
 
+# IoU thresholds of the COCO mAP@[.5:.95]
+COCO_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+
 def ap_per_class(tp, conf, pred_cls, target_cls):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
+    All classes (and IoU thresholds) are computed at once over one sort of the predictions.
     # Arguments
-        tp:    True positives (list).
+        tp:    True positives (list), or array of shape (n, n_thresholds) for several IoU thresholds.
         conf:  Objectness value from 0-1 (list).
         pred_cls: Predicted object classes (list).
         target_cls: True object classes (list).
     # Returns
         The average precision as computed in py-faster-rcnn.
     """
-
-    # Sort by objectness
-    i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    tp, conf, pred_cls = np.asarray(tp, dtype=np.float64), np.asarray(conf), np.asarray(pred_cls)
+    single_threshold = tp.ndim == 1
+    if single_threshold:
+        tp = tp[:, None]
 
     # Find unique classes
-    unique_classes = np.unique(target_cls)
-
-    # Create Precision-Recall curve and compute AP for each class
-    ap, p, r = [], [], []
-    for c in tqdm.tqdm(unique_classes, desc="Computing AP"):
-        i = pred_cls == c
-        n_gt = (target_cls == c).sum()  # Number of ground truth objects
-        n_p = i.sum()  # Number of predicted objects
-
-        if n_p == 0 and n_gt == 0:
-            continue
-        elif n_p == 0 or n_gt == 0:
-            ap.append(0)
-            r.append(0)
-            p.append(0)
-        else:
-            # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum()
-            tpc = (tp[i]).cumsum()
-
-            # Recall
-            recall_curve = tpc / (n_gt + 1e-16)
-            r.append(recall_curve[-1])
-
-            # Precision
-            precision_curve = tpc / (tpc + fpc)
-            p.append(precision_curve[-1])
-
-            # AP from recall-precision curve
-            ap.append(compute_ap(recall_curve, precision_curve))
+    unique_classes, n_gt = np.unique(target_cls, return_counts=True)
+    n_c, n_t = len(unique_classes), tp.shape[1]
+    p, r, ap = np.zeros((n_c, n_t)), np.zeros((n_c, n_t)), np.zeros((n_c, n_t))
+
+    # Keep predictions of evaluated classes and sort them by class and then by objectness
+    class_i = np.minimum(np.searchsorted(unique_classes, pred_cls), max(n_c - 1, 0))
+    valid = unique_classes[class_i] == pred_cls if n_c else np.zeros(len(pred_cls), dtype=bool)
+    class_i, tp, conf = class_i[valid], tp[valid], conf[valid]
+    i = np.lexsort((-conf, class_i))
+    class_i, tp = class_i[i], tp[i]
+
+    if len(class_i):
+        # Segment of every class in the sorted predictions
+        n_p = np.bincount(class_i, minlength=n_c)  # Number of predicted objects
+        starts = np.cumsum(n_p) - n_p
+        rank = np.arange(len(class_i)) - starts[class_i]
+
+        # Accumulate FPs and TPs inside every class
+        tp_cumsum = np.cumsum(tp, 0)
+        tpc = tp_cumsum - np.concatenate((np.zeros((1, n_t)), tp_cumsum))[starts][class_i]
+        fpc = (rank + 1)[:, None] - tpc
+
+        # Recall and precision curves
+        recall_curve = tpc / (n_gt[class_i][:, None] + 1e-16)
+        precision_curve = tpc / (tpc + fpc)
+
+        # Precision envelope of every class in one pass: classes are shifted apart so the
+        # running maximum (from the end) never crosses into the previous class
+        shift = 2.0 * (n_c - class_i)[:, None]
+        envelope = np.flip(np.maximum.accumulate(np.flip(precision_curve + shift, 0), 0), 0) - shift
+
+        # Sum (\Delta recall) * prec, recall starts from zero in every class
+        previous_recall = np.concatenate((np.zeros((1, n_t)), recall_curve[:-1]))
+        previous_recall[rank == 0] = 0
+        area = (recall_curve - previous_recall) * envelope
+
+        has_p = n_p > 0
+        ap[has_p] = np.add.reduceat(area, starts[has_p], 0)
+        last = starts[has_p] + n_p[has_p] - 1
+        r[has_p] = recall_curve[last]
+        p[has_p] = precision_curve[last]
 
     # Compute F1 score (harmonic mean of precision and recall)
-    p, r, ap = np.array(p), np.array(r), np.array(ap)
     f1 = 2 * p * r / (p + r + 1e-16)
 
+    if single_threshold:
+        p, r, ap, f1 = p[:, 0], r[:, 0], ap[:, 0], f1[:, 0]
     return p, r, ap, f1, unique_classes.astype("int32")
 
 
@@ -130,8 +161,7 @@ def compute_ap(recall, precision):
     mpre = np.concatenate(([0.0], precision, [0.0]))
 
     # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -143,7 +173,10 @@ def compute_ap(recall, precision):
 
 
 def get_batch_statistics(outputs, targets, iou_threshold):
-    """ Compute true positives, predicted scores and predicted labels per sample """
+    """
+    Compute true positives, predicted scores and predicted labels per sample. With an array of
+    IoU thresholds the true positives have one column per threshold
+    """
     batch_metrics = []
     for sample_i in range(len(outputs)):
 
@@ -155,30 +188,75 @@ def get_batch_statistics(outputs, targets, iou_threshold):
         pred_scores = output[:, 4]
         pred_labels = output[:, -1]
 
-        true_positives = np.zeros(pred_boxes.shape[0])
+        thresholds = np.atleast_1d(iou_threshold)
+        true_positives = np.zeros((pred_boxes.shape[0], len(thresholds)))
 
         annotations = targets[targets[:, 0] == sample_i][:, 1:]
-        target_labels = annotations[:, 0] if len(annotations) else []
         if len(annotations):
-            detected_boxes = []
+            target_labels = annotations[:, 0]
             target_boxes = annotations[:, 1:]
 
-            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
+            # Best overlapping target of every prediction, from a single IoU matrix
+            iou, box_index = box_iou_matrix(pred_boxes, target_boxes).max(1)
+            iou, box_index = iou.cpu().numpy(), box_index.cpu().numpy()
+            # Predictions whose label is one of the target labels and that overlap enough, per threshold
+            label_match = (pred_labels[:, None] == target_labels[None, :]).any(1).cpu().numpy()
+            matched = label_match[None, :] & (iou[None, :] >= thresholds[:, None])
+            threshold_i, pred_i = matched.nonzero()
+            # Predictions are sorted by confidence, so the first one matched to each target is the true positive
+            _, first_i = np.unique(threshold_i * len(target_boxes) + box_index[pred_i], return_index=True)
+            true_positives[pred_i[first_i], threshold_i[first_i]] = 1
+        if np.ndim(iou_threshold) == 0:
+            true_positives = true_positives[:, 0]
+        batch_metrics.append([true_positives, pred_scores.cpu().numpy(), pred_labels.cpu().numpy()])
+    return batch_metrics
 
-                # If targets are found break
-                if len(detected_boxes) == len(annotations):
-                    break
 
-                # Ignore if label is not one of the target labels
-                if pred_label not in target_labels:
-                    continue
+class StatisticsAccumulator:
+    """
+    Accumulates the true positives, scores and labels of the predictions, and the target labels,
+    of every evaluated batch in growable preallocated buffers
+    """
 
-                iou, box_index = bbox_iou(pred_box.unsqueeze(0), target_boxes).max(0)
-                if iou >= iou_threshold and box_index not in detected_boxes:
-                    true_positives[pred_i] = 1
-                    detected_boxes += [box_index]
-        batch_metrics.append([true_positives, pred_scores, pred_labels])
-    return batch_metrics
+    def __init__(self, iou_threshold, capacity=4096):
+        self.iou_threshold = iou_threshold
+        self.true_positives = np.zeros((capacity,) + np.shape(iou_threshold))
+        self.pred_scores = np.zeros(capacity, dtype=np.float32)
+        self.pred_labels = np.zeros(capacity, dtype=np.float32)
+        self.num_preds = 0
+        self.target_labels = np.zeros(capacity, dtype=np.float32)
+        self.num_targets = 0
+
+    @staticmethod
+    def append(buffer, size, values):
+        """ Writes 'values' after the first 'size' elements of 'buffer', doubling it when full """
+        if size + len(values) > len(buffer):
+            grown = np.zeros((max(2 * len(buffer), size + len(values)),) + buffer.shape[1:], dtype=buffer.dtype)
+            grown[:size] = buffer[:size]
+            buffer = grown
+        buffer[size : size + len(values)] = values
+        return buffer
+
+    def update(self, outputs, targets):
+        """ Adds the predictions of a batch, 'targets' must already be in (x1, y1, x2, y2) pixels """
+        labels = targets[:, 1].cpu().numpy()
+        self.target_labels = self.append(self.target_labels, self.num_targets, labels)
+        self.num_targets += len(labels)
+
+        for true_positives, pred_scores, pred_labels in get_batch_statistics(outputs, targets, self.iou_threshold):
+            self.true_positives = self.append(self.true_positives, self.num_preds, true_positives)
+            self.pred_scores = self.append(self.pred_scores, self.num_preds, pred_scores)
+            self.pred_labels = self.append(self.pred_labels, self.num_preds, pred_labels)
+            self.num_preds += len(true_positives)
+
+    def compute(self):
+        """ Returns precision, recall, AP, f1 and classes, as ap_per_class """
+        return ap_per_class(
+            self.true_positives[: self.num_preds],
+            self.pred_scores[: self.num_preds],
+            self.pred_labels[: self.num_preds],
+            self.target_labels[: self.num_targets],
+        )
 
 
 def bbox_wh_iou(wh1, wh2):
@@ -223,99 +301,199 @@ def bbox_iou(box1, box2, x1y1x2y2=True):
     return iou
 
 
-def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4):
+def box_iou_matrix(boxes1, boxes2):
+    """
+    Returns the pairwise IoU matrix of shape (len(boxes1), len(boxes2)) between two sets of
+    (x1, y1, x2, y2) boxes, using the same pixel convention as bbox_iou
+    """
+    area1 = (boxes1[:, 2] - boxes1[:, 0] + 1) * (boxes1[:, 3] - boxes1[:, 1] + 1)
+    area2 = (boxes2[:, 2] - boxes2[:, 0] + 1) * (boxes2[:, 3] - boxes2[:, 1] + 1)
+    inter_top_left = torch.max(boxes1[:, None, :2], boxes2[None, :, :2])
+    inter_bottom_right = torch.min(boxes1[:, None, 2:4], boxes2[None, :, 2:4])
+    inter_wh = torch.clamp(inter_bottom_right - inter_top_left + 1, min=0)
+    inter_area = inter_wh[..., 0] * inter_wh[..., 1]
+    return inter_area / (area1[:, None] + area2[None, :] - inter_area + 1e-16)
+
+
+def _rank_within_group(group):
+    """ Position of every element inside its group, for a tensor already sorted by group """
+    counts = torch.bincount(group)
+    starts = counts.cumsum(0) - counts
+    return torch.arange(group.numel(), device=group.device) - starts[group]
+
+
+def _top_k_per_group(group, score, k):
+    """ Indices of the k best scored elements of each group, sorted by group and then by score """
+    order = torch.sort(score, descending=True, stable=True)[1]
+    order = order[torch.sort(group[order], stable=True)[1]]
+    return order[_rank_within_group(group[order]) < k]
+
+
+def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4, merge=True, max_det=300, max_nms=30000):
     """
     Removes detections with lower object confidence score than 'conf_thres' and performs
     Non-Maximum Suppression to further filter detections.
+    The whole batch is suppressed in a single call, per image and class. With 'merge' every
+    kept box is replaced by the object confidence weighted mean of the boxes it suppresses.
+    At most 'max_nms' candidates per image enter the suppression and at most 'max_det'
+    detections are kept (None disables either limit).
     Returns detections with shape:
         (x1, y1, x2, y2, object_conf, class_score, class_pred)
     """
+    output = [None for _ in range(len(prediction))]
 
+    # Filter out confidence scores below threshold for every image at once
+    image_i, anchor_i = (prediction[..., 4] >= conf_thres).nonzero(as_tuple=True)
+    if not image_i.numel():
+        return output
+    candidates = prediction[image_i, anchor_i]
     # From (center x, center y, width, height) to (x1, y1, x2, y2)
-    prediction[..., :4] = xywh2xyxy(prediction[..., :4])
-    output = [None for _ in range(len(prediction))]
-    for image_i, image_pred in enumerate(prediction):
-        # Filter out confidence scores below threshold
-        image_pred = image_pred[image_pred[:, 4] >= conf_thres]
-        # If none are remaining => process next image
-        if not image_pred.size(0):
-            continue
-        # Object confidence times class confidence
-        score = image_pred[:, 4] * image_pred[:, 5:].max(1)[0]
-        # Sort by it
-        image_pred = image_pred[(-score).argsort()]
-        class_confs, class_preds = image_pred[:, 5:].max(1, keepdim=True)
-        detections = torch.cat((image_pred[:, :5], class_confs.float(), class_preds.float()), 1)
-        # Perform non-maximum suppression
-        keep_boxes = []
-        while detections.size(0):
-            large_overlap = bbox_iou(detections[0, :4].unsqueeze(0), detections[:, :4]) > nms_thres
-            label_match = detections[0, -1] == detections[:, -1]
-            # Indices of boxes with lower confidence scores, large IOUs and matching labels
-            invalid = large_overlap & label_match
-            weights = detections[invalid, 4:5]
-            # Merge overlapping bboxes by order of confidence
-            detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
-            keep_boxes += [detections[0]]
-            detections = detections[~invalid]
-        if keep_boxes:
-            output[image_i] = torch.stack(keep_boxes)
+    boxes = xywh2xyxy(candidates[:, :4])
+    class_confs, class_preds = candidates[:, 5:].max(1)
+    # Object confidence times class confidence
+    score = candidates[:, 4] * class_confs
+
+    # Keep only the best candidates of each image to bound the suppression cost
+    top = _top_k_per_group(image_i, score, max_nms if max_nms is not None else len(score))
+    image_i, boxes, score = image_i[top], boxes[top], score[top]
+    detections = torch.cat(
+        (boxes, candidates[top, 4:5], class_confs[top].unsqueeze(1), class_preds[top].unsqueeze(1).float()), 1
+    )
+
+    # Suppress per image and class; batched_nms offsets small inputs apart and splits large ones
+    # by group, so the cost does not grow with the square of the whole batch
+    group = image_i * (prediction.size(-1) - 5) + class_preds[top]
+    nms_boxes = boxes.double()
+    # Shift the bottom right corner so the IoU matches the pixel convention of bbox_iou
+    nms_boxes[:, 2:] += 1
+    keep = torchvision.ops.batched_nms(nms_boxes, score.double(), group, nms_thres)
+
+    if merge:
+        # Pair every kept box only with the candidates of its own image and class, so memory grows
+        # with the size of the groups and not with the whole batch
+        order = torch.sort(group, stable=True)[1]
+        counts = torch.bincount(group)
+        starts = counts.cumsum(0) - counts
+        pairs_per_keep = counts[group[keep]]
+        pair_keep = torch.repeat_interleave(torch.arange(len(keep), device=keep.device), pairs_per_keep)
+        pair_offset = _rank_within_group(pair_keep)
+        pair_box = order[starts[group[keep]][pair_keep] + pair_offset]
+        suppresses = bbox_iou(boxes[keep][pair_keep], boxes[pair_box]) > nms_thres
+        pair_keep, pair_box = pair_keep[suppresses], pair_box[suppresses]
+
+        # Each box is merged into the first kept box (by confidence) that suppresses it
+        first_keep = torch.full((len(boxes),), len(keep), dtype=pair_keep.dtype, device=keep.device)
+        first_keep = first_keep.scatter_reduce(0, pair_box, pair_keep, reduce="amin")
+        first = first_keep[pair_box] == pair_keep
+        pair_keep, pair_box = pair_keep[first], pair_box[first]
+        weights = detections[pair_box, 4:5]
+        merged = torch.zeros(len(keep), 4, dtype=boxes.dtype, device=boxes.device)
+        merged.index_add_(0, pair_keep, weights * boxes[pair_box])
+        total = torch.zeros(len(keep), 1, dtype=boxes.dtype, device=boxes.device).index_add_(0, pair_keep, weights)
+        detections[keep, :4] = merged / total
+
+    # Sort kept detections by image (and by confidence inside it) and cap them
+    keep = keep[_top_k_per_group(image_i[keep], score[keep], max_det if max_det is not None else len(keep))]
+    counts = torch.bincount(image_i[keep], minlength=len(prediction)).tolist()
+    for i, image_detections in enumerate(torch.split(detections[keep], counts)):
+        if counts[i]:
+            output[i] = image_detections
 
     return output
 
 
+# Dense target buffers reused across batches, keyed by shape, device and dtype
+target_buffers = OrderedDict()
+TARGET_BUFFERS_SIZE = 16
+
+
+def get_target_buffers(nB, nA, nG, nC, device, dtype, layer=0):
+    """
+    Returns cleared (masks, values, tcls) buffers for a batch: 'masks' holds obj_mask and noobj_mask,
+    'values' holds class_mask, iou_scores, tx, ty, tw and th. 'layer' keeps apart the buffers of
+    layers built in the same call
+    """
+    key = (nB, nA, nG, nC, device, dtype, layer)
+    if key in target_buffers:
+        target_buffers.move_to_end(key)
+    else:
+        target_buffers[key] = (
+            torch.empty((2, nB, nA, nG, nG), dtype=torch.bool, device=device),
+            torch.empty((6, nB, nA, nG, nG), dtype=dtype, device=device),
+            torch.empty((nB, nA, nG, nG, nC), dtype=dtype, device=device),
+        )
+        if len(target_buffers) > TARGET_BUFFERS_SIZE:
+            target_buffers.popitem(last=False)
+    masks, values, tcls = target_buffers[key]
+    masks[0].fill_(0)
+    masks[1].fill_(1)
+    values.zero_()
+    tcls.zero_()
+    return masks, values, tcls
+
+
 def build_targets(pred_boxes, pred_cls, target, anchors, ignore_thres):
+    return build_targets_layers([pred_boxes], [pred_cls], target, [anchors], ignore_thres)[0]
+
 
-    BoolTensor = torch.cuda.BoolTensor if pred_boxes.is_cuda else torch.BoolTensor
-    FloatTensor = torch.cuda.FloatTensor if pred_boxes.is_cuda else torch.FloatTensor
-
-    nB = pred_boxes.size(0)
-    nA = pred_boxes.size(1)
-    nC = pred_cls.size(-1)
-    nG = pred_boxes.size(2)
-
-    # Output tensors
-    obj_mask = BoolTensor(nB, nA, nG, nG).fill_(0)
-    noobj_mask = BoolTensor(nB, nA, nG, nG).fill_(1)
-    class_mask = FloatTensor(nB, nA, nG, nG).fill_(0)
-    iou_scores = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tx = FloatTensor(nB, nA, nG, nG).fill_(0)
-    ty = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tw = FloatTensor(nB, nA, nG, nG).fill_(0)
-    th = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tcls = FloatTensor(nB, nA, nG, nG, nC).fill_(0)
-
-    # Convert to position relative to box
-    target_boxes = target[:, 2:6] * nG
-    gxy = target_boxes[:, :2]
-    gwh = target_boxes[:, 2:]
-    # Get anchors with best iou
-    ious = torch.stack([bbox_wh_iou(anchor, gwh) for anchor in anchors])
-    best_ious, best_n = ious.max(0)
+def build_targets_layers(pred_boxes, pred_cls, target, anchors, ignore_thres):
+    """
+    Builds the targets of several YOLO layers in one call. 'pred_boxes', 'pred_cls' and 'anchors'
+    hold one entry per layer, with the anchors in grid units of their layer. The target columns are
+    split once and the anchor IoUs of all layers come from one (anchors x targets) matrix: anchors
+    are divided by their grid size, as the IoU of widths and heights does not depend on it.
+    Returns one (iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf) per layer
+    """
     # Separate target values
     b, target_labels = target[:, :2].long().t()
-    gx, gy = gxy.t()
-    gw, gh = gwh.t()
-    gi, gj = gxy.long().t()
-    # Set masks
-    obj_mask[b, best_n, gj, gi] = 1
-    noobj_mask[b, best_n, gj, gi] = 0
-
-    # Set noobj mask to zero where iou exceeds ignore threshold
-    for i, anchor_ious in enumerate(ious.t()):
-        noobj_mask[b[i], anchor_ious > ignore_thres, gj[i], gi[i]] = 0
-
-    # Coordinates
-    tx[b, best_n, gj, gi] = gx - gx.floor()
-    ty[b, best_n, gj, gi] = gy - gy.floor()
-    # Width and height
-    tw[b, best_n, gj, gi] = torch.log(gw / anchors[best_n][:, 0] + 1e-16)
-    th[b, best_n, gj, gi] = torch.log(gh / anchors[best_n][:, 1] + 1e-16)
-    # One-hot encoding of label
-    tcls[b, best_n, gj, gi, target_labels] = 1
-    # Compute label correctness and iou at best anchor
-    class_mask[b, best_n, gj, gi] = (pred_cls[b, best_n, gj, gi].argmax(-1) == target_labels).float()
-    iou_scores[b, best_n, gj, gi] = bbox_iou(pred_boxes[b, best_n, gj, gi], target_boxes, x1y1x2y2=False)
-
-    tconf = obj_mask.float()
-    return iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf
+    grid_sizes = [layer_boxes.size(2) for layer_boxes in pred_boxes]
+    # Anchor IoUs of every layer at once, split back by layer
+    normalized_anchors = torch.cat([layer_anchors / nG for layer_anchors, nG in zip(anchors, grid_sizes)])
+    all_ious = bbox_wh_iou(normalized_anchors.t().unsqueeze(-1), target[:, 4:6])
+    layer_ious = torch.split(all_ious, [len(layer_anchors) for layer_anchors in anchors])
+
+    layer_targets = []
+    for layer, (layer_boxes, layer_cls, layer_anchors, ious, nG) in enumerate(
+        zip(pred_boxes, pred_cls, anchors, layer_ious, grid_sizes)
+    ):
+        nB = layer_boxes.size(0)
+        nA = layer_boxes.size(1)
+        nC = layer_cls.size(-1)
+
+        # Output tensors
+        masks, values, tcls = get_target_buffers(nB, nA, nG, nC, layer_boxes.device, layer_boxes.dtype, layer)
+        obj_mask, noobj_mask = masks
+        class_mask, iou_scores, tx, ty, tw, th = values
+
+        # Convert to position relative to box
+        target_boxes = target[:, 2:6] * nG
+        gxy = target_boxes[:, :2]
+        gwh = target_boxes[:, 2:]
+        # Get anchors with best iou
+        best_ious, best_n = ious.max(0)
+        gx, gy = gxy.t()
+        gw, gh = gwh.t()
+        gi, gj = gxy.long().t()
+        # Set masks
+        obj_mask[b, best_n, gj, gi] = 1
+        noobj_mask[b, best_n, gj, gi] = 0
+
+        # Set noobj mask to zero where iou exceeds ignore threshold, for every target and anchor at once
+        target_i, anchor_i = (ious.t() > ignore_thres).nonzero(as_tuple=True)
+        noobj_mask[b[target_i], anchor_i, gj[target_i], gi[target_i]] = 0
+
+        # Coordinates
+        tx[b, best_n, gj, gi] = gx - gx.floor()
+        ty[b, best_n, gj, gi] = gy - gy.floor()
+        # Width and height
+        tw[b, best_n, gj, gi] = torch.log(gw / layer_anchors[best_n][:, 0] + 1e-16)
+        th[b, best_n, gj, gi] = torch.log(gh / layer_anchors[best_n][:, 1] + 1e-16)
+        # One-hot encoding of label
+        tcls[b, best_n, gj, gi, target_labels] = 1
+        # Compute label correctness and iou at best anchor
+        class_mask[b, best_n, gj, gi] = (layer_cls[b, best_n, gj, gi].argmax(-1) == target_labels).float()
+        iou_scores[b, best_n, gj, gi] = bbox_iou(layer_boxes[b, best_n, gj, gi], target_boxes, x1y1x2y2=False)
+
+        tconf = obj_mask.float()
+        layer_targets.append((iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf))
+    return layer_targets